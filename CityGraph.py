@@ -1,14 +1,23 @@
 import json
 
-import matplotlib.pyplot as plt
-from matplotlib import style
+from estimators import EpidemicEstimators
+from lazy import lazy_import
 import time
 
-import seaborn as sns
+# loaded on first use, see lazy.py
+plt = lazy_import('matplotlib.pyplot')
+style = lazy_import('matplotlib.style')
+sns = lazy_import('seaborn')
 
 
 class CityGraph:
-    def __init__(self, city):
+    def __init__(self, city, keep_series=True):
+        '''Records the course of the epidemic in a city, one day at a time.
+
+        :param city.City city: city to follow
+        :param bool keep_series: keep every day's states and beta; without them only the estimators are updated,
+            and the curves cannot be plotted
+        '''
         self.city = city
         self.name = city.name
         self.edge_proximity = city.edge_proximity
@@ -21,6 +30,12 @@ class CityGraph:
         self.betas = []
         self.timestep_of_convergence = None
         self.total_infected = 0
+        self.keep_series = keep_series
+        self.estimators = EpidemicEstimators(city.gamma)
+        # City.snapshot of every day, kept when scatter plots are wanted and rendered after the run, either in
+        # memory or streamed to a snapshots.SnapshotWriter
+        self.snapshots = []
+        self.snapshot_writer = None
 
     @property
     def beta(self):
@@ -31,7 +46,18 @@ class CityGraph:
 
     def set_beta(self, beta):
         self._beta = beta
-        self.betas.append(beta)
+        if self.keep_series:
+            self.betas.append(beta)
+
+    def record(self, i, state_dict, beta):
+        """Take in day i's states and beta."""
+        self.set_beta(beta)
+        if state_dict['total_IR'] == self.N and not self.timestep_of_convergence:
+            self.timestep_of_convergence = i
+        if self.keep_series:
+            self.xs.append(i)
+            self.ys.append(state_dict)
+        self.estimators.update(state_dict, beta)
 
     def write_data(self):
         data_line = '{} {}\n'.format(self.beta * (1 / self.gamma), self.total_infected)
@@ -41,17 +67,10 @@ class CityGraph:
     def plot_data(self):
         """Plot S, I, R curves over time.
 
-        # TODO: animation?
+        See render.write_animation for an animation of the agents themselves.
         """
-        plot_dict_susceptible = {}
-        plot_dict_infected = {}
-        plot_dict_removed = {}
-        plot_dict_quarantined = {}
-        for i, d in enumerate(self.ys):
-            plot_dict_susceptible[i] = d['susceptible']
-            plot_dict_infected[i] = d['infected']
-            plot_dict_removed[i] = d['removed']
-            plot_dict_quarantined[i] = d['quarantined'] 
+        self._check_series()
+        series = {key: [d[key] for d in self.ys] for key in ['susceptible', 'infected', 'removed', 'quarantined']}
 
         movement_policy_probs = self.city.policy.movement_probabilities
         movement_policy = movement_policy_probs[len(self.xs)-1]
@@ -78,14 +97,10 @@ class CityGraph:
         ax.text(x=0.5, y=1.1, s=title, fontsize=16, weight='bold', ha='center', va='bottom', transform=ax.transAxes)
         ax.text(x=0.5, y=1.05, s=subtitle, fontsize=10, alpha=0.75, ha='center', va='bottom', transform=ax.transAxes)
 
-        plt.plot(list(plot_dict_susceptible.keys()), list(plot_dict_susceptible.values()), "b-",
-                 label="Susceptible")
-        plt.plot(list(plot_dict_infected.keys()), list(plot_dict_infected.values()), "r-",
-                 label="Infected")
-        plt.plot(list(plot_dict_removed.keys()), list(plot_dict_removed.values()), "g-",
-                 label="Removed")
-        plt.plot(list(plot_dict_quarantined.keys()), list(plot_dict_quarantined.values()), "k--", linewidth=1,
-                 label="Quarantined")
+        plt.plot(series['susceptible'], "b-", label="Susceptible")
+        plt.plot(series['infected'], "r-", label="Infected")
+        plt.plot(series['removed'], "g-", label="Removed")
+        plt.plot(series['quarantined'], "k--", linewidth=1, label="Quarantined")
 
         plt.xlabel('time')
         plt.ylabel('Number of Agents')
@@ -94,10 +109,16 @@ class CityGraph:
         plt.savefig('data/{}'.format(plotname), dpi=300, bbox_inches='tight')
         # plt.show()
         plt.close(fig1)
-        i_max = max(plot_dict_infected.values())
+        i_max = max(series['infected'])
         return i_max
 
+    def _check_series(self):
+        if not self.keep_series:
+            raise ValueError('{} was followed without keeping its time series, so it has no curves to plot'.format(
+                self.name))
+
     def plot_ro(self):
+        self._check_series()
         plot_dict_betas = {}
         for i, beta in enumerate(self.betas):
             plot_dict_betas[i] = beta * 1 / self.gamma
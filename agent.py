@@ -1,14 +1,21 @@
 import math
 import city
+import kernels
 import random
 import numpy as np
 
-from scipy.spatial import Voronoi, voronoi_plot_2d
-from shapely.geometry import Point
-from shapely.geometry.polygon import Polygon
+# angles a random walk can turn by in one step, shared by every agent
+THETA_STAR = tuple(np.linspace(-(math.pi / 2), (math.pi / 2), 100).tolist())
 
 
 class Agent:
+    # no per-agent __dict__; positions, movement probabilities and central locations live in the city's arrays
+    __slots__ = ('_state', 'timesteps_infected', 'city', 'policy', 'health_policy_active', 'prior_direction',
+                 'direction', 'mode', 'movement_angle_at_current_timestep', 'number', 'transitioned_this_timestep')
+    STATES = ('susceptible', 'infected', 'removed')
+    theta_star = THETA_STAR
+    velocity = 1.0
+
     def __init__(self, i, city):
         '''Defines an agent, which represents a node in the city-level infection network.
 
@@ -16,9 +23,7 @@ class Agent:
         :param city.City city: City object encompassing the agent
         '''
         # attributes
-        self.susceptible = True
-        self.infected = False
-        self.removed = False
+        self._state = 'susceptible'
 
         self.timesteps_infected = 0
         self.city = city
@@ -26,30 +31,80 @@ class Agent:
 
         self.health_policy_active = False
 
-        self.positionx = None
-        self.positiony = None
-        self.prior_x_position = 0
-        self.prior_y_position = 0
         self.prior_direction = 0
         self.direction = 0
 
         self.mode = None
-        self.personal_central_locations = {}
-        self.stay_at_home_probability = None # 6 days out of a week, on average
-        self.work_probability = None
-        self.transit_probability = None
-        self.shop_probability = None
 
-        self.theta_star = np.linspace(-(math.pi / 2), (math.pi / 2), 100)
         self.movement_angle_at_current_timestep = self.theta_star[random.randint(0, 99)]
-        self.name = "Agent #{}".format(i)
         self.number = i
-        self.velocity = 1.0
         self.transitioned_this_timestep = False
-        self._been_quarantined = False
         
         self.initialize_position_and_direction_and_state()
 
+    @property
+    def name(self):
+        return "Agent #{}".format(self.number)
+
+    @property
+    def positionx(self):
+        return float(self.city.position_xs[self.number])
+
+    @positionx.setter
+    def positionx(self, x):
+        self.city.position_xs[self.number] = x
+
+    @property
+    def positiony(self):
+        return float(self.city.position_ys[self.number])
+
+    @positiony.setter
+    def positiony(self, y):
+        self.city.position_ys[self.number] = y
+
+    @property
+    def prior_x_position(self):
+        return float(self.city.prior_xs[self.number])
+
+    @prior_x_position.setter
+    def prior_x_position(self, x):
+        self.city.prior_xs[self.number] = x
+
+    @property
+    def prior_y_position(self):
+        return float(self.city.prior_ys[self.number])
+
+    @prior_y_position.setter
+    def prior_y_position(self, y):
+        self.city.prior_ys[self.number] = y
+
+    @property
+    def personal_central_locations(self):
+        """(x, y) of the agent's central location for every mode, from the city's site arrays."""
+        return {mode: self.city.central_location(self.number, mode) for mode in kernels.MODES}
+
+    def _movement_probability(self, mode):
+        probabilities = self.city.movement_probabilities
+        if probabilities is None:
+            return None
+        return float(probabilities[self.number, kernels.MODE_CODES[mode]])
+
+    @property
+    def stay_at_home_probability(self):
+        return self._movement_probability('home')
+
+    @property
+    def work_probability(self):
+        return self._movement_probability('work')
+
+    @property
+    def shop_probability(self):
+        return self._movement_probability('market')
+
+    @property
+    def transit_probability(self):
+        return self._movement_probability('transit')
+
     def initialize_position_and_direction_and_state(self):
         self.positionx = random.random() * self.city.width
         self.positiony = random.random() * self.city.height
@@ -100,18 +155,16 @@ class Agent:
         If they leave they teleport to the nearest central location, dictated by the
         voronoi diagram around the poissson point process.
         '''
-        msg = '{} probability has not been set!'
-        assert self.shop_probability is not None, msg.format('market')
-        assert self.stay_at_home_probability is not None, msg.format('home')
-        assert self.work_probability is not None, msg.format('work')
-        assert self.transit_probability is not None, msg.format('transit')
+        assert self.city.movement_probabilities is not None, 'Movement probabilities have not been set!'
+        stay_at_home_probability, work_probability, shop_probability, _ = \
+            self.city.movement_probabilities[self.number].tolist()
 
         rand_val = random.random()
-        if rand_val < self.stay_at_home_probability:
+        if rand_val < stay_at_home_probability:
             mode = 'home'
-        elif self.stay_at_home_probability + self.work_probability > rand_val >= self.stay_at_home_probability:
+        elif stay_at_home_probability + work_probability > rand_val >= stay_at_home_probability:
             mode = 'work'
-        elif self.shop_probability + self.stay_at_home_probability + self.work_probability > rand_val >= self.stay_at_home_probability + self.work_probability:
+        elif shop_probability + stay_at_home_probability + work_probability > rand_val >= stay_at_home_probability + work_probability:
             mode = 'market'
         else:
             mode = 'transit'
@@ -120,8 +173,9 @@ class Agent:
         assert self.mode
         self.prior_x_position = self.positionx
         self.prior_y_position = self.positiony
-        self.positionx = list(self.personal_central_locations[self.mode])[0] + np.random.normal(-0.5, 0.5)
-        self.positiony = list(self.personal_central_locations[self.mode])[1] + np.random.normal(-0.5, 0.5)
+        x, y = self.city.central_location(self.number, self.mode)
+        self.positionx = x + np.random.normal(-0.5, 0.5)
+        self.positiony = y + np.random.normal(-0.5, 0.5)
 
     def recalculate_positions_based_on_edges(self, city):
         '''Adjust the positions of an agent based on the city's boundaries.
@@ -157,18 +211,8 @@ class Agent:
         self.movement_angle_at_current_timestep = random.randint(155, 205) - self.movement_angle_at_current_timestep
 
     def transition_state(self, target_state):
-        if target_state == 'removed':
-            self.removed = True
-            self.infected = False
-            self.susceptible = False
-        if target_state == 'susceptible':
-            self.removed = False
-            self.infected = False
-            self.susceptible = True
-        if target_state == 'infected':
-            self.removed = False
-            self.infected = True
-            self.susceptible = False
+        if target_state in self.STATES:
+            self._state = target_state
 
     @property
     def get_city(self):
@@ -176,12 +220,19 @@ class Agent:
 
     @property
     def state(self):
-        if self.susceptible:
-            return 'susceptible'
-        elif self.infected:
-            return 'infected'
-        else:
-            return 'removed'
+        return self._state
+
+    @property
+    def susceptible(self):
+        return self._state == 'susceptible'
+
+    @property
+    def infected(self):
+        return self._state == 'infected'
+
+    @property
+    def removed(self):
+        return self._state == 'removed'
 
     def set_and_verify_locations(self, market_regions, transit_regions, workspace_regions, home_regions):
         """Set a central location (supermarket) for the agent based on their home location.
@@ -199,7 +250,6 @@ class Agent:
                              'transit': transit_regions[1],
                              'work': workspace_regions[1],
                              'home': home_regions[1]}
-        point = Point(self.positionx, self.positiony)
 
         if not market_regions[0]:
             # setup_voronoi_diagrams returned an error so we use random wiring to determine locations
@@ -214,8 +264,7 @@ class Agent:
                 points_list = enumerated_points.get(key)
                 if points_list:
                     random_index = random.randint(0, len(points_list) - 1)
-                    self.personal_central_locations[key] = frozenset([points_list[random_index][0],
-                                                                      points_list[random_index][1]])
+                    self.city.central_sites[self.number, kernels.MODE_CODES[key]] = random_index
                     used_regions[key] = random_index
                 else:
                     print('No {} location found for {}'.format(key, self.name))
@@ -233,20 +282,13 @@ class Agent:
                             'home': None
                             }
             for location_type, poly_tuples in enumerated_regions.items():
-                assigned = False
-                for region, polygon in poly_tuples:
-                    if polygon.contains(point) and not assigned:
-                        self.personal_central_locations[location_type] = frozenset(
-                            [enumerated_points[location_type][region][0],
-                             enumerated_points[location_type][region][1]])  # strip dupes
-                        assigned = True
-                        used_regions[location_type] = region
-
-                if not assigned:
+                region = poly_tuples.region_containing(self.positionx, self.positiony)
+                if region is not None:
+                    self.city.central_sites[self.number, kernels.MODE_CODES[location_type]] = region
+                    used_regions[location_type] = region
+                else:
                     random_index = random.randint(0, len(poly_tuples)) % len(enumerated_points[location_type])
-                    self.personal_central_locations[location_type] = frozenset(
-                        [enumerated_points[location_type][random_index][0],
-                         enumerated_points[location_type][random_index][1]])
+                    self.city.central_sites[self.number, kernels.MODE_CODES[location_type]] = random_index
                     used_regions[location_type] = random_index
 
         return used_regions
@@ -254,10 +296,10 @@ class Agent:
     def set_policy(self, policy, i):
         self.policy = policy
         if self.policy.movement_probabilities:
-            self.shop_probability = self.policy.get_probability(i, 'market')
-            self.stay_at_home_probability = self.policy.get_probability(i, 'home')
-            self.transit_probability = self.policy.get_probability(i, 'transit')
-            self.work_probability = self.policy.get_probability(i, 'work')
+            if self.city.movement_probabilities is None:
+                self.city.movement_probabilities = np.full((self.city.N, len(kernels.MODES)), np.nan)
+            self.city.movement_probabilities[self.number] = [self.policy.get_probability(i, mode)
+                                                             for mode in kernels.MODES]
 
     def is_infected(self):
         return self.infected
@@ -278,19 +320,21 @@ class Agent:
         return self.transitioned_this_timestep
     
     def has_been_quarantined(self):
-        self._been_quarantined = True
+        self.city.quarantine_center.mask[self.number] = True
         
     def not_quarantined(self):
-        self._been_quarantined = False
+        self.city.quarantine_center.mask[self.number] = False
 
     @property
     def been_quarantined(self):
-        return self._been_quarantined
+        # the city's quarantine center keeps track of who is quarantined
+        return bool(self.city.quarantine_center.mask[self.number])
         
     def send_to_quarantine_center(self):
         self.positionx = self.city.quarantine_center_location[0]+ np.random.normal(-5.0, 5.0)
         self.positiony = self.city.quarantine_center_location[1]+ np.random.normal(-5.0, 5.0)
     
     def send_to_home(self):
-        self.positionx = list(self.personal_central_locations['home'])[0] + np.random.normal(-0.5, 0.5)
-        self.positiony = list(self.personal_central_locations['home'])[1] + np.random.normal(-0.5, 0.5)
+        x, y = self.city.central_location(self.number, 'home')
+        self.positionx = x + np.random.normal(-0.5, 0.5)
+        self.positiony = y + np.random.normal(-0.5, 0.5)
@@ -0,0 +1,446 @@
+"""Benchmarks for city setup and the timestep hot paths.
+
+Runs the 'City A' configuration from simulation.construct_cities scaled to larger populations at the
+same density, and reports per-phase wall time, peak traced memory and agent-steps/sec. Results can be
+saved as a JSON baseline and later runs compared against it:
+
+    python benchmark.py --sizes 600 5000 --save
+    python benchmark.py --sizes 600 5000 --compare
+
+--startup instead checks that the simulation imports in a fresh interpreter within STARTUP_BUDGET seconds
+without pulling in any of the libraries that lazy.py defers, --footprint that an agent takes less than
+FOOTPRINT_BUDGET bytes, and --scaling that setup and per-day cost grow no faster than N ** SCALING_BUDGET at the
+density of City A.
+"""
+import argparse
+import contextlib
+import functools
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import simulation
+from agent import Agent
+from city import City
+from instrumentation import Instrumentation
+
+SCENARIOS = {
+    'city_a_600': 600,
+    'city_a_5k': 5000,
+    'city_a_50k': 50000,
+    'city_a_200k': 200000,
+}
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+# version of the simulated trajectories; baselines of another version ran different simulations and are not compared.
+# 2: central locations are read as (x, y) site coordinates rather than in the order of a frozenset of x and y
+BASELINE_VERSION = 2
+
+# modules that must import within STARTUP_BUDGET seconds, without loading any of DEFERRED_MODULES
+STARTUP_MODULES = ['city', 'simulation']
+STARTUP_BUDGET = 0.15
+DEFERRED_MODULES = ['networkx', 'seaborn', 'matplotlib', 'shapely', 'scipy', 'numba']
+
+# most bytes an agent may take: everything allocated to create its Agent plus its share of the city's agent arrays
+FOOTPRINT_BUDGET = 200
+
+# populations of --scaling, and the largest exponent of N that setup and per-day cost may grow with
+SCALING_SIZES = [1000, 2000, 4000, 8000]
+SCALING_BUDGET = 1.2
+
+# City A, as configured in simulation.construct_cities
+CITY_A_N = 600
+CITY_A_WIDTH = 200
+CITY_A_HEIGHT = 200
+CITY_A_FREQUENCIES = {'market': 50, 'transit': 200, 'work': 20, 'home': 3}
+CITY_A_INTENT = 'restrict'
+CITY_A_LOCKDOWN_T0 = 15
+
+SETUP_PHASES = [
+    (City, 'setup_voronoi_diagrams'),
+    (Agent, 'set_and_verify_locations'),
+]
+TIMESTEP_PHASES = [
+    (Agent, 'move'),
+    (City, 'find_edge_arrays'),
+    (City, 'handle_infection'),
+]
+
+
+class PhaseTimer:
+    def __init__(self):
+        '''Accumulates wall time and peak traced memory per named phase.'''
+        self.wall_times = {}
+        self.peak_memory = {}
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if tracemalloc.is_tracing() and self._depth == 0:
+            tracemalloc.reset_peak()
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.wall_times[name] = self.wall_times.get(name, 0.0) + time.perf_counter() - start
+            self._depth -= 1
+            if tracemalloc.is_tracing():
+                peak = tracemalloc.get_traced_memory()[1]
+                self.peak_memory[name] = max(self.peak_memory.get(name, 0), peak)
+
+    @contextlib.contextmanager
+    def wrap_methods(self, methods):
+        '''Time every call of the given (class, method name) pairs while the context is active.'''
+        originals = []
+        for cls, name in methods:
+            original = getattr(cls, name)
+            originals.append((cls, name, original))
+            setattr(cls, name, self._timed(name, original))
+        try:
+            yield
+        finally:
+            for cls, name, original in originals:
+                setattr(cls, name, original)
+
+    def _timed(self, name, method):
+        wall_times = self.wall_times
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                wall_times[name] = wall_times.get(name, 0.0) + time.perf_counter() - start
+        return timed
+
+
+def construct_city_a(n, days, seed, backend='python', contact_engine='auto'):
+    """Build City A scaled to n agents, keeping its population density.
+
+    :param int n: number of agents
+    :param int days: number of timesteps the policy schedule must cover
+    :param int seed: seed for both random number generators
+    :param str backend: City backend
+    :param str contact_engine: City contact engine
+    :rtype: City
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    scale = math.sqrt(n / CITY_A_N)
+    width = int(round(CITY_A_WIDTH * scale))
+    height = int(round(CITY_A_HEIGHT * scale))
+    location_policies_dict = simulation.construct_location_policies_dict(CITY_A_INTENT, days, CITY_A_LOCKDOWN_T0)
+    mpolicy = ['preferential_return', location_policies_dict]
+    city = City('City A', width, height, n, 0.2, 1.0 / simulation.COVID_Gamma, 'normal', mpolicy,
+                dict(CITY_A_FREQUENCIES), backend=backend, contact_engine=contact_engine)
+    city.view_all_policies(simulation.POLICIES)
+    return city
+
+
+def run_scenario(name, n, days, seed=0, trace_memory=True, backend='python', contact_engine='auto'):
+    """Set up and run one scenario, returning its measurements.
+
+    :param str name: scenario name
+    :param int n: number of agents
+    :param int days: number of timesteps to run
+    :param int seed: random seed
+    :param bool trace_memory: record peak traced memory per phase (slows every phase down equally)
+    :param str backend: City backend
+    :param str contact_engine: City contact engine
+    :rtype: dict
+    """
+    timer = PhaseTimer()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            with timer.wrap_methods(SETUP_PHASES), timer.phase('setup'):
+                city = construct_city_a(n, days, seed, backend=backend, contact_engine=contact_engine)
+                city.set_initial_states()
+            records = []
+            city.instrument(Instrumentation(sink=records.append))
+            with timer.wrap_methods(TIMESTEP_PHASES), timer.phase('timestep'):
+                for i in range(days):
+                    city.timestep(i)
+                    city.get_states()
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    # break the timestep down into the phases City.timestep reports
+    counters = {}
+    for record in records:
+        for phase, wall_time in record['phases'].items():
+            key = 'timestep.{}'.format(phase)
+            timer.wall_times[key] = timer.wall_times.get(key, 0.0) + wall_time
+        for counter, value in record['counters'].items():
+            counters[counter] = counters.get(counter, 0) + value
+
+    timestep_time = timer.wall_times['timestep']
+    return {
+        'scenario': name,
+        'n': n,
+        'days': days,
+        'seed': seed,
+        'backend': backend,
+        'contact_engine': city.contact_engine.name,
+        'wall_time': timer.wall_times,
+        'peak_memory': timer.peak_memory,
+        'counters': counters,
+        'agent_steps_per_sec': n * days / timestep_time if timestep_time else None,
+    }
+
+
+def measure_startup(module, repeats=5):
+    """Time importing a module in fresh interpreters.
+
+    :param str module: module to import
+    :param int repeats: number of interpreters to start; the fastest import counts
+    :returns: dict with the import time in seconds and the deferred modules the import loaded
+    """
+    code = ('import json, sys, time\n'
+            'start = time.perf_counter()\n'
+            'import {}\n'
+            'elapsed = time.perf_counter() - start\n'
+            'print(json.dumps([elapsed, sorted(m for m in sys.modules if m.split(".")[0] in {!r})]))')
+    code = code.format(module, DEFERRED_MODULES)
+    times = []
+    loaded = set()
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        elapsed, modules = json.loads(output.splitlines()[-1])
+        times.append(elapsed)
+        loaded.update(module_name.split('.')[0] for module_name in modules)
+    return {'module': module, 'import_time': min(times), 'deferred_loaded': sorted(loaded)}
+
+
+def check_startup(budget=STARTUP_BUDGET):
+    """Check every module in STARTUP_MODULES against the startup budget.
+
+    :returns: list of failure messages
+    """
+    failures = []
+    for module in STARTUP_MODULES:
+        result = measure_startup(module)
+        print('import {:<12} {:>7.1f} ms  (budget {:.0f} ms)  deferred modules loaded: {}'.format(
+            module, result['import_time'] * 1000, budget * 1000, ', '.join(result['deferred_loaded']) or 'none'))
+        if result['import_time'] > budget:
+            failures.append('importing {} takes {:.0f} ms, over the {:.0f} ms budget'.format(
+                module, result['import_time'] * 1000, budget * 1000))
+        if result['deferred_loaded']:
+            failures.append('importing {} loads {}'.format(module, ', '.join(result['deferred_loaded'])))
+    return failures
+
+
+def measure_footprint(n, seed=0, days=2):
+    """Measure the memory every Agent of City A takes once its central locations are set.
+
+    :param int n: number of agents
+    :param int seed: random seed
+    :param int days: timesteps to run before measuring
+    :returns: dict with the bytes of one Agent object including any instance dict, the bytes traced while
+        creating n more agents for the same city per agent, and the bytes of the city's per-agent position arrays
+        per agent
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        city = construct_city_a(n, days, seed)
+        city.set_initial_states()
+        for i in range(days):
+            city.timestep(i)
+    agent = city.agents[0]
+    object_bytes = sys.getsizeof(agent)
+    if hasattr(agent, '__dict__'):
+        object_bytes += sys.getsizeof(agent.__dict__)
+    tracemalloc.start()
+    agents = [Agent(number, city) for number in range(n)]
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del agents
+    array_bytes = city.position_xs.nbytes + city.position_ys.nbytes + city.prior_xs.nbytes + city.prior_ys.nbytes
+    return {'n': n, 'object_bytes': object_bytes, 'traced_bytes_per_agent': traced / n,
+            'array_bytes_per_agent': array_bytes / n}
+
+
+def check_footprint(n, seed=0, budget=FOOTPRINT_BUDGET):
+    """Check the Agent footprint against the budget.
+
+    :returns: list of failure messages
+    """
+    result = measure_footprint(n, seed=seed)
+    per_agent = result['traced_bytes_per_agent'] + result['array_bytes_per_agent']
+    print('Agent {:>5.0f} bytes  (budget {} bytes)  traced {:.0f} + position arrays {:.0f}, Agent object {} bytes, '
+          'N={}'.format(per_agent, budget, result['traced_bytes_per_agent'], result['array_bytes_per_agent'],
+                        result['object_bytes'], n))
+    if per_agent >= budget:
+        return ['an agent takes {:.0f} bytes, over the {} byte budget'.format(per_agent, budget)]
+    return []
+
+
+def fit_exponent(sizes, times):
+    """Exponent b of the least squares fit of times = a * sizes ** b on a log-log scale."""
+    slope, _ = np.polyfit(np.log(sizes), np.log(times), 1)
+    return float(slope)
+
+
+def check_scaling(sizes=SCALING_SIZES, days=10, seed=0, backend='python', contact_engine='auto', repeats=3,
+                  budget=SCALING_BUDGET):
+    """Check that setup and per-day cost grow near-linearly with the population at a fixed density.
+
+    Runs City A scaled to every size and fits the exponent of N with which setup time and timestep time per day
+    grow; either exceeding the budget is a failure, which catches a quadratic path slipping back in.
+
+    :param int repeats: runs per size, of which the fastest setup and timesteps count
+    :returns: list of failure messages
+    """
+    # the first runs also pay for the lazy imports and, with numba, compilation
+    run_scenario('scaling_warmup', sizes[0], 2, seed=seed, trace_memory=False, backend=backend,
+                 contact_engine=contact_engine)
+    setup_times = []
+    day_times = []
+    for n in sizes:
+        results = [run_scenario('scaling_{}'.format(n), n, days, seed=seed, trace_memory=False, backend=backend,
+                                contact_engine=contact_engine) for _ in range(repeats)]
+        setup_times.append(min(result['wall_time']['setup'] for result in results))
+        day_times.append(min(result['wall_time']['timestep'] for result in results) / days)
+        print('N={:<7} setup {:>8.3f}s  per day {:>8.4f}s'.format(n, setup_times[-1], day_times[-1]))
+    failures = []
+    for phase, times in [('setup', setup_times), ('timestep per day', day_times)]:
+        exponent = fit_exponent(sizes, times)
+        print('{:<17} grows as N^{:.2f}  (budget N^{})'.format(phase, exponent, budget))
+        if exponent > budget:
+            failures.append('{} grows as N^{:.2f}, faster than N^{}'.format(phase, exponent, budget))
+    return failures
+
+
+def machine_info():
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'processor': platform.processor(),
+    }
+
+
+def compare(results, baseline, tolerance, min_time=0.05):
+    """Compare results against a baseline.
+
+    :param list[dict] results: measurements from run_scenario
+    :param dict baseline: previously saved benchmark output
+    :param float tolerance: allowed ratio of current over baseline wall time
+    :param float min_time: phases faster than this in the baseline are too noisy to flag
+    :returns: list of regression messages
+    """
+    if baseline.get('version', 1) != BASELINE_VERSION:
+        print('The baseline was saved by version {} of the simulation, this is version {}; save a new one'.format(
+            baseline.get('version', 1), BASELINE_VERSION))
+        return []
+    baseline_results = {r['scenario']: r for r in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result['scenario'])
+        if (previous is None or previous['days'] != result['days'] or
+                previous.get('backend', 'python') != result['backend'] or
+                previous.get('contact_engine', 'cell_list') != result['contact_engine']):
+            print('{}: no comparable baseline'.format(result['scenario']))
+            continue
+        for phase, wall_time in sorted(result['wall_time'].items()):
+            previous_time = previous['wall_time'].get(phase)
+            if not previous_time:
+                continue
+            ratio = wall_time / previous_time
+            print('{:<14} {:<26} {:>9.3f}s  baseline {:>9.3f}s  x{:.2f}'.format(
+                result['scenario'], phase, wall_time, previous_time, ratio))
+            if ratio > tolerance and previous_time >= min_time:
+                regressions.append('{} {} is {:.2f}x slower than baseline'.format(
+                    result['scenario'], phase, ratio))
+    return regressions
+
+
+def print_result(result):
+    print('{} (N={}, {} days, {:.0f} agent-steps/sec)'.format(
+        result['scenario'], result['n'], result['days'], result['agent_steps_per_sec'] or 0))
+    for phase, wall_time in sorted(result['wall_time'].items()):
+        peak = result['peak_memory'].get(phase)
+        memory = '{:>9.1f} MiB peak'.format(peak / 2 ** 20) if peak is not None else ''
+        print('  {:<26} {:>9.3f}s {}'.format(phase, wall_time, memory))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[SCENARIOS['city_a_600']],
+                        help='populations to run, chosen from {}'.format(sorted(SCENARIOS.values())))
+    parser.add_argument('--days', type=int, default=10, help='timesteps per scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', default='python', help="City backend: python, numpy, numba or auto")
+    parser.add_argument('--contact-engine', default='auto',
+                        help='City contact engine: cell_list, co_occupancy, verlet_list or auto')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace peak memory')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON file')
+    parser.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results against the baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='wall time ratio over baseline that counts as a regression')
+    parser.add_argument('--startup', action='store_true',
+                        help='only check import time and deferred imports against the startup budget')
+    parser.add_argument('--footprint', action='store_true',
+                        help='only check the bytes per Agent of the first size against the footprint budget')
+    parser.add_argument('--scaling', action='store_true',
+                        help='only check how setup and per-day cost grow over --sizes, {} by default'.format(
+                            SCALING_SIZES))
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        failures = check_startup()
+        for message in failures:
+            print('REGRESSION: {}'.format(message))
+        return 1 if failures else 0
+    if args.footprint:
+        failures = check_footprint(args.sizes[0], seed=args.seed)
+        for message in failures:
+            print('REGRESSION: {}'.format(message))
+        return 1 if failures else 0
+    if args.scaling:
+        sizes = args.sizes if args.sizes != parser.get_default('sizes') else SCALING_SIZES
+        failures = check_scaling(sizes, days=args.days, seed=args.seed, backend=args.backend,
+                                 contact_engine=args.contact_engine)
+        for message in failures:
+            print('REGRESSION: {}'.format(message))
+        return 1 if failures else 0
+
+    names = {n: name for name, n in SCENARIOS.items()}
+    results = []
+    for n in args.sizes:
+        if n not in names:
+            parser.error('no scenario with N={}'.format(n))
+        result = run_scenario(names[n], n, args.days, seed=args.seed, trace_memory=not args.no_memory,
+                              backend=args.backend, contact_engine=args.contact_engine)
+        print_result(result)
+        results.append(result)
+
+    output = {'version': BASELINE_VERSION, 'machine': machine_info(), 'results': results}
+    if args.compare:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print('REGRESSION: {}'.format(message))
+        if regressions:
+            return 1
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
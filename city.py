@@ -2,20 +2,33 @@ import math
 import random
 import collections
 import policy
+import kernels
+import contacts
+import render
+from cohorts import Cohorts
+from instrumentation import NULL_INSTRUMENTATION
+from quarantine import QuarantineCenter
+from regions import VoronoiRegions
 import numpy as np
 import itertools
-import scipy
-from scipy import spatial
-import matplotlib.pyplot as plt
-
-import networkx as nx
-import seaborn as sns
+from lazy import lazy_import
 
 from agent import *
 
+# loaded on first use, see lazy.py
+spatial = lazy_import('scipy.spatial')
+geometry = lazy_import('shapely.geometry')
+plt = lazy_import('matplotlib.pyplot')
+nx = lazy_import('networkx')
+sns = lazy_import('seaborn')
+
+# state codes of City.snapshot
+SNAPSHOT_STATES = ['susceptible', 'infected', 'removed', 'quarantined']
+
 
 class City:
-    def __init__(self, name, x, y, n, edge_proximity, gamma, hpolicy, mpolicy, frequencies_dict):
+    def __init__(self, name, x, y, n, edge_proximity, gamma, hpolicy, mpolicy, frequencies_dict, backend='python',
+                 contact_engine='auto', cohorts=None, layout=None):
         '''Defines an agent, which represents a node in the city-level infection network.
 
         :param str name: name of the city
@@ -27,6 +40,13 @@ class City:
         :param str hpolicy: health policy name
         :param list[str, dict] mpolicy: movement policy name
         :param dict frequencies_dict: dictionary of special point frequencies
+        :param str backend: 'python' moves and infects agents one by one; 'numpy', 'numba' or 'auto' use the
+            array kernels in kernels.py, applying the S->I and I->R transitions synchronously
+        :param str contact_engine: how to find contacts, see contacts.get_engine; every engine finds the same edges
+        :param cohorts.Cohorts cohorts: cohort of every agent; by default the cohorts implied by the movement policy,
+            see Cohorts.for_policy
+        :param layouts.Layout layout: initial positions and central locations of the agents from layouts.py; by
+            default they are laid out with Voronoi diagrams, see setup_agent_central_locations
         '''
         self.POLICIES = None
 
@@ -49,18 +69,47 @@ class City:
         self.agents_per_work = frequencies_dict['work']
         self.agents_per_home = frequencies_dict['home']
 
-        self.past_networks = []
-        self.network = None
+        # (quarantined agent numbers, edges_i, edges_j) of every day so far; the networkx graph of a day is only
+        # built when something reads network or past_networks
+        self.past_edges = []
+        self._network = None
         self.edge_proximity = edge_proximity  # proxy for infectivity
         self.policy = policy.Policy(hpolicy, mpolicy)
-
+        self.instrumentation = NULL_INSTRUMENTATION
+        self.backend = backend
+        # contact search is exact with every backend, so the python backend uses the fastest kernels too
+        self.kernels = kernels.get_backend('auto' if backend == 'python' else backend)
+        # coordinates of the central locations of every mode, and the index of every agent's site per mode in
+        # kernels.MODES order
+        self.sites = {mode: np.empty((0, 2)) for mode in kernels.MODES}
+        self.central_sites = np.zeros((n, len(kernels.MODES)), dtype=np.int64)
+        self._central_location_arrays = None
+        self.contact_engine = contacts.get_engine(contact_engine, self.policy.movement_policy_name)
+        if cohorts is None:
+            cohorts = Cohorts.for_policy(n, self.policy.movement_policy_name)
+        if len(cohorts.cohort) != n:
+            raise ValueError('{} has {} agents but {} cohort assignments'.format(name, n, len(cohorts.cohort)))
+        self.cohorts = cohorts
+        # (n, 4) movement probabilities of every agent at the current timestep, in kernels.MODES order
+        self.movement_probabilities = None
+
+        # current and prior position of every agent, indexed by agent number, behind Agent.positionx and friends
+        self.position_xs = np.zeros(n)
+        self.position_ys = np.zeros(n)
+        self.prior_xs = np.zeros(n)
+        self.prior_ys = np.zeros(n)
         self.agents = [Agent(i, self) for i in range(0, self.N)]
 
         self.quarantine_center_location=None
         self.quarantine_threshold = 4
         self.quarantine_rate = 0.05
-        
-        self.setup_agent_central_locations()
+        self.quarantine_capacity = None  # unlimited
+        self.quarantine_center = QuarantineCenter(self)
+
+        if layout is not None:
+            self.apply_layout(layout)
+        else:
+            self.setup_agent_central_locations()
         self.agent_dict = {v.number: v for v in self.agents}
 
     def setup_agent_central_locations(self):
@@ -75,6 +124,8 @@ class City:
         workspaces = self.poisson_point_process(
             intensity=(self.N / self.area) / self.agents_per_work)  # one workplace for every 15 agents
         homes = self.poisson_point_process(intensity=(self.N / self.area) / self.agents_per_home)  #  one home per every 3 agents
+        self.sites = {mode: np.array(points, dtype=float).reshape(-1, 2) for mode, points in
+                      [('market', central_locations), ('transit', transit_hubs), ('work', workspaces), ('home', homes)]}
         #print(len(set(homes)), len(set(central_locations)), len(set(transit_hubs)), len(set(workspaces)))
 
         market_regions, transit_regions, work_regions, home_regions = self.setup_voronoi_diagrams(
@@ -84,10 +135,11 @@ class City:
             homes=homes)
         #print(len(home_regions), len(market_regions), len(transit_regions), len(work_regions))
 
-        used_regions = {'market': [],
-                        'transit': [],
-                        'work': [],
-                        'home': []
+        # number of agents using every region so far
+        used_regions = {'market': collections.Counter(),
+                        'transit': collections.Counter(),
+                        'work': collections.Counter(),
+                        'home': collections.Counter()
                         }
 
         for agent in self.agents:
@@ -98,43 +150,50 @@ class City:
                 (home_regions, homes)
             )
 
-            used_regions['market'].append(agent_used_regions['market'])
-            used_regions['transit'].append(agent_used_regions['transit'])
-            used_regions['work'].append(agent_used_regions['work'])
-            used_regions['home'].append(agent_used_regions['home'])
+            used_regions['market'][agent_used_regions['market']] += 1
+            used_regions['transit'][agent_used_regions['transit']] += 1
+            used_regions['work'][agent_used_regions['work']] += 1
+            used_regions['home'][agent_used_regions['home']] += 1
 
             self.remove_overutilized_regions(agent_used_regions, used_regions,
                                              market_regions, transit_regions,
                                              work_regions, home_regions)
         self.define_quarantine_location()
 
+    def apply_layout(self, layout):
+        """Place the agents and set their central locations from a layout built by layouts.py.
+
+        :param layouts.Layout layout: layout of a city of this size
+        """
+        if (layout.n, layout.width, layout.height) != (self.N, self.width, self.height):
+            raise ValueError('Layout of a {}x{} city of {} agents does not fit {}, a {}x{} city of {}'.format(
+                layout.width, layout.height, layout.n, self.name, self.width, self.height, self.N))
+        self.position_xs[:] = self.prior_xs[:] = layout.xs
+        self.position_ys[:] = self.prior_ys[:] = layout.ys
+        self.sites = dict(layout.sites)
+        self.central_sites = layout.assignment.astype(np.int64)
+        self.central_locations_changed()
+        self.define_quarantine_location()
+
     def remove_overutilized_regions(self, agent_used_regions, used_regions, market_regions,
                                     transit_regions, work_regions, home_regions):
         """If a region has too many points within it, exclude it so that central locations are better distributed."""
 
-        if used_regions['market'].count(agent_used_regions['market']) > self.agents_per_market:
+        if used_regions['market'][agent_used_regions['market']] > self.agents_per_market:
             if market_regions:
-                _region_to_remove = [tup for tup in market_regions if tup[0] == agent_used_regions.get('market')]
-                if _region_to_remove:
-                    market_regions.remove(_region_to_remove[0])
+                market_regions.remove(agent_used_regions['market'])
 
-        if used_regions['transit'].count(agent_used_regions['transit']) > self.agents_per_transit:
+        if used_regions['transit'][agent_used_regions['transit']] > self.agents_per_transit:
             if transit_regions:
-                _region_to_remove = [tup for tup in transit_regions if tup[0] == agent_used_regions.get('transit')]
-                if _region_to_remove:
-                    transit_regions.remove(_region_to_remove[0])
+                transit_regions.remove(agent_used_regions['transit'])
 
-        if used_regions['work'].count(agent_used_regions['work']) > self.agents_per_work:
+        if used_regions['work'][agent_used_regions['work']] > self.agents_per_work:
             if work_regions:
-                _region_to_remove = [tup for tup in work_regions if tup[0] == agent_used_regions.get('work')]
-                if _region_to_remove:
-                    work_regions.remove(_region_to_remove[0])
+                work_regions.remove(agent_used_regions['work'])
 
-        if used_regions['home'].count(agent_used_regions['home']) > self.agents_per_home:
+        if used_regions['home'][agent_used_regions['home']] > self.agents_per_home:
             if home_regions:
-                _region_to_remove = [tup for tup in home_regions if tup[0] == agent_used_regions.get('home')]
-                if _region_to_remove:
-                    home_regions.remove(_region_to_remove[0])
+                home_regions.remove(agent_used_regions['home'])
 
     def setup_voronoi_diagrams(self, markets, transits, workspaces, homes):
         """
@@ -144,7 +203,7 @@ class City:
         :param transits: list of transit points
         :param workspaces: list of work points
         :param homes: list of home points
-        :return: tuple of voronoi regions
+        :return: tuple of VoronoiRegions
         """
         print('Setting up {} fixed locations'.format(self.name))
         modes = ['market', 'transit', 'work', 'home']
@@ -154,7 +213,7 @@ class City:
             try:
                 location_group = list(location_group)
 
-                vor = Voronoi(location_group)
+                vor = spatial.Voronoi(location_group)
                 vertices = vor.vertices
                 regions = vor.regions
                 regions.remove([])
@@ -166,18 +225,18 @@ class City:
                         for pair in polygon_vertices:
                             point_pair = (pair[0], pair[1])
                             point_pairs.append(point_pair)
-                        polygon = Polygon(point_pairs)
+                        polygon = geometry.Polygon(point_pairs)
                         if i > len(location_group):
                             i = i % len(location_group)
                         polygons.append((i, polygon))
                 polygons_dict[modes[index]].extend(polygons)
-            except spatial.qhull.QhullError:
+            except spatial.QhullError:
                 print('Catching Qhull error, defaulting to random network wiring')
                 return None, None, None, None
             except IndexError:
                 print('Catching Index error, defaulting to random network wiring')
                 return None, None, None, None
-        return polygons_dict['market'], polygons_dict['transit'], polygons_dict['work'], polygons_dict['home']
+        return tuple(VoronoiRegions(polygons_dict[mode]) for mode in modes)
 
     def print_width(self):
         print('{} is {} units wide'.format(self.name, self.width))
@@ -193,6 +252,8 @@ class City:
         patient_zero = random.choice(self.agents)
         print('Patient zero in {} is {}'.format(self.name, patient_zero.name))
         patient_zero.transition_state('infected')
+        # patient zero's infection clock first ticks on timestep 0
+        self.quarantine_center.schedule([patient_zero.number], 0)
         for agent in self.agents:
             if agent.state == 'susceptible':
                 self.num_susceptible += 1
@@ -214,8 +275,7 @@ class City:
 
         :rtype dict(any)
         """
-        quarantined = [agent for agent in self.agents if agent.been_quarantined]
-        self.num_quarantined = len(quarantined)
+        self.num_quarantined = self.quarantine_center.count
 
         return {
             'susceptible': self.num_susceptible,
@@ -232,8 +292,12 @@ class City:
     def view_all_policies(self, policies_dict):
         self.POLICIES = policies_dict
 
-    def view_all_policies(self, policies_dict):
-        self.POLICIES = policies_dict
+    def instrument(self, instrumentation=None):
+        '''Report per-phase timings, counters and memory for every timestep.
+
+        :param instrumentation.Instrumentation instrumentation: receives the records; None switches instrumentation off
+        '''
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
 
     def timestep(self, i):
         '''One unit of time in a city.
@@ -245,92 +309,271 @@ class City:
             c) infection spreads with probability gamma
             d) agent trajectories are updated by their distance policy
         '''
-        self.network = nx.Graph()
+        instrumentation = self.instrumentation
+        self._network = None
 
-        # move nodes
-        # generate nodes O(n)
-        for agent in self.agents:
-            # TODO: this should probably be a function (set alternative policy)
-            if 'essential' in self.policy.movement_policy_name:
-                if agent.number % 50 == 0:  # 50 essential workers
-                    agent.set_policy(self.policy, i=i)
+        with instrumentation.phase('policy'):
+            self.set_agent_policies(i)
+
+        # move nodes O(n)
+        with instrumentation.phase('movement'):
+            if i > 0:
+                if self.backend == 'python':
+                    for agent in self.agents:
+                        if not agent.been_quarantined:
+                            agent.move()
                 else:
-                    temp_policy = policy.Policy(self.policy.health_policy, ('preferential_return_stay_at_home',
-                                                self.POLICIES['stay_at_home']))
-                    agent.set_policy(temp_policy, i=i)
+                    self.move_agents([agent for agent, quarantined in zip(self.agents, self.quarantine_center.mask)
+                                      if not quarantined])
+
+        # generate edges O(n) with the contact engine
+        with instrumentation.phase('edges'):
+            edges_i, edges_j = self.find_edge_arrays()
+        instrumentation.count('edges_found', len(edges_i))
+
+        self.past_edges.append((np.nonzero(self.quarantine_center.mask)[0], edges_i, edges_j))
+        if self.backend == 'python':
+            # the sequential transitions look up every agent's neighbors in the graph
+            with instrumentation.phase('graph'):
+                self._network = self.build_network(*self.past_edges[-1])
+
+        with instrumentation.phase('infection'):
+            admitted = self.quarantine_center.admit_due(i)
+            instrumentation.count('quarantines', len(admitted))
+            if self.backend == 'python':
+                beta = self.transition_agents_sequentially(i)
             else:
-                agent.set_policy(self.policy, i=i)
-            if i > 0:
-                if not agent.been_quarantined:
-                    agent.move()
-            self.network.add_node(agent)
+                beta = self.transition_agents(i, edges_i, edges_j)
+
+        with instrumentation.phase('modes'):
+            homes = [agent for agent in self.agents if agent.mode == 'home']
+            len_homes = len(homes)
+            works = [agent for agent in self.agents if agent.mode == 'work']
+            len_works = len(works)
+            transits = [agent for agent in self.agents if agent.mode == 'transit']
+            len_transits = len(transits)
+            markets = [agent for agent in self.agents if agent.mode == 'market']
+            len_markets = len(markets)
+            len_quarantined = self.quarantine_center.count
 
-        # generate edges O(n^2)
-        potential_edges = self.find_edge_candidates()
+        if i > 0:
+            print('{} stayed home, {} went to work, {} went on the bus, {} went to the market {} are in quarantine'.format(
+                len_homes, len_works, len_transits, len_markets,len_quarantined
 
-        # add O(|E)
-        for edge_number_tuple in potential_edges:
-            self.network.add_edge(self.agents[edge_number_tuple[0]], self.agents[edge_number_tuple[1]])
+            ))
+        instrumentation.emit(self.name, i)
+        return beta
 
-        self.past_networks.append(self.network)
+    @property
+    def network(self):
+        """The networkx proximity graph of the current day, built from its edge arrays on first use."""
+        if self._network is None and self.past_edges:
+            self._network = self.build_network(*self.past_edges[-1])
+        return self._network
+
+    @property
+    def past_networks(self):
+        """The networkx proximity graph of every day so far, built on every use."""
+        return [self.build_network(*day_edges) for day_edges in self.past_edges]
+
+    def build_network(self, quarantined, edges_i, edges_j):
+        """A networkx graph of the agents joined by the given edges. O(n + |E|)
+
+        :param np.ndarray quarantined: numbers of the agents that are out of the network altogether
+        :param np.ndarray edges_i: lower agent number of every edge
+        :param np.ndarray edges_j: higher agent number of every edge
+        """
+        absent = set(quarantined.tolist())
+        network = nx.Graph()
+        network.add_nodes_from(agent for agent in self.agents if agent.number not in absent)
+        network.add_edges_from(zip([self.agents[k] for k in edges_i.tolist()],
+                                   [self.agents[k] for k in edges_j.tolist()]))
+        return network
+
+    def __getstate__(self):
+        # the graph is a cache of the current day's edges, copies and workers rebuild it if they need it
+        state = self.__dict__.copy()
+        state['_network'] = None
+        return state
+
+    def set_agent_policies(self, i):
+        """Give every agent its cohort's policy and movement probabilities for timestep i.
 
+        :param int i: timestep
+        """
+        cohort_policies = self.cohorts.policies(self)
+        self.movement_probabilities = self.cohorts.movement_probabilities(cohort_policies, i)[self.cohorts.cohort]
+        for agent, k in zip(self.agents, self.cohorts.cohort.tolist()):
+            agent.policy = cohort_policies[k]
+
+    def transition_agents_sequentially(self, i):
+        """Infect and recover agents one at a time, each seeing the transitions of the agents before it.
+
+        Newly infected agents start counting timesteps_infected on the day they are infected.
+
+        :param int i: timestep
+        :returns: sum of the susceptible agents' infection rates
+        """
         # infect O(n * |neighbor_set|)
         si_transition_rates = []
+        newly_infected = []
 
         for agent in self.agents:
             if not agent.has_transitioned_this_timestep():
                 if agent.is_susceptible():
                     si_transition_rates.append(self.handle_infection(agent))
+                    if agent.is_infected():
+                        newly_infected.append(agent.number)
                 if agent.is_infected():
                     agent.timesteps_infected += 1
-                    quarantine_instance = random.random()
-                    if not agent.been_quarantined:
-                        if agent.timesteps_infected >= self.quarantine_threshold:
-                            if quarantine_instance <= self.quarantine_rate:
-                                self.quarantine(agent)
                     self.i_r_transition(agent)
 
-        beta = sum(si_transition_rates)
+        self.quarantine_center.schedule(newly_infected, i)
+        return sum(si_transition_rates)
 
-        homes = [agent for agent in self.agents if agent.mode == 'home']
-        len_homes = len(homes)
-        works = [agent for agent in self.agents if agent.mode == 'work']
-        len_works = len(works)
-        transits = [agent for agent in self.agents if agent.mode == 'transit']
-        len_transits = len(transits)
-        markets = [agent for agent in self.agents if agent.mode == 'market']
-        len_markets = len(markets)
-        quarantined = [agent for agent in self.agents if agent.been_quarantined]
-        len_quarantined = len(quarantined)
+    def transition_agents(self, i, edges_i, edges_j):
+        """Infect and recover all agents at once from the states at the start of the infection phase.
 
-        if i > 0:
-            print('{} stayed home, {} went to work, {} went on the bus, {} went to the market {} are in quarantine'.format(
-                len_homes, len_works, len_transits, len_markets,len_quarantined
+        :param int i: timestep
+        :param np.ndarray edges_i: lower agent number of every edge
+        :param np.ndarray edges_j: higher agent number of every edge
+        :returns: sum of the susceptible agents' infection rates
+        """
+        agents = self.agents
+        n = self.N
+        susceptible = np.fromiter((agent.susceptible for agent in agents), dtype=bool, count=n)
+        infected = np.fromiter((agent.infected for agent in agents), dtype=bool, count=n)
+        eligible = np.fromiter((not agent.transitioned_this_timestep for agent in agents), dtype=bool, count=n)
+        timesteps_infected = np.fromiter((agent.timesteps_infected for agent in agents), dtype=np.int64, count=n)
+
+        if self.cohorts.uniform:
+            rates = self.kernels.infection_rates(n, edges_i, edges_j, infected)
+        else:
+            rates = self.kernels.infection_rates(n, edges_i, edges_j, infected, self.cohorts.agent_susceptibility(),
+                                                 self.cohorts.agent_infectiousness())
+        newly_infected, recovered, timesteps_infected = self.kernels.transitions(
+            rates, np.random.random(n), susceptible, infected, eligible, timesteps_infected, 1 / self.gamma)
+        infection_clocks = (infected | newly_infected) & eligible
 
-            ))
-        return beta
+        msg = 'susceptible {} went to {} and became infected'
+        for k in np.nonzero(newly_infected)[0].tolist():
+            agent = agents[k]
+            print(msg.format(agent.name, agent.mode))
+            agent.transition_state('infected')
+            self.instrumentation.count('infections')
+            self.num_susceptible -= 1
+            self.num_infected += 1
+            agent.transitioned_this_timestep = True
+        for k in np.nonzero(infection_clocks)[0].tolist():
+            agents[k].timesteps_infected = int(timesteps_infected[k])
+        for k in np.nonzero(recovered)[0].tolist():
+            self.i_r_transition(agents[k])
+        self.quarantine_center.schedule(np.nonzero(newly_infected)[0].tolist(), i)
+
+        return float(rates[susceptible & eligible].sum())
+
+    def move_agents(self, movers):
+        """Move agents with the array kernels.
+
+        Agents on a preferential return policy move together, any others move one by one.
+
+        :param list[agent.Agent] movers: agents to move
+        """
+        returners = []
+        for agent in movers:
+            if 'preferential_return' in agent.policy.movement_policy_name:
+                returners.append(agent)
+            else:
+                agent.move()
+        if not returners:
+            return
+
+        n = len(returners)
+        numbers = np.fromiter((agent.number for agent in returners), dtype=np.int64, count=n)
+        thresholds = np.cumsum(self.movement_probabilities[numbers, :3], axis=1)
+        site_xs, site_ys = self.central_location_arrays()
+        modes, xs, ys = self.kernels.preferential_return(
+            np.random.random(n), thresholds, site_xs[numbers], site_ys[numbers], np.random.normal(-0.5, 0.5, (n, 2)))
+        xs, ys, reverse = self.kernels.reflect(xs, ys, self.width, self.height, returners[0].velocity)
+
+        self.prior_xs[numbers] = self.position_xs[numbers]
+        self.prior_ys[numbers] = self.position_ys[numbers]
+        self.position_xs[numbers] = xs
+        self.position_ys[numbers] = ys
+        for agent, mode, reverse_agent in zip(returners, modes.tolist(), reverse.tolist()):
+            agent.mode = kernels.MODES[mode]
+            if reverse_agent:
+                agent.reverse_vector()
+            agent.transitioned_this_timestep = False
+            agent.deactivate_health_policy()
+
+    def central_location_arrays(self):
+        """Coordinates of every agent's central locations, one column per mode in kernels.MODES order.
+
+        :returns: tuple of (n, 4) arrays of x and y coordinates indexed by agent number
+        """
+        if self._central_location_arrays is None:
+            site_xs = np.empty((self.N, len(kernels.MODES)))
+            site_ys = np.empty((self.N, len(kernels.MODES)))
+            for code, mode in enumerate(kernels.MODES):
+                site_xs[:, code] = self.sites[mode][self.central_sites[:, code], 0]
+                site_ys[:, code] = self.sites[mode][self.central_sites[:, code], 1]
+            self._central_location_arrays = (site_xs, site_ys)
+        return self._central_location_arrays
+
+    def central_location_sites(self):
+        """Site id of every agent's central locations; agents share an id when they share the location.
+
+        :returns: (n, 4) int array indexed by agent number, one column per mode in kernels.MODES order
+        """
+        return self.central_sites
+
+    def central_location(self, number, mode):
+        """(x, y) of an agent's central location of a mode."""
+        x, y = self.sites[mode][self.central_sites[number, kernels.MODE_CODES[mode]]].tolist()
+        return x, y
+
+    def set_central_location(self, number, mode, x, y):
+        """Make (x, y) an agent's central location of a mode, adding a site there if there is none."""
+        sites = self.sites[mode]
+        existing = np.nonzero((sites[:, 0] == x) & (sites[:, 1] == y))[0]
+        if len(existing):
+            site = int(existing[0])
+        else:
+            site = len(sites)
+            self.sites[mode] = np.vstack((sites, [[x, y]]))
+        self.central_sites[number, kernels.MODE_CODES[mode]] = site
+        self.central_locations_changed()
+
+    def central_locations_changed(self):
+        """Call after changing sites or central_sites."""
+        self._central_location_arrays = None
+
+    def positions(self):
+        """Current agent positions.
+
+        :returns: tuple of x and y coordinate arrays indexed by agent number
+        """
+        return self.position_xs.copy(), self.position_ys.copy()
 
     def find_edge_candidates(self):
         """See if a node is close enough to another node to count as an edge.
 
-        Update the health policy and replace the node in self.agents with the modified node.
-
-        :param int i: timestep
+        :returns: list of (agent number, agent number) tuples, lower number first, in sorted order
         """
-        potential_edges = []
+        edges_i, edges_j = self.find_edge_arrays()
+        return list(zip(edges_i.tolist(), edges_j.tolist()))
 
-        for pair in list(itertools.combinations(self.agents, r=2)):
-            d = np.sqrt(
-                # euclidean distance
-                ((pair[0].positionx - pair[1].positionx) ** 2) + ((pair[0].positiony - pair[1].positiony) ** 2)
-            )
-            agent_a = pair[0]
-            agent_b = pair[1]
-            if d <= self.edge_proximity:
-                # we know you would be repulsed, so we add you to a data structure here
-                potential_edges.append((agent_a.number, agent_b.number))
+    def find_edge_arrays(self):
+        """Find all pairs of agents within edge_proximity of each other with the city's contact engine.
 
-        return potential_edges
+        :returns: tuple of arrays of the lower and higher agent number of every edge, sorted
+        """
+        # quarantined agents have no contacts, leave them out of the search
+        present = np.nonzero(~self.quarantine_center.mask)[0]
+        edges_i, edges_j, candidate_pairs = self.contact_engine.find_pairs(self, present)
+        self.instrumentation.count('candidate_pairs', candidate_pairs)
+        return edges_i, edges_j
 
     def handle_infection(self, agent):
         """What to do when an agent is susceptible.
@@ -346,10 +589,17 @@ class City:
         if len(adjacency_list) > 0:
             infected_neighbors = [neighbor for neighbor in adjacency_list if neighbor.is_infected()]
             if len(infected_neighbors) > 0:
-                si_transition_rate = len(infected_neighbors) / len(adjacency_list)
+                if self.cohorts.uniform:
+                    si_transition_rate = len(infected_neighbors) / len(adjacency_list)
+                else:
+                    infectiousness = self.cohorts.agent_infectiousness()
+                    si_transition_rate = float(self.cohorts.agent_susceptibility()[agent.number] *
+                                               sum(infectiousness[neighbor.number] for neighbor in infected_neighbors) /
+                                               len(adjacency_list))
                 if random.random() < si_transition_rate:
                     print(msg.format(agent.name, agent.mode))
                     agent.transition_state('infected')
+                    self.instrumentation.count('infections')
 
                     self.num_susceptible -= 1
                     self.num_infected += 1
@@ -361,48 +611,36 @@ class City:
         if agent.timesteps_infected >= (1 / self.gamma):
             print('Transitioning {} to removed'.format(agent.name))
             agent.transition_state('removed')
+            self.instrumentation.count('recoveries')
             self.num_infected -= 1
             self.num_removed += 1
             agent.transitioned_this_timestep = True
             agent.timesteps_infected = 0
-            if agent.been_quarantined:
-                agent.not_quarantined()
-                agent.send_to_home()
+            self.quarantine_center.release(agent)
 
-    @staticmethod
-    def quarantine(agent):
+    def quarantine(self, agent):
         '''Quarantining an agent and sending the agent to the Q.C.'''
         print('Quarantining {} to Quarantine Center'.format(agent.name))
-        agent.has_been_quarantined()
-        agent.send_to_quarantine_center()
+        self.quarantine_center.admit(agent)
+
+    def snapshot(self, i):
+        """Positions, states and modes of every agent, for rendering and analysis after the run.
+
+        :param int i: timestep
+        :returns: dict with the day, float32 x and y arrays, int8 state codes (see SNAPSHOT_STATES; infected agents
+            in quarantine are 'quarantined') and int8 mode codes (see kernels.MODES, -1 before the first move)
+        """
+        xs, ys = self.positions()
+        states = np.fromiter((0 if agent.susceptible else 1 if agent.infected else 2 for agent in self.agents),
+                             dtype=np.int8, count=self.N)
+        states[(states == 1) & self.quarantine_center.mask] = 3
+        modes = np.fromiter((kernels.MODE_CODES.get(agent.mode, -1) for agent in self.agents), dtype=np.int8,
+                            count=self.N)
+        return {'day': i, 'xs': xs.astype(np.float32), 'ys': ys.astype(np.float32), 'states': states, 'modes': modes}
 
     def plot_scatter(self, j):
         ''' For visualising the spread of disease as it moves through the city'''
-        state_index = 0
-        colors = []
-        for agent in self.agents:
-            if agent.state == 'susceptible':
-                colors.append("blue")
-            if agent.state == 'infected':
-                if agent.been_quarantined:
-                    colors.append("black")
-                else:
-                    colors.append("red")
-            if agent.state == 'removed':
-                colors.append("green")
-
-        sns.set_style("darkgrid")
-        plt.ioff()
-        fig = plt.figure()
-        for agent in self.agents:
-            plt.scatter(agent.positionx,
-                        agent.positiony,
-                        c=colors[state_index],
-                        alpha=0.5)
-            state_index += 1
-        scatterfile = "plots/{}{}.png".format(self.name, j)
-        plt.savefig(scatterfile, dpi=300)
-        plt.close(fig)
+        render.render_frame(self.snapshot(j), "plots/{}{}.png".format(self.name, j), dpi=300)
 
     def change_proximity(self, epsilon):
         '''Change proxmity radius to simulate Social Distancing.
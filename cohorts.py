@@ -0,0 +1,110 @@
+"""Population cohorts: groups of agents with their own movement policy, susceptibility and infectiousness.
+
+Every agent belongs to one cohort, stored as an array of cohort indices by agent number. Movement probabilities,
+susceptibility and infectiousness are tables with one row per cohort that are expanded to all agents by indexing
+with that array, so the cost per agent does not depend on the number of cohorts.
+"""
+import numpy as np
+
+import kernels
+import policy
+
+# one in this many agents of an essential worker city keeps following its movement policy
+ESSENTIAL_WORKER_PERIOD = 50
+
+
+class Cohorts:
+    def __init__(self, names, cohort, susceptibility=None, infectiousness=None, intents=None):
+        '''Assigns every agent of a city to a cohort.
+
+        :param list[str] names: cohort names
+        :param np.ndarray cohort: index into names of every agent, by agent number
+        :param list[float] susceptibility: relative susceptibility of each cohort, 1 by default
+        :param list[float] infectiousness: relative infectiousness of each cohort, 1 by default
+        :param list[str] intents: key of City.POLICIES whose schedule each cohort follows, None to follow the city's
+            own movement policy; by default every cohort follows the city's policy
+        '''
+        k = len(names)
+        self.names = list(names)
+        self.cohort = np.asarray(cohort, dtype=np.int64)
+        if len(self.cohort) and (self.cohort.min() < 0 or self.cohort.max() >= k):
+            raise ValueError('Cohort indices must lie in [0, {})'.format(k))
+        self.susceptibility = np.ones(k) if susceptibility is None else np.asarray(susceptibility, dtype=float)
+        self.infectiousness = np.ones(k) if infectiousness is None else np.asarray(infectiousness, dtype=float)
+        self.intents = [None] * k if intents is None else list(intents)
+        for table in (self.susceptibility, self.infectiousness, self.intents):
+            if len(table) != k:
+                raise ValueError('Expected one value per cohort for the {} cohorts {}'.format(k, self.names))
+        # with every weight 1 the infection rates are those of a homogeneous population
+        self.uniform = bool((self.susceptibility == 1).all() and (self.infectiousness == 1).all())
+        self._agent_susceptibility = None
+        self._agent_infectiousness = None
+
+    @classmethod
+    def homogeneous(cls, n):
+        """One cohort of n agents following the city's movement policy."""
+        return cls(['general'], np.zeros(n, dtype=np.int64))
+
+    @classmethod
+    def essential_workers(cls, n):
+        """Every ESSENTIAL_WORKER_PERIOD-th agent keeps following the city's policy, the others stay at home."""
+        cohort = (np.arange(n) % ESSENTIAL_WORKER_PERIOD != 0).astype(np.int64)
+        return cls(['essential', 'stay_at_home'], cohort, intents=[None, 'stay_at_home'])
+
+    @classmethod
+    def from_shares(cls, n, specs):
+        """Draw each of n agents' cohort at random in proportion to the cohorts' shares.
+
+        :param list[dict] specs: one dict per cohort with name and share, and optionally susceptibility,
+            infectiousness and intent
+        """
+        shares = np.array([spec['share'] for spec in specs], dtype=float)
+        if (shares < 0).any() or shares.sum() <= 0:
+            raise ValueError('Cohort shares must be non-negative and not all zero')
+        cohort = np.random.choice(len(specs), size=n, p=shares / shares.sum())
+        return cls([spec['name'] for spec in specs], cohort,
+                   susceptibility=[spec.get('susceptibility', 1.0) for spec in specs],
+                   infectiousness=[spec.get('infectiousness', 1.0) for spec in specs],
+                   intents=[spec.get('intent') for spec in specs])
+
+    @classmethod
+    def for_policy(cls, n, movement_policy_name):
+        """The cohorts implied by a movement policy name: essential workers for the essential policies."""
+        if 'essential' in movement_policy_name:
+            return cls.essential_workers(n)
+        return cls.homogeneous(n)
+
+    def __len__(self):
+        return len(self.names)
+
+    def counts(self):
+        """Number of agents in every cohort."""
+        return np.bincount(self.cohort, minlength=len(self))
+
+    def agent_susceptibility(self):
+        """Susceptibility of every agent, by agent number."""
+        if self._agent_susceptibility is None:
+            self._agent_susceptibility = self.susceptibility[self.cohort]
+        return self._agent_susceptibility
+
+    def agent_infectiousness(self):
+        """Infectiousness of every agent, by agent number."""
+        if self._agent_infectiousness is None:
+            self._agent_infectiousness = self.infectiousness[self.cohort]
+        return self._agent_infectiousness
+
+    def policies(self, city):
+        """The Policy each cohort moves by; cohorts with an intent return to their central locations on its schedule."""
+        health_policy = city.policy.health_policy
+        return [city.policy if intent is None else
+                policy.Policy(health_policy, ('preferential_return_{}'.format(intent), city.POLICIES[intent]))
+                for intent in self.intents]
+
+    def movement_probabilities(self, policies, i):
+        """Movement probabilities of every cohort at timestep i.
+
+        :param list[policy.Policy] policies: policy of every cohort, from policies
+        :returns: (cohorts, 4) array in kernels.MODES order, NaN for policies without location probabilities
+        """
+        return np.array([[cohort_policy.get_probability(i, mode) if cohort_policy.movement_probabilities else np.nan
+                          for mode in kernels.MODES] for cohort_policy in policies], dtype=float)
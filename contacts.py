@@ -0,0 +1,268 @@
+"""Contact engines: strategies for finding every pair of agents within a city's edge_proximity.
+
+Every engine returns exactly the pairs an all-pairs scan would, as sorted arrays of agent numbers.
+"""
+import numpy as np
+
+import kernels
+
+
+class CellListContacts:
+    name = 'cell_list'
+
+    def find_pairs(self, city, present):
+        """Find all pairs of present agents within edge_proximity of each other.
+
+        :param city.City city: city whose agents to pair up
+        :param np.ndarray present: increasing numbers of the agents taking part
+        :returns: tuple of lower agent numbers, higher agent numbers and the number of candidate pairs tested
+        """
+        xs, ys = city.positions()
+        edges_i, edges_j, tested = city.kernels.cell_list_pairs(xs[present], ys[present], city.edge_proximity)
+        # present is increasing, so mapping back keeps the pairs ordered
+        return present[edges_i], present[edges_j], tested
+
+
+class CoOccupancyContacts:
+    name = 'co_occupancy'
+
+    def __init__(self, max_group_scan=256):
+        '''Finds contacts among agents sharing a central location.
+
+        Under preferential return agents gather around a few central locations, so almost every contact is
+        between agents in the same mode at the same site. Agents are grouped by (mode, site); groups whose
+        bounding boxes, grown by edge_proximity, overlap are merged, and pairs are only sought within the
+        merged groups. Small groups compare all their pairs directly, large ones fall back to a cell list.
+        Bounding boxes come from the actual positions, so the edge set is exact whatever the jitter.
+
+        :param int max_group_scan: largest merged group whose pairs are all compared directly
+        '''
+        self.max_group_scan = max_group_scan
+
+    def find_pairs(self, city, present):
+        xs, ys = city.positions()
+        xs = xs[present]
+        ys = ys[present]
+        n = len(present)
+        empty = np.empty(0, dtype=np.int64)
+        if n < 2:
+            return empty, empty, 0
+        radius = city.edge_proximity
+
+        groups = self.site_groups(city, present)
+        components = self.merge_overlapping(groups, xs, ys, radius)
+
+        order = np.argsort(components, kind='stable')
+        _, starts, sizes = np.unique(components[order], return_index=True, return_counts=True)
+        found_i = [empty]
+        found_j = [empty]
+        tested = 0
+
+        small = sizes <= self.max_group_scan
+        for size in np.unique(sizes[small & (sizes > 1)]).tolist():
+            # compare all pairs within every merged group of this size at once
+            upper_a, upper_b = np.triu_indices(size, 1)
+            group_starts = starts[small & (sizes == size)]
+            a = order[(group_starts[:, None] + upper_a[None, :]).reshape(-1)]
+            b = order[(group_starts[:, None] + upper_b[None, :]).reshape(-1)]
+            tested += len(a)
+            d = np.sqrt(((xs[a] - xs[b]) ** 2) + ((ys[a] - ys[b]) ** 2))
+            close = d <= radius
+            found_i.append(a[close])
+            found_j.append(b[close])
+
+        large = np.isin(components, np.unique(components[order][starts[~small]]))
+        if large.any():
+            members = np.nonzero(large)[0]
+            a, b, large_tested = city.kernels.cell_list_pairs(xs[members], ys[members], radius,
+                                                              groups=components[members])
+            tested += large_tested
+            found_i.append(members[a])
+            found_j.append(members[b])
+
+        a = np.concatenate(found_i)
+        b = np.concatenate(found_j)
+        edges_i = np.minimum(a, b)
+        edges_j = np.maximum(a, b)
+        order = np.lexsort((edges_j, edges_i))
+        return present[edges_i[order]], present[edges_j[order]], tested
+
+    @staticmethod
+    def site_groups(city, present):
+        """Group id of every present agent, shared by agents in the same mode at the same central location.
+
+        Agents that have not chosen a mode yet each get a group of their own.
+        """
+        sites = city.central_location_sites()
+        modes = np.fromiter((kernels.MODE_CODES.get(city.agents[k].mode, -1) for k in present.tolist()),
+                            dtype=np.int64, count=len(present))
+        has_mode = modes >= 0
+        site = sites[present, np.where(has_mode, modes, 0)]
+        keys = np.where(has_mode, modes * (int(sites.max()) + 1) + site, -1 - np.arange(len(present)))
+        _, groups = np.unique(keys, return_inverse=True)
+        return groups
+
+    @staticmethod
+    def merge_overlapping(groups, xs, ys, radius):
+        """Merge groups whose bounding boxes come within radius of each other.
+
+        :returns: merged group id of every agent
+        """
+        n_groups = int(groups.max()) + 1
+        x_min = np.full(n_groups, np.inf)
+        x_max = np.full(n_groups, -np.inf)
+        y_min = np.full(n_groups, np.inf)
+        y_max = np.full(n_groups, -np.inf)
+        np.minimum.at(x_min, groups, xs)
+        np.maximum.at(x_max, groups, xs)
+        np.minimum.at(y_min, groups, ys)
+        np.maximum.at(y_max, groups, ys)
+
+        # sweep along x: the groups that may touch group g start between its left edge and its right edge + radius
+        by_x_min = np.argsort(x_min, kind='stable')
+        sorted_x_min = x_min[by_x_min]
+        first = np.arange(n_groups) + 1
+        last = np.searchsorted(sorted_x_min, x_max[by_x_min] + radius, side='right')
+        counts = np.maximum(last - first, 0)
+        g = np.repeat(np.arange(n_groups), counts)
+        h = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+        g = by_x_min[g]
+        h = by_x_min[h]
+        touching = (y_min[h] <= y_max[g] + radius) & (y_min[g] <= y_max[h] + radius)
+        g = g[touching]
+        h = h[touching]
+
+        # connected components by propagating the smallest label along the touching pairs
+        labels = np.arange(n_groups)
+        while len(g):
+            merged = np.minimum(labels[g], labels[h])
+            if np.array_equal(merged, labels[g]) and np.array_equal(merged, labels[h]):
+                break
+            np.minimum.at(labels, g, merged)
+            np.minimum.at(labels, h, merged)
+            labels = labels[labels]
+        return labels[groups]
+
+
+class VerletListContacts:
+    name = 'verlet_list'
+
+    def __init__(self, rebuild_every=4, max_movers=32):
+        '''Finds contacts by filtering a cached list of candidate pairs that is rebuilt only now and then.
+
+        Under a random walk agents move at most about velocity per step, so the pairs that can come within
+        edge_proximity over the next k steps are those within edge_proximity + 2 * velocity * k now. That list is
+        built with a cell list and then filtered by the current distances every day. Agents that have moved more
+        than velocity * k since the list was built, e.g. because they bounced off the city's edge or came back from
+        quarantine, are paired with every present agent directly. The list is rebuilt after k steps, when
+        edge_proximity changes or when there are more than max_movers such agents, so the edge set is exact.
+
+        :param int rebuild_every: k, the number of steps a candidate list lasts
+        :param int max_movers: most agents beyond the skin to pair up directly before rebuilding instead
+        '''
+        self.rebuild_every = rebuild_every
+        self.max_movers = max_movers
+        self.rebuilds = 0
+        self._radius = None
+        self._skin = None
+        self._steps = 0
+        self._xs = None
+        self._ys = None
+        self._candidates_i = None
+        self._candidates_j = None
+
+    def find_pairs(self, city, present):
+        xs, ys = city.positions()
+        radius = city.edge_proximity
+        empty = np.empty(0, dtype=np.int64)
+        if len(present) < 2:
+            return empty, empty, 0
+        tested = 0
+        movers = None
+        if not self._stale(city, radius):
+            movers = self.movers(xs, ys, present)
+            if len(movers) > self.max_movers:
+                movers = None
+        if movers is None:
+            tested += self._rebuild(city, xs, ys, radius)
+            movers = empty
+        self._steps += 1
+
+        # pairs of agents within the skin come from the candidate list
+        stayed = np.zeros(city.N, dtype=bool)
+        stayed[present] = True
+        stayed[movers] = False
+        a = self._candidates_i
+        b = self._candidates_j
+        keep = stayed[a] & stayed[b]
+        a = a[keep]
+        b = b[keep]
+        tested += len(a)
+        d = np.sqrt(((xs[a] - xs[b]) ** 2) + ((ys[a] - ys[b]) ** 2))
+        close = d <= radius
+        edges_i = a[close]
+        edges_j = b[close]
+        if not len(movers):
+            # the candidates are sorted, and filtering keeps them so
+            return edges_i, edges_j, tested
+
+        # pairs with a mover, each pair of movers once
+        a = np.repeat(movers, len(present))
+        b = np.tile(present, len(movers))
+        keep = stayed[b] | (a < b)
+        a = a[keep]
+        b = b[keep]
+        tested += len(a)
+        d = np.sqrt(((xs[a] - xs[b]) ** 2) + ((ys[a] - ys[b]) ** 2))
+        close = d <= radius
+        edges_i = np.concatenate((edges_i, np.minimum(a[close], b[close])))
+        edges_j = np.concatenate((edges_j, np.maximum(a[close], b[close])))
+        order = np.lexsort((edges_j, edges_i))
+        return edges_i[order], edges_j[order], tested
+
+    def movers(self, xs, ys, present):
+        """The present agents that have moved too far since the candidate list was built for it to hold their pairs."""
+        displacement = np.sqrt(((xs[present] - self._xs[present]) ** 2) + ((ys[present] - self._ys[present]) ** 2))
+        # the list holds every pair whose distance can have shrunk by less than the skin since it was built;
+        # the margin covers rounding in the distances
+        return present[2 * displacement >= self._skin * (1 - 1e-9)]
+
+    def _stale(self, city, radius):
+        return (self._xs is None or len(self._xs) != city.N or radius != self._radius or
+                self._steps >= self.rebuild_every)
+
+    def _rebuild(self, city, xs, ys, radius):
+        velocity = max(agent.velocity for agent in city.agents)
+        self._skin = 2 * velocity * self.rebuild_every
+        self._radius = radius
+        self._xs = xs
+        self._ys = ys
+        self._steps = 0
+        self.rebuilds += 1
+        self._candidates_i, self._candidates_j, tested = city.kernels.cell_list_pairs(xs, ys, radius + self._skin)
+        return tested
+
+
+ENGINES = {
+    CellListContacts.name: CellListContacts,
+    CoOccupancyContacts.name: CoOccupancyContacts,
+    VerletListContacts.name: VerletListContacts,
+}
+
+
+def get_engine(name, movement_policy_name):
+    """Create a contact engine.
+
+    :param str name: engine name, or 'auto' to pick one suited to the movement policy
+    :param str movement_policy_name: the city's movement policy
+    """
+    if name == 'auto':
+        if 'preferential_return' in movement_policy_name:
+            name = CoOccupancyContacts.name
+        elif movement_policy_name == '2d_random_walk':
+            name = VerletListContacts.name
+        else:
+            name = CellListContacts.name
+    if name not in ENGINES:
+        raise ValueError('Unknown contact engine {}, choose from {}'.format(name, sorted(ENGINES)))
+    return ENGINES[name]()
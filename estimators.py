@@ -0,0 +1,95 @@
+"""Streaming epidemic estimators, updated in O(1) per day from a city's state counts."""
+import collections
+import math
+
+
+class EpidemicEstimators:
+    def __init__(self, gamma, window=7):
+        '''Tracks the infection peak, doubling time and effective reproduction number of one city.
+
+        Rt over the last window days is the number of new infections divided by the infectious agent-days times
+        the recovery rate, so that Rt = beta * S / (gamma * N) in the SIR limit. The growth rate and doubling time
+        are those of the cumulative number of infections over the window.
+
+        :param float gamma: recovery rate, i.e. one over the infection length in days
+        :param int window: length of the sliding window in days
+        '''
+        self.gamma = gamma
+        self.window = window
+        self.days = 0
+        self.i_max = 0
+        self.day_of_peak = None
+        self.ro = None
+        self.final_size = 0
+        self._new_infections = collections.deque(maxlen=window)
+        self._infected = collections.deque(maxlen=window)
+        self._cumulative = collections.deque(maxlen=window + 1)
+        self._new_infections_sum = 0
+        self._infected_sum = 0
+
+    def update(self, state_dict, beta=None):
+        """Take in one day.
+
+        :param dict state_dict: the day's City.get_states
+        :param float beta: the day's beta, as passed to CityGraph.set_beta
+        """
+        infected = state_dict['infected']
+        cumulative = state_dict['total_IR']
+        new_infections = max(cumulative - self._cumulative[-1], 0) if self._cumulative else 0
+
+        if len(self._new_infections) == self.window:
+            self._new_infections_sum -= self._new_infections[0]
+            self._infected_sum -= self._infected[0]
+        self._new_infections.append(new_infections)
+        self._infected.append(infected)
+        self._cumulative.append(cumulative)
+        self._new_infections_sum += new_infections
+        self._infected_sum += infected
+
+        if infected > self.i_max or self.day_of_peak is None:
+            self.i_max = infected
+            self.day_of_peak = self.days
+        if beta is not None:
+            self.ro = beta / self.gamma
+        self.final_size = cumulative
+        self.days += 1
+
+    @property
+    def rt(self):
+        """Effective reproduction number over the window, None before anyone has been infectious."""
+        if self._infected_sum == 0:
+            return 0.0 if self.final_size else None
+        return self._new_infections_sum / (self.gamma * self._infected_sum)
+
+    @property
+    def growth_rate(self):
+        """Daily exponential growth rate of the cumulative infections over the window, None until a full window."""
+        if len(self._cumulative) <= self.window or self._cumulative[0] == 0:
+            return None
+        return math.log(self._cumulative[-1] / self._cumulative[0]) / self.window
+
+    @property
+    def doubling_time(self):
+        """Days for the cumulative infections to double at the current growth rate, None if they are not growing."""
+        growth_rate = self.growth_rate
+        if growth_rate is None or growth_rate <= 0:
+            return None
+        return math.log(2) / growth_rate
+
+    def settled(self, rt_threshold):
+        """Whether the peak is at least a window behind and Rt has fallen below rt_threshold."""
+        rt = self.rt
+        return (self.day_of_peak is not None and self.days - 1 - self.day_of_peak >= self.window and
+                rt is not None and rt < rt_threshold)
+
+    def summary(self):
+        return {
+            'days': self.days,
+            'i_max': self.i_max,
+            'day_of_peak': self.day_of_peak,
+            'final_size': self.final_size,
+            'ro': self.ro,
+            'rt': self.rt,
+            'growth_rate': self.growth_rate,
+            'doubling_time': self.doubling_time,
+        }
@@ -0,0 +1,106 @@
+import collections
+import contextlib
+import json
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+class Instrumentation:
+    def __init__(self, sink=None, trace_memory=False):
+        '''Per-day phase timers, counters and memory snapshots for City.timestep.
+
+        Attach to a city with City.instrument. At the end of every timestep a record is passed to the sink.
+
+        :param callable sink: called with one dict per city per day, e.g. list.append or a JsonLinesSink
+        :param bool trace_memory: start tracemalloc so records carry current and peak traced memory
+        '''
+        self.sink = sink
+        self.trace_memory = trace_memory
+        self.context = {}
+        self.phase_times = collections.defaultdict(float)
+        self.counters = collections.Counter()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_times[name] += time.perf_counter() - start
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def memory_snapshot(self):
+        snapshot = {}
+        if tracemalloc.is_tracing():
+            snapshot['traced_current'], snapshot['traced_peak'] = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        if resource is not None:
+            snapshot['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return snapshot
+
+    def emit(self, city_name, i):
+        '''Send the record for timestep i of a city to the sink and start a new one.'''
+        record = dict(self.context)
+        record.update({
+            'city': city_name,
+            'day': i,
+            'phases': dict(self.phase_times),
+            'counters': dict(self.counters),
+            'memory': self.memory_snapshot(),
+        })
+        self.phase_times.clear()
+        self.counters.clear()
+        if self.sink is not None:
+            self.sink(record)
+        return record
+
+
+class NullInstrumentation:
+    '''Stands in for Instrumentation when a city is not instrumented, so timestep never has to check.'''
+
+    def __init__(self):
+        self._null_phase = contextlib.nullcontext()
+
+    def phase(self, name):
+        return self._null_phase
+
+    def count(self, name, value=1):
+        pass
+
+    def emit(self, city_name, i):
+        pass
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+class JsonLinesSink:
+    def __init__(self, path):
+        '''Appends each instrumentation record to a file as one JSON line.
+
+        :param str path: file to append to
+        '''
+        self.path = path
+
+    def __call__(self, record):
+        with open(self.path, 'a+') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def fan_out(sinks):
+    """Combine several sinks into one that passes every record to each of them."""
+    sinks = list(sinks)
+
+    def sink(record):
+        for s in sinks:
+            s(record)
+    return sink
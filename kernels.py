@@ -0,0 +1,194 @@
+"""Array kernels for the timestep hot paths: contact search, preferential-return movement and transitions.
+
+Two backends expose the same methods. NumpyKernels is always available. NumbaKernels, in numba_kernels.py,
+compiles the same kernels with numba when it is installed, caching the compiled code on disk next to that
+module so that later processes skip compilation. numba is only imported once a backend is asked for:
+get_backend('auto') picks numba when it can and falls back to NumPy.
+"""
+import importlib
+
+import numpy as np
+
+MODES = ['home', 'work', 'market', 'transit']  # order of the cumulative movement probabilities
+MODE_CODES = {mode: code for code, mode in enumerate(MODES)}
+
+# half of the 3x3 cell stencil, so that every pair of neighbouring cells is visited once
+_HALF_STENCIL = [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+
+def _cell_keys(xs, ys, radius, groups=None):
+    """Bin points into square cells at least radius wide.
+
+    Rows and columns are padded by one empty cell so that neighbouring keys never wrap into the next column,
+    or into the next group's cells when points are split into groups that must not be paired.
+
+    :returns: tuple of per-point cell keys and the row length of the key space
+    """
+    cell_size = radius if radius > 0 else 1.0
+    cx = np.floor((xs - xs.min()) / cell_size).astype(np.int64)
+    cy = np.floor((ys - ys.min()) / cell_size).astype(np.int64)
+    ny = int(cy.max()) + 2
+    keys = cx * ny + cy
+    if groups is not None:
+        keys += np.asarray(groups, dtype=np.int64) * ((int(cx.max()) + 2) * ny)
+    return keys, ny
+
+
+class NumpyKernels:
+    name = 'numpy'
+
+    @staticmethod
+    def cell_list_pairs(xs, ys, radius, groups=None):
+        """Find every pair of points no further than radius apart.
+
+        Distances are computed exactly as the original all-pairs scan did, so the pairs are identical.
+
+        :param np.ndarray xs: x coordinates
+        :param np.ndarray ys: y coordinates
+        :param float radius: maximum distance
+        :param np.ndarray groups: optional non-negative group of every point; only points of the same group pair up
+        :returns: tuple(np.ndarray, np.ndarray, int) i, j with i < j sorted lexicographically, and the number
+            of candidate pairs whose distance was tested
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        n = len(xs)
+        empty = np.empty(0, dtype=np.int64)
+        if n < 2:
+            return empty, empty, 0
+        keys, ny = _cell_keys(xs, ys, radius, groups)
+        order = np.argsort(keys, kind='stable')
+        cells, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+
+        found_i = []
+        found_j = []
+        tested = 0
+        for dx, dy in _HALF_STENCIL:
+            neighbour_keys = keys + (dx * ny + dy)
+            cell_index = np.minimum(np.searchsorted(cells, neighbour_keys), len(cells) - 1)
+            a = np.nonzero(cells[cell_index] == neighbour_keys)[0]
+            cell_index = cell_index[a]
+            members = counts[cell_index]
+            total = int(members.sum())
+            a = np.repeat(a, members)
+            within = np.arange(total) - np.repeat(np.cumsum(members) - members, members)
+            b = order[np.repeat(starts[cell_index], members) + within]
+            if dx == 0 and dy == 0:
+                keep = a < b
+                a = a[keep]
+                b = b[keep]
+            tested += len(a)
+            d = np.sqrt(((xs[a] - xs[b]) ** 2) + ((ys[a] - ys[b]) ** 2))
+            close = d <= radius
+            found_i.append(a[close])
+            found_j.append(b[close])
+
+        a = np.concatenate(found_i)
+        b = np.concatenate(found_j)
+        i = np.minimum(a, b)
+        j = np.maximum(a, b)
+        order = np.lexsort((j, i))
+        return i[order], j[order], tested
+
+    @staticmethod
+    def preferential_return(rand_vals, thresholds, site_xs, site_ys, jitter):
+        """Choose each agent's mode and teleport it next to that mode's central location.
+
+        :param np.ndarray rand_vals: one uniform draw per agent
+        :param np.ndarray thresholds: (n, 3) cumulative probabilities of home, work and market
+        :param np.ndarray site_xs: (n, 4) x coordinate of each agent's central location per mode, in MODES order
+        :param np.ndarray site_ys: (n, 4) y coordinate of each agent's central location per mode
+        :param np.ndarray jitter: (n, 2) offsets added to the central location
+        :returns: tuple of mode codes, x and y positions
+        """
+        modes = (rand_vals[:, None] >= thresholds).sum(axis=1)
+        rows = np.arange(len(modes))
+        xs = site_xs[rows, modes] + jitter[:, 0]
+        ys = site_ys[rows, modes] + jitter[:, 1]
+        return modes, xs, ys
+
+    @staticmethod
+    def reflect(xs, ys, width, height, velocity):
+        """Keep positions inside the city like Agent.recalculate_positions_based_on_edges.
+
+        :returns: tuple of x and y positions, and a mask of the agents modified along both axes
+        """
+        x_high = xs >= width
+        xs = np.where(x_high, xs - velocity, xs)
+        x_low = xs < 0
+        xs = np.where(x_low, xs * -1 * velocity, xs)
+        y_high = ys >= height
+        ys = np.where(y_high, ys - velocity, ys)
+        y_low = ys < 0
+        ys = np.where(y_low, ys * -1 * velocity, ys)
+        return xs, ys, (x_high | x_low) & (y_high | y_low)
+
+    @staticmethod
+    def infection_rates(n, ei, ej, infected, susceptibility=None, infectiousness=None):
+        """Fraction of each agent's neighbours that are infected, 0 for agents without neighbours.
+
+        With weights, infected neighbours count with their infectiousness and the fraction is scaled by the agent's
+        susceptibility.
+
+        :param np.ndarray susceptibility: optional per-agent susceptibility, see cohorts.Cohorts
+        :param np.ndarray infectiousness: optional per-agent infectiousness
+        """
+        degree = np.bincount(ei, minlength=n) + np.bincount(ej, minlength=n)
+        infected = infected.astype(np.float64)
+        if infectiousness is not None:
+            infected = infected * infectiousness
+        infected_neighbours = (np.bincount(ei, weights=infected[ej], minlength=n) +
+                               np.bincount(ej, weights=infected[ei], minlength=n))
+        rates = np.zeros(n)
+        np.divide(infected_neighbours, degree, out=rates, where=degree > 0)
+        if susceptibility is not None:
+            rates *= susceptibility
+        return rates
+
+    @staticmethod
+    def transitions(rates, draws, susceptible, infected, eligible, timesteps_infected, recovery_time):
+        """Apply one synchronous S->I and I->R update.
+
+        Newly infected agents start counting timesteps_infected on the day they are infected.
+
+        :param np.ndarray rates: per-agent infection rates from infection_rates
+        :param np.ndarray draws: one uniform draw per agent
+        :param np.ndarray susceptible: mask of susceptible agents
+        :param np.ndarray infected: mask of infected agents
+        :param np.ndarray eligible: mask of agents that have not transitioned this timestep
+        :param np.ndarray timesteps_infected: days each agent has been infected
+        :param float recovery_time: days after which an infected agent is removed
+        :returns: tuple of newly infected mask, recovered mask and updated timesteps_infected
+        """
+        newly_infected = susceptible & eligible & (draws < rates)
+        still_infected = (infected | newly_infected) & eligible
+        timesteps_infected = timesteps_infected + still_infected
+        recovered = still_infected & (timesteps_infected >= recovery_time)
+        return newly_infected, recovered, timesteps_infected
+
+
+BACKENDS = {'numpy': NumpyKernels}
+
+
+def _load_numba():
+    """Import the numba kernels on first use; importing numba alone takes the best part of a second."""
+    if 'numba' not in BACKENDS:
+        try:
+            BACKENDS['numba'] = importlib.import_module('numba_kernels').NumbaKernels
+        except ImportError:
+            return False
+    return True
+
+
+def get_backend(name='auto'):
+    """Return the kernels of a backend.
+
+    :param str name: 'numba', 'numpy' or 'auto' for numba when installed, NumPy otherwise
+    """
+    if name in ('auto', 'numba'):
+        available = _load_numba()
+        if name == 'auto':
+            name = 'numba' if available else 'numpy'
+    if name not in BACKENDS:
+        raise ValueError('Kernel backend {} is not available, choose from {}'.format(name, sorted(BACKENDS)))
+    return BACKENDS[name]
@@ -0,0 +1,155 @@
+"""City layouts: central locations and which of them every agent uses, built as compact arrays.
+
+A layout holds the initial agent positions, the sites of every kind of central location and, per agent and mode,
+the index of the site it uses. Every agent uses the nearest site of each kind, i.e. the one whose Voronoi region
+holds its home position, found with a k-d tree instead of shapely polygons. As in City.setup_agent_central_locations,
+a site takes no more agents once it has more than the city's agents per site, and the agents beyond that use a
+random site instead. Layouts depend only on their seed, so they can be built in worker processes ahead of the runs
+that use them:
+
+    with LayoutService(workers=2) as service:
+        for layout in service.layouts(specs):
+            city = City(..., layout=layout)
+"""
+import collections
+import itertools
+import multiprocessing
+
+import numpy as np
+
+import kernels
+from lazy import lazy_import
+
+# loaded on first use, see lazy.py
+spatial = lazy_import('scipy.spatial')
+
+
+class Layout:
+    def __init__(self, width, height, xs, ys, sites, assignment):
+        '''The layout of one city.
+
+        :param int width: city width
+        :param int height: city height
+        :param np.ndarray xs: initial x position of every agent
+        :param np.ndarray ys: initial y position of every agent
+        :param dict sites: (k, 2) array of the site coordinates of every mode in kernels.MODES
+        :param np.ndarray assignment: (n, 4) index of every agent's site per mode, in kernels.MODES order
+        '''
+        self.width = width
+        self.height = height
+        self.xs = xs
+        self.ys = ys
+        self.sites = sites
+        self.assignment = assignment
+
+    @property
+    def n(self):
+        return len(self.xs)
+
+    @property
+    def nbytes(self):
+        return (self.xs.nbytes + self.ys.nbytes + self.assignment.nbytes +
+                sum(sites.nbytes for sites in self.sites.values()))
+
+    def central_location_arrays(self):
+        """Coordinates of every agent's central locations, as City.central_location_arrays.
+
+        :returns: tuple of (n, 4) arrays of x and y coordinates indexed by agent number
+        """
+        site_xs = np.empty((self.n, len(kernels.MODES)))
+        site_ys = np.empty((self.n, len(kernels.MODES)))
+        for code, mode in enumerate(kernels.MODES):
+            site_xs[:, code] = self.sites[mode][self.assignment[:, code], 0]
+            site_ys[:, code] = self.sites[mode][self.assignment[:, code], 1]
+        return site_xs, site_ys
+
+
+def generate_layout(width, height, n, frequencies, seed):
+    """Lay out a city.
+
+    Every kind of central location is placed by a Poisson point process with one site per frequencies[mode] agents
+    on average, and at least one site.
+
+    :param int width: city width
+    :param int height: city height
+    :param int n: number of agents
+    :param dict frequencies: agents per site of every mode, as City's frequencies_dict
+    :param seed: seed of the layout's random number generator, anything numpy.random.default_rng accepts
+    :rtype: Layout
+    """
+    rng = np.random.default_rng(seed)
+    xs = width * rng.random(n)
+    ys = height * rng.random(n)
+    homes = np.column_stack((xs, ys))
+    sites = {}
+    assignment = np.empty((n, len(kernels.MODES)), dtype=np.int32)
+    for code, mode in enumerate(kernels.MODES):
+        count = max(int(rng.poisson(n / frequencies[mode])), 1)
+        sites[mode] = np.column_stack((width * rng.random(count), height * rng.random(count)))
+        _, nearest = spatial.cKDTree(sites[mode]).query(homes)
+        assignment[:, code] = limit_site_use(nearest, frequencies[mode], count, rng)
+    return Layout(width, height, xs, ys, sites, assignment)
+
+
+def limit_site_use(sites, capacity, count, rng):
+    """Let the first capacity + 1 agents of every site keep it and send the others to a random site.
+
+    :param np.ndarray sites: site of every agent, in agent order
+    :param int capacity: agents per site
+    :param int count: number of sites
+    :returns: new array of sites
+    """
+    order = np.argsort(sites, kind='stable')
+    sorted_sites = sites[order]
+    rank = np.empty(len(sites), dtype=np.int64)
+    rank[order] = np.arange(len(sites)) - np.searchsorted(sorted_sites, sorted_sites)
+    sites = sites.copy()
+    over = rank > capacity
+    sites[over] = rng.integers(0, count, int(over.sum()))
+    return sites
+
+
+def _generate(spec):
+    return generate_layout(**spec)
+
+
+class LayoutService:
+    def __init__(self, workers=1, ahead=None):
+        '''Builds layouts in worker processes while earlier ones are being used.
+
+        :param int workers: worker processes; 0 builds every layout in the calling process when it is taken
+        :param int ahead: most layouts being built or waiting to be taken, twice the workers by default
+        '''
+        self.workers = workers
+        self.ahead = ahead if ahead is not None else max(2 * workers, 1)
+        self._pool = multiprocessing.Pool(workers) if workers > 0 else None
+
+    def layouts(self, specs):
+        """Yield the layout of every spec in order.
+
+        :param specs: iterable of dicts of generate_layout arguments
+        """
+        specs = iter(specs)
+        if self._pool is None:
+            for spec in specs:
+                yield _generate(spec)
+            return
+        pending = collections.deque(self._pool.apply_async(_generate, (spec,))
+                                    for spec in itertools.islice(specs, self.ahead))
+        while pending:
+            result = pending.popleft()
+            for spec in itertools.islice(specs, 1):
+                pending.append(self._pool.apply_async(_generate, (spec,)))
+            yield result.get()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
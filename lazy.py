@@ -0,0 +1,38 @@
+"""Deferred imports for the heavy plotting, geometry and graph libraries.
+
+The simulation core only needs NumPy to start. Modules that use networkx, shapely, scipy, matplotlib or
+seaborn bind them with lazy_import, which imports the real module the first time one of its attributes
+is looked up, so that workers and short command line runs that never plot or build a graph skip the cost.
+"""
+import importlib
+
+
+class LazyModule:
+    def __init__(self, name):
+        '''Stands in for a module until it is first used.
+
+        :param str name: full module name, e.g. 'matplotlib.pyplot'
+        '''
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module {} ({})>'.format(self._name, state)
+
+
+def lazy_import(name):
+    """Return a stand-in for the module name that imports it on first attribute access.
+
+    :param str name: full module name
+    :rtype: LazyModule
+    """
+    return LazyModule(name)
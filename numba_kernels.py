@@ -0,0 +1,189 @@
+"""numba versions of the array kernels in kernels.py, loaded by kernels.get_backend on first use.
+
+The compiled code is cached on disk next to this module so that later processes skip compilation.
+"""
+import numba
+import numpy as np
+
+from kernels import NumpyKernels, _cell_keys
+
+
+@numba.njit(parallel=True, cache=True)
+def _count_neighbours(xs, ys, radius, agent_cells, neighbour_cells, starts, counts, order, found, tested):
+    for a in numba.prange(len(xs)):
+        n_found = 0
+        n_tested = 0
+        for cell in neighbour_cells[agent_cells[a]]:
+            if cell < 0:
+                continue
+            for k in range(starts[cell], starts[cell] + counts[cell]):
+                b = order[k]
+                if b > a:
+                    n_tested += 1
+                    if np.sqrt(((xs[a] - xs[b]) ** 2) + ((ys[a] - ys[b]) ** 2)) <= radius:
+                        n_found += 1
+        found[a] = n_found
+        tested[a] = n_tested
+
+@numba.njit(parallel=True, cache=True)
+def _fill_neighbours(xs, ys, radius, agent_cells, neighbour_cells, starts, counts, order, offsets, ei, ej):
+    for a in numba.prange(len(xs)):
+        k_out = offsets[a]
+        for cell in neighbour_cells[agent_cells[a]]:
+            if cell < 0:
+                continue
+            for k in range(starts[cell], starts[cell] + counts[cell]):
+                b = order[k]
+                if b > a and np.sqrt(((xs[a] - xs[b]) ** 2) + ((ys[a] - ys[b]) ** 2)) <= radius:
+                    ei[k_out] = a
+                    ej[k_out] = b
+                    k_out += 1
+        ej[offsets[a]:k_out] = np.sort(ej[offsets[a]:k_out])
+
+@numba.njit(parallel=True, cache=True)
+def _preferential_return(rand_vals, thresholds, site_xs, site_ys, jitter, modes, xs, ys):
+    for a in numba.prange(len(rand_vals)):
+        mode = 0
+        for k in range(thresholds.shape[1]):
+            if rand_vals[a] >= thresholds[a, k]:
+                mode += 1
+        modes[a] = mode
+        xs[a] = site_xs[a, mode] + jitter[a, 0]
+        ys[a] = site_ys[a, mode] + jitter[a, 1]
+
+@numba.njit(parallel=True, cache=True)
+def _reflect(xs, ys, width, height, velocity, out_xs, out_ys, both):
+    for a in numba.prange(len(xs)):
+        x = xs[a]
+        y = ys[a]
+        x_modified = False
+        y_modified = False
+        if x >= width:
+            x = x - velocity
+            x_modified = True
+        if x < 0:
+            x = x * -1 * velocity
+            x_modified = True
+        if y >= height:
+            y = y - velocity
+            y_modified = True
+        if y < 0:
+            y = y * -1 * velocity
+            y_modified = True
+        out_xs[a] = x
+        out_ys[a] = y
+        both[a] = x_modified and y_modified
+
+@numba.njit(cache=True)
+def _infection_rates(n, ei, ej, infected, rates):
+    degree = np.zeros(n, dtype=np.int64)
+    infected_neighbours = np.zeros(n, dtype=np.int64)
+    for k in range(len(ei)):
+        a = ei[k]
+        b = ej[k]
+        degree[a] += 1
+        degree[b] += 1
+        if infected[b]:
+            infected_neighbours[a] += 1
+        if infected[a]:
+            infected_neighbours[b] += 1
+    for a in range(n):
+        rates[a] = infected_neighbours[a] / degree[a] if degree[a] > 0 else 0.0
+
+@numba.njit(cache=True)
+def _weighted_infection_rates(n, ei, ej, infected, susceptibility, infectiousness, rates):
+    degree = np.zeros(n, dtype=np.int64)
+    infected_neighbours = np.zeros(n)
+    for k in range(len(ei)):
+        a = ei[k]
+        b = ej[k]
+        degree[a] += 1
+        degree[b] += 1
+        if infected[b]:
+            infected_neighbours[a] += infectiousness[b]
+        if infected[a]:
+            infected_neighbours[b] += infectiousness[a]
+    for a in range(n):
+        rates[a] = infected_neighbours[a] / degree[a] * susceptibility[a] if degree[a] > 0 else 0.0
+
+@numba.njit(parallel=True, cache=True)
+def _transitions(rates, draws, susceptible, infected, eligible, timesteps_infected, recovery_time,
+                 newly_infected, recovered, out_timesteps_infected):
+    for a in numba.prange(len(rates)):
+        newly_infected[a] = susceptible[a] and eligible[a] and draws[a] < rates[a]
+        t = timesteps_infected[a]
+        if (infected[a] or newly_infected[a]) and eligible[a]:
+            t += 1
+            recovered[a] = t >= recovery_time
+        else:
+            recovered[a] = False
+        out_timesteps_infected[a] = t
+
+
+class NumbaKernels(NumpyKernels):
+    name = 'numba'
+
+    @staticmethod
+    def cell_list_pairs(xs, ys, radius, groups=None):
+        xs = np.ascontiguousarray(xs, dtype=np.float64)
+        ys = np.ascontiguousarray(ys, dtype=np.float64)
+        n = len(xs)
+        empty = np.empty(0, dtype=np.int64)
+        if n < 2:
+            return empty, empty, 0
+        keys, ny = _cell_keys(xs, ys, radius, groups)
+        order = np.argsort(keys, kind='stable')
+        cells, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+        agent_cells = np.searchsorted(cells, keys)
+        # index of each cell's 3x3 neighbourhood in cells, -1 where the neighbouring cell is empty
+        neighbour_cells = np.empty((len(cells), 9), dtype=np.int64)
+        for k, (dx, dy) in enumerate([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]):
+            neighbour_keys = cells + (dx * ny + dy)
+            index = np.minimum(np.searchsorted(cells, neighbour_keys), len(cells) - 1)
+            neighbour_cells[:, k] = np.where(cells[index] == neighbour_keys, index, -1)
+        found = np.empty(n, dtype=np.int64)
+        tested = np.empty(n, dtype=np.int64)
+        _count_neighbours(xs, ys, radius, agent_cells, neighbour_cells, starts, counts, order, found, tested)
+        offsets = np.concatenate((np.zeros(1, dtype=np.int64), np.cumsum(found)))
+        ei = np.empty(offsets[-1], dtype=np.int64)
+        ej = np.empty(offsets[-1], dtype=np.int64)
+        _fill_neighbours(xs, ys, radius, agent_cells, neighbour_cells, starts, counts, order, offsets, ei, ej)
+        return ei, ej, int(tested.sum())
+
+    @staticmethod
+    def preferential_return(rand_vals, thresholds, site_xs, site_ys, jitter):
+        n = len(rand_vals)
+        modes = np.empty(n, dtype=np.int64)
+        xs = np.empty(n)
+        ys = np.empty(n)
+        _preferential_return(rand_vals, thresholds, site_xs, site_ys, jitter, modes, xs, ys)
+        return modes, xs, ys
+
+    @staticmethod
+    def reflect(xs, ys, width, height, velocity):
+        out_xs = np.empty(len(xs))
+        out_ys = np.empty(len(ys))
+        both = np.empty(len(xs), dtype=np.bool_)
+        _reflect(xs, ys, width, height, velocity, out_xs, out_ys, both)
+        return out_xs, out_ys, both
+
+    @staticmethod
+    def infection_rates(n, ei, ej, infected, susceptibility=None, infectiousness=None):
+        rates = np.empty(n)
+        if susceptibility is None and infectiousness is None:
+            _infection_rates(n, ei, ej, infected, rates)
+        else:
+            susceptibility = np.ones(n) if susceptibility is None else np.asarray(susceptibility, dtype=np.float64)
+            infectiousness = np.ones(n) if infectiousness is None else np.asarray(infectiousness, dtype=np.float64)
+            _weighted_infection_rates(n, ei, ej, infected, susceptibility, infectiousness, rates)
+        return rates
+
+    @staticmethod
+    def transitions(rates, draws, susceptible, infected, eligible, timesteps_infected, recovery_time):
+        n = len(rates)
+        newly_infected = np.empty(n, dtype=np.bool_)
+        recovered = np.empty(n, dtype=np.bool_)
+        out_timesteps_infected = np.empty(n, dtype=np.int64)
+        _transitions(rates, draws, susceptible, infected, eligible, timesteps_infected, recovery_time,
+                     newly_infected, recovered, out_timesteps_infected)
+        return newly_infected, recovered, out_timesteps_infected
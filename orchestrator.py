@@ -0,0 +1,309 @@
+"""Parameter sweeps of simulation.setup_and_run driven from an asyncio event loop.
+
+Every point of the lockdown_t0 x EDGE_PROXIMITIES x GAMMAS grid runs in a pool of worker processes. The event loop
+only schedules runs, writes their results and reports progress, so none of these waits on a simulation. At most
+max_in_flight runs are submitted at a time and, with a memory limit, only as many as fit in it going by the peak
+resident memory the workers report. Results are appended to a JSON lines file as soon as each run finishes, and
+points already in the file with the same settings and code are skipped, so an interrupted sweep resumes where it
+stopped. A failed run is retried
+with a growing delay, and a point that keeps failing is reported at the end and left out of the file, so the next
+sweep tries it again. Ctrl-C cancels the sweep: no further runs start and the runs in flight are abandoned.
+
+    python orchestrator.py 200 --workers 4 --results data/sweep.jsonl
+    python orchestrator.py 50 --edge-proximities 0.1 0.2 --gammas 10 18 --memory-limit 2000 --retries 2
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import os
+import signal
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+import result_store
+import simulation
+from progress import SweepProgress
+from scenario import stored_keys
+
+# simulation.py settings that change the outcome of a run, and so are part of every point's key
+OUTCOME_SETTINGS = ['MIGRATE', 'SOCIAL_DISTANCING', 'KERNEL_BACKEND', 'CONTACT_ENGINE', 'EARLY_STOP_RT', 'LAYOUTS',
+                    'LOCATION_POLICIES']
+# simulation.py settings that worker processes take over from the process running the sweep
+WORKER_SETTINGS = OUTCOME_SETTINGS + ['SNAPSHOT_DIR', 'SNAPSHOT_CODEC', 'RESULT_STORE', 'RESULT_STORE_MAX_BYTES']
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def sweep_points(timesteps, edge_proximities, gammas, lockdown_t0s, migration_t0=1, seed=None):
+    """The runs of a parameter sweep, in the order of simulation.run_experiments, with the current settings.
+
+    :returns: list of dicts of setup_and_run arguments and the OUTCOME_SETTINGS, each with a run_id and a key
+        identifying its result, which also covers the code version, see result_store.config_key
+    """
+    settings = {name: getattr(simulation, name) for name in OUTCOME_SETTINGS}
+    points = []
+    for lockdown_t0 in lockdown_t0s:
+        for edge_proximity in edge_proximities:
+            for gamma in gammas:
+                point = {'timesteps': timesteps, 'edge_proximity': float(edge_proximity), 'gamma': float(gamma),
+                         'migration_t0': migration_t0, 'lockdown_t0': lockdown_t0, 'seed': seed,
+                         'settings': settings}
+                point['key'] = result_store.config_key(point)
+                point['run_id'] = len(points)
+                points.append(point)
+    return points
+
+
+def pending_points(points, results_path):
+    """The points without a result in the results file."""
+    done = stored_keys(results_path)
+    return [point for point in points if point['key'] not in done]
+
+
+def _init_worker(settings):
+    # Ctrl-C cancels the sweep in the main process, which decides what happens to the runs in flight
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name, value in settings.items():
+        setattr(simulation, name, value)
+
+
+def run_point(point, quiet=True):
+    """Run one point of a sweep in a worker process.
+
+    :returns: dict with the i_max of every city, the wall time and the worker's peak resident memory in bytes, None
+        where it cannot be measured
+    """
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if quiet:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+        i_max = simulation.setup_and_run(point['timesteps'], point['edge_proximity'], point['gamma'],
+                                         point['migration_t0'], point['lockdown_t0'], seed=point['seed'])
+    return {
+        'i_max': [int(value) for value in i_max],
+        'wall_time': time.perf_counter() - start,
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT if resource is not None else None,
+    }
+
+
+class SweepOrchestrator:
+    def __init__(self, results_path, workers=1, max_in_flight=None, memory_limit=None, retries=1, retry_delay=1.0,
+                 progress=None, quiet=True):
+        '''Runs sweep points in worker processes and streams their results to a JSON lines file.
+
+        :param str results_path: JSON lines results file, appended to
+        :param int workers: number of worker processes
+        :param int max_in_flight: most runs submitted to the workers at a time, the number of workers by default
+        :param int memory_limit: bytes the runs in flight may take together, each counted as the largest peak
+            resident memory a worker has reported; until a worker has reported one, which without the resource
+            module never happens, they start one at a time
+        :param int retries: times a failed run is tried again
+        :param float retry_delay: seconds before the first retry, doubling with every further one
+        :param progress.SweepProgress progress: reports every run's start and end, if given
+        :param bool quiet: silence the per-day output of the runs
+        '''
+        self.results_path = results_path
+        self.workers = workers
+        self.max_in_flight = max_in_flight or workers
+        self.memory_limit = memory_limit
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.progress = progress
+        self.quiet = quiet
+        self.run_bytes = None
+        self.completed = 0
+        self.failed = []
+        self.cancelled = False
+        self._in_flight = 0
+        self._slots = None
+        self._executor = None
+        self._task = None
+
+    def _new_executor(self):
+        settings = {name: getattr(simulation, name) for name in WORKER_SETTINGS}
+        return concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(settings,))
+
+    def _fits(self):
+        if self._in_flight >= self.max_in_flight:
+            return False
+        if self.memory_limit is None or self._in_flight == 0:
+            return True
+        return self.run_bytes is not None and (self._in_flight + 1) * self.run_bytes <= self.memory_limit
+
+    async def _acquire(self):
+        async with self._slots:
+            await self._slots.wait_for(self._fits)
+            self._in_flight += 1
+
+    async def _release(self):
+        async with self._slots:
+            self._in_flight -= 1
+            self._slots.notify_all()
+
+    async def run(self, points):
+        """Run every point whose key is not in the results file yet.
+
+        :param list[dict] points: points from sweep_points
+        :returns: list of the points that failed on every attempt
+        """
+        total = len(points)
+        points = pending_points(points, self.results_path)
+        print('{} runs already stored, {} to run'.format(total - len(points), len(points)))
+        directory = os.path.dirname(self.results_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._task = asyncio.current_task()
+        self._slots = asyncio.Condition()
+        self._executor = self._new_executor()
+        # bounded, and a run keeps its slot until its result is queued, so results never pile up in memory
+        results = asyncio.Queue(maxsize=self.max_in_flight)
+        writer = asyncio.create_task(self._write_results(results, len(points)))
+        tasks = set()
+        try:
+            for point in points:
+                await self._acquire()
+                task = asyncio.create_task(self._run_point(point, results))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            # Python < 3.11 does not count cancellation requests, there is nothing to undo
+            if hasattr(self._task, 'uncancel'):
+                self._task.uncancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # runs in flight when the sweep is cancelled finish in the background and are not written
+            self._executor.shutdown(wait=not self.cancelled, cancel_futures=True)
+            await results.put(None)
+            await writer
+        if self.cancelled:
+            print('Sweep cancelled after {} of {} runs'.format(self.completed, len(points)))
+        for point in self.failed:
+            print('FAILED: run {} edge_proximity {} gamma {} lockdown_t0 {}'.format(
+                point['run_id'], point['edge_proximity'], point['gamma'], point['lockdown_t0']))
+        return self.failed
+
+    def cancel(self):
+        """Stop starting runs and abandon those in flight; safe to call from a signal handler of the event loop."""
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run_point(self, point, results):
+        loop = asyncio.get_running_loop()
+        if self.progress is not None:
+            self.progress.run_started(point['run_id'], edge_proximity=point['edge_proximity'], gamma=point['gamma'],
+                                      lockdown_t0=point['lockdown_t0'])
+        try:
+            for attempt in range(1, self.retries + 2):
+                executor = self._executor
+                try:
+                    outcome = await loop.run_in_executor(executor, run_point, point, self.quiet)
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    # a worker died, e.g. killed for running out of memory; later runs get a new pool
+                    if self._executor is executor:
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        self._executor = self._new_executor()
+                    error = e
+                except Exception as e:
+                    error = e
+                else:
+                    max_rss = outcome.pop('max_rss')
+                    if max_rss is not None:
+                        self.run_bytes = max(self.run_bytes or 0, max_rss)
+                    record = {key: value for key, value in point.items() if key != 'run_id'}
+                    record.update(outcome, attempts=attempt)
+                    await results.put(record)
+                    if self.progress is not None:
+                        self.progress.run_finished(run_id=point['run_id'])
+                    return
+                print('Run {} failed on attempt {}: {!r}'.format(point['run_id'], attempt, error))
+                if attempt <= self.retries:
+                    await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+            self.failed.append(point)
+            if self.progress is not None:
+                self.progress.run_finished(failed=True, run_id=point['run_id'])
+        except asyncio.CancelledError:
+            if self.progress is not None:
+                self.progress.run_finished(failed=True, run_id=point['run_id'])
+            raise
+        finally:
+            await self._release()
+
+    async def _write_results(self, results, total):
+        with open(self.results_path, 'a') as f:
+            while True:
+                record = await results.get()
+                if record is None:
+                    return
+                await asyncio.to_thread(self._write, f, record)
+                self.completed += 1
+                print('[{}/{}] edge_proximity {} gamma {} lockdown_t0 {}: i_max {} ({:.1f}s)'.format(
+                    self.completed, total, record['edge_proximity'], record['gamma'], record['lockdown_t0'],
+                    record['i_max'], record['wall_time']))
+
+    @staticmethod
+    def _write(f, record):
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+
+
+async def run_sweep(orchestrator, points):
+    """Run a sweep, cancelling it on SIGINT or SIGTERM."""
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, orchestrator.cancel)
+    try:
+        return await orchestrator.run(points)
+    finally:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('timesteps', type=int, nargs='?', default=200)
+    parser.add_argument('--results', default='data/sweep.jsonl', help='JSON lines results file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--max-in-flight', type=int, help='most runs submitted at a time, --workers by default')
+    parser.add_argument('--memory-limit', type=float, help='MB the runs in flight may take together')
+    parser.add_argument('--retries', type=int, default=1, help='times a failed run is tried again')
+    parser.add_argument('--edge-proximities', type=float, nargs='+', default=list(simulation.EDGE_PROXIMITIES),
+                        help='edge proximities to sweep, simulation.EDGE_PROXIMITIES by default')
+    parser.add_argument('--gammas', type=float, nargs='+', default=list(simulation.GAMMAS),
+                        help='infection lengths in days to sweep, simulation.GAMMAS by default')
+    parser.add_argument('--lockdown-t0', type=int, nargs='+', default=[15])
+    parser.add_argument('--seed', type=int, default=simulation.SEED, help='seed of every run')
+    parser.add_argument('--backend', default=simulation.KERNEL_BACKEND, help='python, numpy, numba or auto')
+    parser.add_argument('--verbose', action='store_true', help='show the per-day output of the runs')
+    args = parser.parse_args(argv)
+
+    simulation.KERNEL_BACKEND = args.backend
+    points = sweep_points(args.timesteps, args.edge_proximities, args.gammas, args.lockdown_t0, seed=args.seed)
+    progress = None
+    if simulation.PROGRESS_FILE or simulation.PROGRESS_PORT is not None:
+        # points already stored are not run, so they do not count towards the progress and ETA
+        progress = SweepProgress(len(pending_points(points, args.results)), status_file=simulation.PROGRESS_FILE,
+                                 port=simulation.PROGRESS_PORT)
+    orchestrator = SweepOrchestrator(args.results, workers=args.workers, max_in_flight=args.max_in_flight,
+                                     memory_limit=args.memory_limit * 2 ** 20 if args.memory_limit else None,
+                                     retries=args.retries, progress=progress, quiet=not args.verbose)
+    try:
+        failed = asyncio.run(run_sweep(orchestrator, points))
+    finally:
+        if progress is not None:
+            progress.close()
+    return 1 if failed or orchestrator.cancelled else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
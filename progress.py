@@ -0,0 +1,166 @@
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class SweepProgress:
+    def __init__(self, total_runs, status_file=None, port=None, interval=1.0):
+        '''Tracks how far a sweep has got and exports it for schedulers.
+
+        Call run_started and run_finished around every run. Passing observe as an instrumentation sink
+        also reports the in-flight timestep. Progress is exported as a rolling JSON status file and/or
+        served on http://127.0.0.1:port/metrics in Prometheus text format (and as JSON on /status).
+
+        :param int total_runs: number of runs in the sweep
+        :param str status_file: path of the JSON status file, rewritten atomically
+        :param int port: local port for the HTTP endpoint
+        :param float interval: minimum seconds between status file writes while a run is in flight
+        '''
+        self.total_runs = total_runs
+        self.status_file = status_file
+        self.interval = interval
+        self.completed_runs = 0
+        self.failed_runs = 0
+        self.current_run = None
+        self.current_timestep = None
+        self.last_run_time = None
+        self.total_run_time = 0.0
+        self.start_time = time.time()
+        self._run_start_times = {}
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+        # serializes status file writes, which come from the runs, the instrumentation sink and the HTTP thread
+        self._write_lock = threading.Lock()
+        self._server = None
+        if port is not None:
+            self.serve(port)
+
+    def run_started(self, run_id, **params):
+        with self._lock:
+            self.current_run = {'id': run_id, 'params': params}
+            self.current_timestep = None
+            self._run_start_times[run_id] = time.time()
+        self.write_status(force=True)
+
+    def run_finished(self, failed=False, run_id=None):
+        '''Record the end of a run; with several runs in flight, run_id says which, by default the last started.'''
+        with self._lock:
+            if run_id is None:
+                if self.current_run is None:
+                    raise ValueError('No run in flight to finish; pass its run_id')
+                run_id = self.current_run['id']
+            if run_id not in self._run_start_times:
+                raise ValueError('Run {} is not in flight'.format(run_id))
+            self.last_run_time = time.time() - self._run_start_times.pop(run_id)
+            self.total_run_time += self.last_run_time
+            self.completed_runs += 1
+            if failed:
+                self.failed_runs += 1
+            if self.current_run is not None and self.current_run['id'] == run_id:
+                self.current_run = None
+                self.current_timestep = None
+        self.write_status(force=True)
+
+    def observe(self, record):
+        '''Instrumentation sink that records the in-flight timestep.'''
+        with self._lock:
+            self.current_timestep = record['day']
+        self.write_status()
+
+    def status(self):
+        with self._lock:
+            elapsed = time.time() - self.start_time
+            runs_per_sec = self.completed_runs / elapsed if elapsed > 0 else 0.0
+            mean_run_time = self.total_run_time / self.completed_runs if self.completed_runs else None
+            remaining = self.total_runs - self.completed_runs
+            eta = remaining / runs_per_sec if runs_per_sec > 0 else None
+            return {
+                'total_runs': self.total_runs,
+                'completed_runs': self.completed_runs,
+                'failed_runs': self.failed_runs,
+                'elapsed_seconds': elapsed,
+                'runs_per_second': runs_per_sec,
+                'last_run_seconds': self.last_run_time,
+                'mean_run_seconds': mean_run_time,
+                'eta_seconds': eta,
+                'runs_in_flight': len(self._run_start_times),
+                'current_run': self.current_run,
+                'current_timestep': self.current_timestep,
+                'updated': time.time(),
+            }
+
+    def write_status(self, force=False):
+        if self.status_file is None:
+            return
+        with self._write_lock:
+            now = time.time()
+            if not force and now - self._last_write < self.interval:
+                return
+            self._last_write = now
+            directory = os.path.dirname(os.path.abspath(self.status_file))
+            with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.status-', suffix='.tmp',
+                                             delete=False) as f:
+                json.dump(self.status(), f, indent=2)
+            os.replace(f.name, self.status_file)
+
+    def prometheus_text(self):
+        status = self.status()
+        metrics = [
+            ('sweep_runs_planned', 'gauge', 'Runs in the sweep', status['total_runs']),
+            ('sweep_runs_completed_total', 'counter', 'Runs completed so far', status['completed_runs']),
+            ('sweep_runs_failed_total', 'counter', 'Runs that raised an error', status['failed_runs']),
+            ('sweep_runs_per_second', 'gauge', 'Completed runs per second since the sweep started',
+             status['runs_per_second']),
+            ('sweep_last_run_seconds', 'gauge', 'Wall time of the last completed run', status['last_run_seconds']),
+            ('sweep_mean_run_seconds', 'gauge', 'Mean wall time of completed runs', status['mean_run_seconds']),
+            ('sweep_eta_seconds', 'gauge', 'Estimated seconds until the sweep completes', status['eta_seconds']),
+            ('sweep_runs_in_flight', 'gauge', 'Runs started and not yet finished', status['runs_in_flight']),
+            ('sweep_current_timestep', 'gauge', 'Timestep of the run in flight', status['current_timestep']),
+        ]
+        lines = []
+        for name, metric_type, description, value in metrics:
+            if value is None:
+                continue
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        '''Serve the progress on 127.0.0.1:port from a daemon thread.'''
+        progress = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = progress.prometheus_text().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/status':
+                    body = json.dumps(progress.status()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        print('Serving sweep progress on http://127.0.0.1:{}/metrics'.format(self._server.server_port))
+
+    def close(self):
+        self.write_status(force=True)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,115 @@
+import collections
+import math
+
+import numpy as np
+
+
+class QuarantineSchedule:
+    def __init__(self, city):
+        '''The day every infected agent of a city is due to be quarantined.
+
+        Rather than drawing against quarantine_rate for every infected agent every day, the day an agent will be
+        quarantined is drawn once, when its infection clock starts: the number of daily draws up to and including
+        the first success is geometric. Agents are admitted on that day, which makes the daily cost proportional to
+        the number of new quarantines. When the center is full, agents due that day draw again from the next day.
+
+        :param city.City city: city whose gamma, quarantine_threshold, quarantine_rate and quarantine_capacity apply
+        '''
+        self.city = city
+        self._due = collections.defaultdict(list)
+
+    def schedule(self, numbers, first_day):
+        """Schedule the quarantine of newly infected agents.
+
+        :param list[int] numbers: numbers of the agents
+        :param int first_day: timestep on which the agents' timesteps_infected first becomes 1
+        """
+        if len(numbers) == 0 or self.city.quarantine_rate <= 0:
+            return
+        # the last day the agents are still infected when the quarantine draw happens
+        recovery_day = first_day + max(math.ceil(1 / self.city.gamma), 1) - 1
+        first_check = first_day + max(self.city.quarantine_threshold, 1) - 1
+        self._schedule(numbers, first_check, recovery_day)
+
+    def _schedule(self, numbers, first_check, recovery_day):
+        days = first_check + np.random.geometric(min(self.city.quarantine_rate, 1.0), len(numbers)) - 1
+        for number, day in zip(numbers, days.tolist()):
+            if day <= recovery_day:
+                self._due[day].append((number, recovery_day))
+
+    def due(self, i, admissible, count):
+        """The agents to quarantine on timestep i, as many as the center has room for.
+
+        Agents due that day for whom there is no room are scheduled again from the next day.
+
+        :param int i: timestep
+        :param admissible: function of an agent number telling whether it is still infected and not quarantined
+        :param int count: number of agents already in quarantine
+        :returns: numbers of the agents to admit
+        """
+        due = [(number, recovery_day) for number, recovery_day in self._due.pop(i, []) if admissible(number)]
+        capacity = self.city.quarantine_capacity
+        if capacity is not None:
+            room = max(capacity - count, 0)
+            overflow = due[room:]
+            due = due[:room]
+            for number, recovery_day in overflow:
+                self._schedule([number], i + 1, recovery_day)
+        return [number for number, _ in due]
+
+
+class QuarantineCenter:
+    def __init__(self, city):
+        '''Keeps track of which agents of a city are quarantined, admitting them on the days of a QuarantineSchedule.
+
+        :param city.City city: city whose quarantine_threshold, quarantine_rate and quarantine_capacity apply
+        '''
+        self.city = city
+        self.mask = np.zeros(city.N, dtype=bool)
+        self.count = 0
+        self.quarantine_schedule = QuarantineSchedule(city)
+
+    def schedule(self, numbers, first_day):
+        """Schedule the quarantine of newly infected agents, see QuarantineSchedule.schedule."""
+        self.quarantine_schedule.schedule(numbers, first_day)
+
+    def admit_due(self, i):
+        """Quarantine the agents due on timestep i and send them to the quarantine center.
+
+        :param int i: timestep
+        :returns: numbers of the admitted agents
+        """
+        agents = self.city.agents
+        admitted = self.quarantine_schedule.due(
+            i, lambda number: agents[number].is_infected() and not self.mask[number], self.count)
+        if not admitted:
+            return admitted
+        self.mask[admitted] = True
+        self.count += len(admitted)
+        offsets = np.random.normal(-5.0, 5.0, (len(admitted), 2))
+        location = self.city.quarantine_center_location
+        for number, (dx, dy) in zip(admitted, offsets.tolist()):
+            agent = agents[number]
+            print('Quarantining {} to Quarantine Center'.format(agent.name))
+            agent.has_been_quarantined()
+            agent.positionx = location[0] + dx
+            agent.positiony = location[1] + dy
+        return admitted
+
+    def admit(self, agent):
+        """Quarantine an agent right away, regardless of schedule and capacity."""
+        if self.mask[agent.number]:
+            return
+        self.mask[agent.number] = True
+        self.count += 1
+        agent.has_been_quarantined()
+        agent.send_to_quarantine_center()
+
+    def release(self, agent):
+        """Let a recovered agent out of quarantine and send it home."""
+        if not self.mask[agent.number]:
+            return
+        self.mask[agent.number] = False
+        self.count -= 1
+        agent.not_quarantined()
+        agent.send_to_home()
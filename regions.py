@@ -0,0 +1,49 @@
+"""Voronoi regions of one kind of central location, indexed for point lookups."""
+import collections
+
+from lazy import lazy_import
+
+# loaded on first use, see lazy.py
+geometry = lazy_import('shapely.geometry')
+strtree = lazy_import('shapely.strtree')
+
+
+class VoronoiRegions:
+    def __init__(self, polygons):
+        '''The polygons of City.setup_voronoi_diagrams, from which regions can be removed.
+
+        Finding the region of a point queries an R-tree of the polygons' bounding boxes instead of testing every
+        polygon, so assigning all agents takes O(N log N) rather than O(N^2).
+
+        :param list[tuple] polygons: (region, shapely Polygon) tuples in the order regions are looked up in
+        '''
+        self.polygons = polygons
+        self._removed = [False] * len(polygons)
+        self._count = len(polygons)
+        # positions of the polygons of every region that have not been removed
+        self._positions = collections.defaultdict(collections.deque)
+        for position, (region, _) in enumerate(polygons):
+            self._positions[region].append(position)
+        self._tree = strtree.STRtree([polygon for _, polygon in polygons])
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return (pair for pair, removed in zip(self.polygons, self._removed) if not removed)
+
+    def region_containing(self, x, y):
+        """The first region left whose polygon contains (x, y), None if there is none."""
+        point = geometry.Point(x, y)
+        for position in sorted(self._tree.query(point).tolist()):
+            region, polygon = self.polygons[position]
+            if not self._removed[position] and polygon.contains(point):
+                return region
+        return None
+
+    def remove(self, region):
+        """Remove the first polygon left of a region, if any."""
+        positions = self._positions.get(region)
+        if positions:
+            self._removed[positions.popleft()] = True
+            self._count -= 1
@@ -0,0 +1,163 @@
+"""Rendering of agent snapshots after a run: scatter frames and animations.
+
+Snapshots come from City.snapshot: per-day float32 positions, int8 state codes (see city.SNAPSHOT_STATES) and
+mode codes, either kept in a list or read back from a snapshot store (see snapshots.py). Every frame is drawn
+with a single scatter call colored by state code, frames can be rendered by a pool of worker processes, and a
+whole run can be written as an MP4 (when ffmpeg is installed) or GIF animation:
+
+    python render.py data/snapshots/City_A-20200601-120000 --frames plots --animation plots/City_A.gif
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+from lazy import lazy_import
+from snapshots import SnapshotReader
+
+# loaded on first use, see lazy.py
+animation = lazy_import('matplotlib.animation')
+backend_agg = lazy_import('matplotlib.backends.backend_agg')
+figure = lazy_import('matplotlib.figure')
+sns = lazy_import('seaborn')
+
+# color of each state code of city.SNAPSHOT_STATES, as in the original per-agent scatter plots
+STATE_COLORS = np.array(['blue', 'red', 'green', 'black'])
+
+
+def frame_limits(snapshots, margin=1.0):
+    """Axis limits that fit every agent of every snapshot, so that all frames share one frame of reference.
+
+    :returns: tuple of (x_min, x_max) and (y_min, y_max)
+    """
+    x_min = y_min = np.inf
+    x_max = y_max = -np.inf
+    for snapshot in snapshots:
+        x_min = min(x_min, float(snapshot['xs'].min()))
+        x_max = max(x_max, float(snapshot['xs'].max()))
+        y_min = min(y_min, float(snapshot['ys'].min()))
+        y_max = max(y_max, float(snapshot['ys'].max()))
+    return (x_min - margin, x_max + margin), (y_min - margin, y_max + margin)
+
+
+def _new_figure(limits=None):
+    sns.set_style('darkgrid')
+    fig = figure.Figure()
+    backend_agg.FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if limits is not None:
+        ax.set_xlim(*limits[0])
+        ax.set_ylim(*limits[1])
+    return fig, ax
+
+
+def render_frame(snapshot, path, limits=None, dpi=100):
+    """Draw one snapshot as a scatter plot and save it.
+
+    Uses a figure of its own rather than pyplot, so that frames can be drawn in worker processes or threads.
+
+    :param dict snapshot: snapshot from City.snapshot
+    :param str path: image file to write
+    :param tuple limits: axis limits from frame_limits; None to fit this snapshot alone
+    :param int dpi: resolution
+    :returns: path
+    """
+    fig, ax = _new_figure(limits)
+    ax.scatter(snapshot['xs'], snapshot['ys'], c=STATE_COLORS[snapshot['states']], alpha=0.5)
+    ax.set_title('Day {}'.format(snapshot['day']))
+    fig.savefig(path, dpi=dpi)
+    return path
+
+
+def _render_frame(args):
+    return render_frame(*args)
+
+
+def render_frames(snapshots, directory, prefix, workers=1, dpi=100):
+    """Draw every snapshot to directory/<prefix><day>.png.
+
+    :param snapshots: list of snapshots from City.snapshot, or a snapshots.SnapshotReader
+    :param str directory: output directory, created if missing
+    :param str prefix: file name prefix, e.g. the city name
+    :param int workers: number of worker processes
+    :param int dpi: resolution
+    :returns: list of the written paths in snapshot order
+    """
+    if not snapshots:
+        return []
+    os.makedirs(directory, exist_ok=True)
+    limits = frame_limits(snapshots)
+    tasks = [(snapshot, os.path.join(directory, '{}{}.png'.format(prefix, snapshot['day'])), limits, dpi)
+             for snapshot in snapshots]
+    if workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            return pool.map(_render_frame, tasks, chunksize=max(1, len(tasks) // (4 * workers)))
+    return [_render_frame(task) for task in tasks]
+
+
+def write_animation(snapshots, path, fps=5, dpi=100):
+    """Write the snapshots of a run as an animation.
+
+    A single scatter is created and its offsets and colors updated for every frame.
+
+    :param snapshots: list of snapshots from City.snapshot in day order, or a snapshots.SnapshotReader
+    :param str path: .mp4 (needs ffmpeg) or .gif file to write
+    :param int fps: frames per second
+    :param int dpi: resolution
+    :returns: path
+    """
+    if not snapshots:
+        raise ValueError('No snapshots to animate')
+    if path.endswith('.mp4'):
+        if not animation.writers.is_available('ffmpeg'):
+            raise ValueError('Writing {} needs ffmpeg; write a .gif instead'.format(path))
+        writer = animation.FFMpegWriter(fps=fps)
+    elif path.endswith('.gif'):
+        writer = animation.PillowWriter(fps=fps)
+    else:
+        raise ValueError('Unknown animation format {}, use .mp4 or .gif'.format(path))
+
+    fig, ax = _new_figure(frame_limits(snapshots))
+    first = snapshots[0]
+    scatter = ax.scatter(first['xs'], first['ys'], c=STATE_COLORS[first['states']], alpha=0.5)
+    with writer.saving(fig, path, dpi):
+        for snapshot in snapshots:
+            scatter.set_offsets(np.column_stack((snapshot['xs'], snapshot['ys'])))
+            scatter.set_facecolor(STATE_COLORS[snapshot['states']])
+            scatter.set_edgecolor(STATE_COLORS[snapshot['states']])
+            ax.set_title('Day {}'.format(snapshot['day']))
+            writer.grab_frame()
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('store', help='snapshot store directory')
+    parser.add_argument('--frames', help='directory to draw a PNG per day to')
+    parser.add_argument('--prefix', default='', help='frame file name prefix')
+    parser.add_argument('--animation', help='.gif or .mp4 file to write')
+    parser.add_argument('--first-day', type=int, help='first day to draw')
+    parser.add_argument('--last-day', type=int, help='last day to draw')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='processes drawing frames')
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--fps', type=int, default=5)
+    args = parser.parse_args(argv)
+    if not args.frames and not args.animation:
+        parser.error('nothing to do, give --frames and/or --animation')
+
+    reader = SnapshotReader(args.store)
+    last_day = args.last_day + 1 if args.last_day is not None else None
+    snapshots = reader.snapshots(slice(args.first_day, last_day))
+    if args.frames:
+        paths = render_frames(snapshots, args.frames, args.prefix, workers=args.workers, dpi=args.dpi)
+        print('Drew {} frames to {}'.format(len(paths), args.frames))
+    if args.animation:
+        write_animation(snapshots, args.animation, fps=args.fps, dpi=args.dpi)
+        print('Wrote {}'.format(args.animation))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""Replicate-batched simulation: R replicates of one city stepped together as a single array program."""
+import numpy as np
+
+import kernels
+
+SUSCEPTIBLE, INFECTED, REMOVED = 0, 1, 2
+
+
+class ReplicateBatch:
+    def __init__(self, cities, backend='auto'):
+        '''Holds R replicates of a city with the replicate as the leading axis of every array.
+
+        The replicates are taken over from already constructed cities with their initial states set, so each
+        replicate keeps its own central locations and patient zero. Transitions are synchronous, as with the
+        array kernel backends of City.
+
+        :param list[city.City] cities: identically configured cities on a preferential return policy
+        :param str backend: kernel backend, see kernels.get_backend
+        '''
+        first = cities[0]
+        for city in cities:
+            if (city.N, city.width, city.height) != (first.N, first.width, first.height):
+                raise ValueError('Replicates must have the same size, {} differs from {}'.format(city.name, first.name))
+            if 'preferential_return' not in city.policy.movement_policy_name:
+                raise ValueError('Replicate batches only support preferential return, not {}'.format(
+                    city.policy.movement_policy_name))
+            if city.cohorts.names != first.cohorts.names:
+                raise ValueError('Replicates must have the same cohorts, {} differs from {}'.format(city.name,
+                                                                                                  first.name))
+
+        self.kernels = kernels.get_backend(backend)
+        self.name = first.name
+        self.R = len(cities)
+        self.N = first.N
+        self.width = first.width
+        self.height = first.height
+        self.edge_proximity = first.edge_proximity
+        self.gamma = first.gamma
+        self.policy = first.policy
+        self.POLICIES = first.POLICIES
+        self.quarantine_threshold = first.quarantine_threshold
+        self.quarantine_rate = first.quarantine_rate
+        self.quarantine_capacity = first.quarantine_capacity
+        self.quarantine_center_location = first.quarantine_center_location
+        self.velocity = first.agents[0].velocity
+        # the cohort tables are those of the first replicate, the cohort of every agent is its replicate's own
+        self.cohorts = first.cohorts
+        self.cohort = np.concatenate([city.cohorts.cohort for city in cities])
+        self.susceptibility = self.cohorts.susceptibility[self.cohort]
+        self.infectiousness = self.cohorts.infectiousness[self.cohort]
+
+        positions = [city.positions() for city in cities]
+        self.xs = np.array([xs for xs, _ in positions])
+        self.ys = np.array([ys for _, ys in positions])
+        central_locations = [city.central_location_arrays() for city in cities]
+        self.site_xs = np.array([site_xs for site_xs, _ in central_locations])
+        self.site_ys = np.array([site_ys for _, site_ys in central_locations])
+        self.state = np.array([[self._state_code(agent) for agent in city.agents] for city in cities], dtype=np.int8)
+        self.timesteps_infected = np.array([[agent.timesteps_infected for agent in city.agents] for city in cities],
+                                           dtype=np.int64)
+        self.quarantined = np.array([[agent.been_quarantined for agent in city.agents] for city in cities])
+        self.transitioned = np.array([[agent.transitioned_this_timestep for agent in city.agents] for city in cities])
+        # each replicate keeps its city's quarantine schedule, patient zero included
+        self.quarantine_schedules = [city.quarantine_center.quarantine_schedule for city in cities]
+        # which replicate each flattened agent belongs to, so that contacts never cross replicates
+        self.groups = np.repeat(np.arange(self.R), self.N)
+
+    @staticmethod
+    def _state_code(agent):
+        if agent.is_susceptible():
+            return SUSCEPTIBLE
+        if agent.is_infected():
+            return INFECTED
+        return REMOVED
+
+    def thresholds(self, i):
+        """Cumulative home, work and market probabilities of every agent of every replicate at timestep i.
+
+        :returns: (R * N, 3) array
+        """
+        probabilities = self.cohorts.movement_probabilities(self.cohorts.policies(self), i)
+        return np.cumsum(probabilities[:, :3], axis=1)[self.cohort]
+
+    def counts(self):
+        """Number of agents per state in every replicate.
+
+        :returns: dict of (R,) arrays
+        """
+        susceptible = (self.state == SUSCEPTIBLE).sum(axis=1)
+        infected = (self.state == INFECTED).sum(axis=1)
+        removed = (self.state == REMOVED).sum(axis=1)
+        return {
+            'susceptible': susceptible,
+            'infected': infected,
+            'removed': removed,
+            'total_IR': infected + removed,
+            'quarantined': self.quarantined.sum(axis=1),
+        }
+
+    def timestep(self, i):
+        '''One unit of time in every replicate: move, find contacts, infect, quarantine and recover.
+
+        :param int i: timestep
+        :returns: per-replicate beta, the summed infection rate of susceptible agents divided by N
+        '''
+        xs = self.xs.reshape(-1)
+        ys = self.ys.reshape(-1)
+        quarantined = self.quarantined.reshape(-1)
+        transitioned = self.transitioned.reshape(-1)
+        timesteps_infected = self.timesteps_infected.reshape(-1)
+        site_xs = self.site_xs.reshape(-1, len(kernels.MODES))
+        site_ys = self.site_ys.reshape(-1, len(kernels.MODES))
+        n = len(xs)
+
+        if i > 0:
+            movers = np.nonzero(~quarantined)[0]
+            thresholds = self.thresholds(i)[movers]
+            _, new_xs, new_ys = self.kernels.preferential_return(
+                np.random.random(len(movers)), thresholds, site_xs[movers], site_ys[movers],
+                np.random.normal(-0.5, 0.5, (len(movers), 2)))
+            new_xs, new_ys, _ = self.kernels.reflect(new_xs, new_ys, self.width, self.height, self.velocity)
+            xs[movers] = new_xs
+            ys[movers] = new_ys
+            transitioned[movers] = False
+
+        # quarantined agents have no contacts
+        present = np.nonzero(~quarantined)[0]
+        edges_i, edges_j, _ = self.kernels.cell_list_pairs(xs[present], ys[present], self.edge_proximity,
+                                                           groups=self.groups[present])
+        edges_i = present[edges_i]
+        edges_j = present[edges_j]
+
+        self.admit_due(i)
+
+        state = self.state.reshape(-1)
+        susceptible = state == SUSCEPTIBLE
+        infected = state == INFECTED
+        eligible = ~transitioned
+        if self.cohorts.uniform:
+            rates = self.kernels.infection_rates(n, edges_i, edges_j, infected)
+        else:
+            rates = self.kernels.infection_rates(n, edges_i, edges_j, infected, self.susceptibility,
+                                                 self.infectiousness)
+        newly_infected, recovered, new_timesteps_infected = self.kernels.transitions(
+            rates, np.random.random(n), susceptible, infected, eligible, timesteps_infected, 1 / self.gamma)
+        state[newly_infected] = INFECTED
+        transitioned[newly_infected] = True
+        timesteps_infected[:] = new_timesteps_infected
+        for schedule, numbers in zip(self.quarantine_schedules, newly_infected.reshape(self.R, self.N)):
+            schedule.schedule(np.nonzero(numbers)[0].tolist(), i)
+
+        state[recovered] = REMOVED
+        transitioned[recovered] = True
+        timesteps_infected[recovered] = 0
+        released = np.nonzero(recovered & quarantined)[0]
+        quarantined[released] = False
+        home = kernels.MODE_CODES['home']
+        xs[released] = site_xs[released, home] + np.random.normal(-0.5, 0.5, len(released))
+        ys[released] = site_ys[released, home] + np.random.normal(-0.5, 0.5, len(released))
+
+        si_rates = np.where(susceptible & eligible, rates, 0.0).reshape(self.R, self.N)
+        return si_rates.sum(axis=1) / self.N
+
+    def admit_due(self, i):
+        """Quarantine the agents of every replicate due on timestep i, as QuarantineCenter.admit_due does.
+
+        :param int i: timestep
+        :returns: flattened numbers of the admitted agents
+        """
+        admitted = []
+        for r, schedule in enumerate(self.quarantine_schedules):
+            state = self.state[r]
+            quarantined = self.quarantined[r]
+            due = schedule.due(i, lambda number: state[number] == INFECTED and not quarantined[number],
+                               int(quarantined.sum()))
+            admitted.extend(r * self.N + number for number in due)
+        admitted = np.array(admitted, dtype=np.int64)
+        quarantined = self.quarantined.reshape(-1)
+        quarantined[admitted] = True
+        offsets = np.random.normal(-5.0, 5.0, (len(admitted), 2))
+        self.xs.reshape(-1)[admitted] = self.quarantine_center_location[0] + offsets[:, 0]
+        self.ys.reshape(-1)[admitted] = self.quarantine_center_location[1] + offsets[:, 1]
+        return admitted
+
+    def run(self, timesteps):
+        '''Run every replicate until it is free of infection or timesteps have passed.
+
+        Like setup_and_run, a replicate's time series ends on the first day with no infected agents.
+
+        :param int timesteps: maximum number of timesteps
+        :returns: list with one dict per replicate holding i_max, timestep_of_convergence, betas and the
+            susceptible, infected, removed, total_IR and quarantined time series
+        '''
+        series = {key: [] for key in ['susceptible', 'infected', 'removed', 'total_IR', 'quarantined']}
+        betas = []
+        end_day = np.full(self.R, timesteps)
+        for i in range(timesteps):
+            betas.append(self.timestep(i))
+            for key, values in self.counts().items():
+                series[key].append(values)
+            finished = (series['infected'][-1] == 0) & (end_day == timesteps)
+            end_day[finished] = i + 1
+            if np.all(end_day < timesteps):
+                break
+
+        series = {key: np.array(values).T for key, values in series.items()}
+        betas = np.array(betas).T
+        results = []
+        for r in range(self.R):
+            days = end_day[r]
+            replicate_series = {key: values[r, :days].tolist() for key, values in series.items()}
+            converged = np.nonzero(np.array(replicate_series['total_IR']) == self.N)[0]
+            results.append({
+                'i_max': max(replicate_series['infected']),
+                'timestep_of_convergence': int(converged[0]) if len(converged) else None,
+                'betas': betas[r, :days].tolist(),
+                'series': replicate_series,
+            })
+        return results
+
+
+def summarize(results, key='i_max'):
+    """Mean of a per-replicate result with a normal-approximation 95% confidence interval.
+
+    :param list[dict] results: output of ReplicateBatch.run
+    :param str key: result to summarize
+    :returns: tuple of mean, lower and upper bound
+    """
+    values = np.array([result[key] for result in results if result[key] is not None], dtype=float)
+    if len(values) == 0:
+        return None, None, None
+    mean = values.mean()
+    half_width = 1.96 * values.std(ddof=1) / np.sqrt(len(values)) if len(values) > 1 else 0.0
+    return mean, mean - half_width, mean + half_width
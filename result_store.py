@@ -0,0 +1,203 @@
+"""Content-addressed store of finished run results, so that identical runs are not simulated twice.
+
+A result is stored under the SHA-256 of its full run configuration together with a hash of the source of the
+simulation engine, so that any change to the engine invalidates every stored result. Settings that do not change a
+run's outcome, such as the toggles for progress reporting or the number of runs in simulation.py, are not part of
+the key. Entries are JSON files holding
+a digest of their payload, which is checked on every read; damaged entries are discarded. The store can be
+bounded in size, in which case the least recently used entries are evicted first.
+
+    python result_store.py data/results --verify
+"""
+import argparse
+import ast
+import glob
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+# modules whose source determines the outcome of a run
+CODE_MODULES = ['agent.py', 'city.py', 'CityGraph.py', 'cohorts.py', 'contacts.py', 'estimators.py', 'kernels.py',
+                'layouts.py', 'numba_kernels.py', 'policy.py', 'quarantine.py', 'regions.py']
+# functions of modules that also hold settings, whose source determines the outcome of a run
+CODE_FUNCTIONS = {
+    'simulation.py': ['setup_and_run', 'construct_cities', 'city_specs', 'construct_location_policies_dict',
+                      'run_timesteps', 'migration', 'shuffle', 'shuffle_central_locations', 'collect_i_max',
+                      'summarize_city_graphs'],
+}
+
+_code_version = None
+
+
+def code_version():
+    """Hash of the source of every module in CODE_MODULES and every function in CODE_FUNCTIONS."""
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in CODE_MODULES:
+            digest.update(name.encode())
+            with open(os.path.join(directory, name), 'rb') as f:
+                digest.update(f.read())
+        for name, functions in sorted(CODE_FUNCTIONS.items()):
+            with open(os.path.join(directory, name)) as f:
+                source = f.read()
+            definitions = {node.name: ast.get_source_segment(source, node) for node in ast.parse(source).body
+                           if isinstance(node, ast.FunctionDef)}
+            for function in functions:
+                digest.update('{}:{}'.format(name, function).encode())
+                digest.update(definitions[function].encode())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def config_key(config):
+    """Key of a run configuration: the SHA-256 of the configuration and the code version.
+
+    :param dict config: JSON-serializable description of everything that determines the run's outcome
+    """
+    content = json.dumps({'config': config, 'code_version': code_version()}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _digest(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class ResultStore:
+    def __init__(self, directory, max_bytes=None):
+        '''Stores run results as JSON files under directory, two levels deep by key prefix.
+
+        :param str directory: store directory, created if missing
+        :param int max_bytes: evict the least recently used entries once the store grows beyond this; None for
+            no limit
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        """Return the payload stored under key, or None if there is none or it is damaged."""
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except ValueError:
+            entry = None
+        if not self._intact(key, entry):
+            self._discard(path)
+            self.misses += 1
+            return None
+        # reads count as use for eviction
+        os.utime(path)
+        self.hits += 1
+        return entry['payload']
+
+    def put(self, key, payload):
+        """Store a JSON-serializable payload under key."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {'key': key, 'digest': _digest(payload), 'payload': payload}
+        # write to a temporary file and rename it, so readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def entries(self):
+        """Paths of all stored entries."""
+        return glob.glob(os.path.join(self.directory, '*', '*.json'))
+
+    def size(self):
+        """Total size of the stored entries in bytes."""
+        return sum(os.path.getsize(path) for path in self.entries())
+
+    def evict(self, max_bytes):
+        """Remove the least recently used entries until the store is no larger than max_bytes.
+
+        :returns: number of entries removed
+        """
+        entries = []
+        for path in self.entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            self._discard(path, damaged=False)
+            total -= size
+            removed += 1
+        return removed
+
+    def verify(self):
+        """Check every entry against its digest and discard the damaged ones.
+
+        :returns: keys of the discarded entries
+        """
+        damaged = []
+        for path in self.entries():
+            key = os.path.splitext(os.path.basename(path))[0]
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                entry = None
+            if not self._intact(key, entry):
+                self._discard(path)
+                damaged.append(key)
+        return damaged
+
+    @staticmethod
+    def _intact(key, entry):
+        return (isinstance(entry, dict) and entry.get('key') == key and 'payload' in entry and
+                entry.get('digest') == _digest(entry['payload']))
+
+    def _discard(self, path, damaged=True):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        if damaged:
+            self.discarded += 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='store directory')
+    parser.add_argument('--verify', action='store_true', help='check every entry and discard the damaged ones')
+    parser.add_argument('--max-bytes', type=int, help='evict least recently used entries down to this size')
+    args = parser.parse_args(argv)
+
+    store = ResultStore(args.directory)
+    if args.verify:
+        damaged = store.verify()
+        for key in damaged:
+            print('Discarded damaged entry {}'.format(key))
+    if args.max_bytes is not None:
+        print('Evicted {} entries'.format(store.evict(args.max_bytes)))
+    print('{} entries, {:.1f} MiB'.format(len(store.entries()), store.size() / 2 ** 20))
+    return 1 if args.verify and damaged else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,397 @@
+"""Declarative scenario files: describe cities, policy schedules, sweeps and outputs instead of editing simulation.py.
+
+A scenario file (TOML or JSON) expands into one job per sweep point and replicate. Jobs whose results are
+already in the results file are skipped, and the rest are dispatched to a pool of worker processes:
+
+    python scenario.py scenarios/city_a_lockdown.toml --workers 4
+    python scenario.py scenarios/city_a_lockdown.toml --dry-run
+
+Top-level keys of a scenario file, see scenarios/city_a_lockdown.toml for a complete example:
+    name, timesteps, replicates, seed
+    [settings]           simulation.py toggles in lower case, see SETTINGS
+    [location_policies]  entries added to or replacing simulation.LOCATION_POLICIES
+    [schedule]           edge_proximity, gamma (infection length in days), lockdown_t0 and migration_t0
+    [sweep]              a list of values for any schedule key; every combination becomes a sweep point
+    [[cities]]           name, width, height, n, health_policy, movement_policy, intent, frequencies and cohorts,
+                         a list of name, share, susceptibility, infectiousness and intent (see cohorts.py)
+    [output]             results (JSON lines file), instrumentation (JSON lines file), plot and series (false
+                         to store only the estimates of estimators.py, not every day's counts)
+"""
+import argparse
+import contextlib
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    tomllib = None
+
+import simulation
+from city import City
+from cohorts import Cohorts
+from CityGraph import CityGraph
+from instrumentation import Instrumentation, JsonLinesSink
+from layouts import LayoutService, generate_layout
+import result_store
+
+# scenario settings and the simulation.py globals they set
+SETTINGS = {
+    'migrate': 'MIGRATE',
+    'social_distancing': 'SOCIAL_DISTANCING',
+    'plot_scatter': 'PLOT_SCATTER',
+    'kernel_backend': 'KERNEL_BACKEND',
+    'contact_engine': 'CONTACT_ENGINE',
+    'early_stop_rt': 'EARLY_STOP_RT',
+    'layouts': 'LAYOUTS',
+}
+DEFAULT_SCHEDULE = {
+    'edge_proximity': 0.2,
+    'gamma': simulation.COVID_Gamma,
+    'lockdown_t0': 15,
+    'migration_t0': 1,
+}
+# City A, as configured in simulation.construct_cities
+DEFAULT_CITY = {
+    'name': 'City A',
+    'width': 200,
+    'height': 200,
+    'n': 600,
+    'health_policy': 'normal',
+    'movement_policy': 'preferential_return',
+    'intent': 'restrict',
+    'frequencies': {'market': 50, 'transit': 200, 'work': 20, 'home': 3},
+    'cohorts': None,
+}
+COHORT_KEYS = {'name', 'share', 'susceptibility', 'infectiousness', 'intent'}
+DEFAULT_OUTPUT = {
+    'results': 'data/scenario_results.jsonl',
+    'instrumentation': None,
+    'plot': False,
+    'series': True,
+}
+TOP_LEVEL_KEYS = {'name', 'timesteps', 'replicates', 'seed', 'settings', 'location_policies', 'schedule', 'sweep',
+                  'cities', 'output'}
+
+
+def load_scenario(path):
+    """Read and validate a scenario file.
+
+    :param str path: .toml or .json file
+    :returns: scenario dict with defaults filled in
+    """
+    if path.endswith('.toml'):
+        if tomllib is None:
+            raise ValueError('Reading {} needs Python 3.11 or later for tomllib; use a JSON scenario'.format(path))
+        with open(path, 'rb') as f:
+            scenario = tomllib.load(f)
+    else:
+        with open(path) as f:
+            scenario = json.load(f)
+    scenario.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    return validate(scenario)
+
+
+def validate(scenario):
+    """Check a scenario for unknown keys and fill in the defaults.
+
+    :raises ValueError: on unknown keys or values
+    """
+    unknown = set(scenario) - TOP_LEVEL_KEYS
+    if unknown:
+        raise ValueError('Unknown scenario keys: {}'.format(', '.join(sorted(unknown))))
+    scenario = dict(scenario)
+    scenario.setdefault('timesteps', 200)
+    scenario.setdefault('replicates', 1)
+    scenario.setdefault('seed', 0)
+
+    settings = scenario.setdefault('settings', {})
+    _check_keys('settings', settings, SETTINGS)
+    schedule = dict(DEFAULT_SCHEDULE, **scenario.get('schedule', {}))
+    _check_keys('schedule', schedule, DEFAULT_SCHEDULE)
+    scenario['schedule'] = schedule
+    sweep = scenario.setdefault('sweep', {})
+    _check_keys('sweep', sweep, DEFAULT_SCHEDULE)
+    for key, values in sweep.items():
+        if not isinstance(values, list) or not values:
+            raise ValueError('sweep.{} must be a non-empty list'.format(key))
+    scenario['output'] = dict(DEFAULT_OUTPUT, **scenario.get('output', {}))
+    _check_keys('output', scenario['output'], DEFAULT_OUTPUT)
+    if scenario['output']['plot'] and not scenario['output']['series']:
+        raise ValueError('output.plot needs output.series')
+
+    location_policies = dict(simulation.LOCATION_POLICIES, **scenario.get('location_policies', {}))
+    scenario['location_policies'] = location_policies
+    cities = [dict(DEFAULT_CITY, **city) for city in scenario.get('cities', [{}])]
+    for city in cities:
+        _check_keys('cities', city, DEFAULT_CITY)
+        if city['intent'] not in location_policies:
+            raise ValueError('City {} has unknown intent {}'.format(city['name'], city['intent']))
+        for cohort in city['cohorts'] or []:
+            _check_keys('cohorts', cohort, COHORT_KEYS)
+            if 'name' not in cohort or 'share' not in cohort:
+                raise ValueError('Every cohort of city {} needs a name and a share'.format(city['name']))
+            if cohort.get('intent') is not None and cohort['intent'] not in location_policies:
+                raise ValueError('Cohort {} of city {} has unknown intent {}'.format(cohort['name'], city['name'],
+                                                                                     cohort['intent']))
+    scenario['cities'] = cities
+    return scenario
+
+
+def _check_keys(section, values, known):
+    unknown = set(values) - set(known)
+    if unknown:
+        raise ValueError('Unknown {} keys: {}'.format(section, ', '.join(sorted(unknown))))
+
+
+def expand_jobs(scenario):
+    """Expand a scenario into one job per sweep point and replicate.
+
+    A job holds everything besides the source code that determines its outcome, so equal jobs have equal keys.
+
+    :param dict scenario: validated scenario
+    :returns: list of job dicts, each with a 'key'
+    """
+    sweep_keys = sorted(scenario['sweep'])
+    jobs = []
+    for values in itertools.product(*[scenario['sweep'][key] for key in sweep_keys]):
+        schedule = dict(scenario['schedule'], **dict(zip(sweep_keys, values)))
+        for replicate in range(scenario['replicates']):
+            job = {
+                'timesteps': scenario['timesteps'],
+                'seed': scenario['seed'] + replicate,
+                'settings': scenario['settings'],
+                'location_policies': scenario['location_policies'],
+                'schedule': schedule,
+                'cities': scenario['cities'],
+            }
+            job['key'] = job_key(job)
+            job['scenario'] = scenario['name']
+            job['replicate'] = replicate
+            jobs.append(job)
+    return jobs
+
+
+def job_key(job):
+    """Hash of everything that determines a job's outcome, including the code version, see result_store.py."""
+    content = {key: value for key, value in job.items() if key not in ('key', 'scenario', 'replicate')}
+    return result_store.config_key(content)
+
+
+def stored_keys(results_path):
+    """Keys of the jobs that already have a result in a results file."""
+    keys = set()
+    if not os.path.exists(results_path):
+        return keys
+    with open(results_path) as f:
+        for line in f:
+            try:
+                keys.add(json.loads(line)['key'])
+            except (ValueError, KeyError):
+                continue  # a line cut short by an interrupted run
+    return keys
+
+
+def pending_jobs(jobs, done):
+    """Drop jobs that are already done or that repeat an earlier job.
+
+    :param list[dict] jobs: expanded jobs
+    :param set done: keys of stored results
+    """
+    pending = []
+    seen = set(done)
+    for job in jobs:
+        if job['key'] not in seen:
+            seen.add(job['key'])
+            pending.append(job)
+    return pending
+
+
+@contextlib.contextmanager
+def simulation_settings(settings, location_policies):
+    """Apply a job's settings to the simulation module for the duration of the context."""
+    names = [SETTINGS[key] for key in settings] + ['LOCATION_POLICIES']
+    saved = {name: getattr(simulation, name) for name in names}
+    try:
+        for key, value in settings.items():
+            setattr(simulation, SETTINGS[key], value)
+        simulation.LOCATION_POLICIES = dict(location_policies)
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(simulation, name, value)
+
+
+def layout_specs(job):
+    """Arguments of layouts.generate_layout for every city of a job, seeded by the job's seed and the city."""
+    return [{'width': spec['width'], 'height': spec['height'], 'n': spec['n'], 'frequencies': dict(spec['frequencies']),
+             'seed': [job['seed'], index]} for index, spec in enumerate(job['cities'])]
+
+
+def uses_layouts(job):
+    return bool(job['settings'].get('layouts'))
+
+
+def build_cities(job, layouts=None):
+    """Construct the cities of a job, as simulation.construct_cities does for the hard-coded ones.
+
+    :param list[layouts.Layout] layouts: layout of every city when the job's settings ask for layouts; built here
+        if not given
+    """
+    schedule = job['schedule']
+    if uses_layouts(job) and layouts is None:
+        layouts = [generate_layout(**spec) for spec in layout_specs(job)]
+    cities = []
+    for index, spec in enumerate(job['cities']):
+        location_policies_dict = simulation.construct_location_policies_dict(spec['intent'], job['timesteps'],
+                                                                             schedule['lockdown_t0'])
+        cohorts = Cohorts.from_shares(spec['n'], spec['cohorts']) if spec['cohorts'] else None
+        city = City(spec['name'], spec['width'], spec['height'], spec['n'], schedule['edge_proximity'],
+                    1.0 / schedule['gamma'], spec['health_policy'], [spec['movement_policy'], location_policies_dict],
+                    dict(spec['frequencies']), backend=simulation.KERNEL_BACKEND,
+                    contact_engine=simulation.CONTACT_ENGINE, cohorts=cohorts,
+                    layout=layouts[index] if layouts is not None else None)
+        # the schedules the cohorts follow besides the city's own
+        for intent in set(city.cohorts.intents) - {None}:
+            simulation.construct_location_policies_dict(intent, job['timesteps'], schedule['lockdown_t0'])
+        cities.append(city)
+    for city in cities:
+        city.view_all_policies(simulation.POLICIES)
+    return cities
+
+
+def run_job(job, instrumentation_file=None, plot=False, quiet=False, series=True):
+    """Run one job.
+
+    :param dict job: job from expand_jobs
+    :param str instrumentation_file: JSON lines file for the per-day instrumentation records, if given
+    :param bool plot: also plot each city's curves, as setup_and_run does
+    :param bool quiet: silence the per-day output
+    :param bool series: keep the betas and time series; otherwise only the estimates are returned
+    :returns: result dict with per-city i_max, timestep_of_convergence, estimates, betas and time series
+    """
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if quiet:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+        stack.enter_context(simulation_settings(job['settings'], job['location_policies']))
+        random.seed(job['seed'])
+        np.random.seed(job['seed'])
+        schedule = job['schedule']
+        cities = build_cities(job, job.get('layouts'))
+        if instrumentation_file:
+            simulation.instrument_cities(cities, Instrumentation(sink=JsonLinesSink(instrumentation_file)),
+                                         key=job['key'], **schedule)
+        for city in cities:
+            city.set_initial_states()
+        city_graphs = [CityGraph(city, keep_series=series) for city in cities]
+        simulation.run_timesteps(cities, city_graphs, 0, job['timesteps'], schedule['edge_proximity'],
+                                 schedule['migration_t0'], schedule['lockdown_t0'])
+        if plot:
+            simulation.collect_i_max(city_graphs)
+
+    return {
+        'key': job['key'],
+        'scenario': job['scenario'],
+        'schedule': job['schedule'],
+        'seed': job['seed'],
+        'replicate': job['replicate'],
+        'cities': simulation.summarize_city_graphs(city_graphs),
+        'wall_time': time.perf_counter() - start,
+    }
+
+
+def with_layouts(jobs, service):
+    """Yield every job, with the layouts of its cities from the layout service if its settings ask for them."""
+    specs = (spec for job in jobs if uses_layouts(job) for spec in layout_specs(job))
+    built = service.layouts(specs)
+    for job in jobs:
+        if uses_layouts(job):
+            job = dict(job, layouts=[next(built) for _ in job['cities']])
+        yield job
+
+
+def run_jobs(jobs, results_path, workers=1, instrumentation_file=None, plot=False, quiet=False, series=True,
+             layout_workers=1):
+    """Run jobs in worker processes, appending every result to the results file as soon as it is done.
+
+    Results are written as they arrive, so an interrupted sweep resumes where it stopped. Jobs with the layouts
+    setting get their city layouts from a pool of layout_workers processes that builds them ahead of the jobs.
+
+    :param list[dict] jobs: jobs to run
+    :param str results_path: JSON lines results file
+    :param int workers: number of worker processes; 1 runs the jobs in this process
+    :param int layout_workers: number of processes building layouts; 0 builds them in the job's process
+    :returns: list of results in completion order
+    """
+    run = functools.partial(run_job, instrumentation_file=instrumentation_file, plot=plot, quiet=quiet,
+                            series=series)
+    directory = os.path.dirname(results_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    results = []
+    with contextlib.ExitStack() as stack:
+        tasks = jobs
+        if layout_workers > 0 and any(uses_layouts(job) for job in jobs):
+            # a generator, so that jobs start as soon as their own layouts are built
+            tasks = with_layouts(jobs, stack.enter_context(LayoutService(layout_workers)))
+        if workers > 1:
+            pool = stack.enter_context(multiprocessing.Pool(workers))
+            completed = pool.imap_unordered(run, tasks)
+        else:
+            completed = map(run, tasks)
+        f = stack.enter_context(open(results_path, 'a'))
+        for result in completed:
+            f.write(json.dumps(result) + '\n')
+            f.flush()
+            results.append(result)
+            cities = ', '.join('{} i_max {}'.format(name, city['i_max']) for name, city in result['cities'].items())
+            print('[{}/{}] {} seed {}: {} ({:.1f}s)'.format(len(results), len(jobs), result['key'][:12],
+                                                          result['seed'], cities, result['wall_time']))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenario', help='scenario file (.toml or .json)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--results', help='results file, overriding output.results of the scenario')
+    parser.add_argument('--dry-run', action='store_true', help='only list the jobs that would run')
+    parser.add_argument('--force', action='store_true', help='run jobs again even if their results are stored')
+    parser.add_argument('--quiet', action='store_true', help='silence the per-day output of the jobs')
+    parser.add_argument('--layout-workers', type=int, default=1,
+                        help='processes building city layouts ahead of the jobs, with settings.layouts')
+    args = parser.parse_args(argv)
+
+    try:
+        scenario = load_scenario(args.scenario)
+    except ValueError as e:
+        parser.error(str(e))
+    output = scenario['output']
+    results_path = args.results or output['results']
+    jobs = expand_jobs(scenario)
+    done = set() if args.force else stored_keys(results_path)
+    pending = pending_jobs(jobs, done)
+    print('{}: {} jobs, {} already stored or repeated, {} to run'.format(scenario['name'], len(jobs), len(jobs) - len(pending),
+                                                             len(pending)))
+    if args.dry_run:
+        for job in pending:
+            print('{} seed {} {}'.format(job['key'][:12], job['seed'], json.dumps(job['schedule'], sort_keys=True)))
+        return 0
+    if pending:
+        run_jobs(pending, results_path, workers=min(args.workers, len(pending)),
+                 instrumentation_file=output['instrumentation'], plot=output['plot'], quiet=args.quiet,
+                 series=output['series'], layout_workers=args.layout_workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
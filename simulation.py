@@ -7,12 +7,19 @@ Created on Wed Apr 29 10:25:20 2020
 
 from city import *
 from CityGraph import *
-from scipy import special
+from instrumentation import Instrumentation, JsonLinesSink, fan_out
+import layouts
+from progress import SweepProgress
+import render
+import replicates
+import result_store
+from snapshots import SnapshotReader, SnapshotWriter
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
 
+import copy
+import os
 import sys
+import time
 
 GAMMAS = np.linspace(1.0, 20.0, num=20)  # infection length (days)
 EDGE_PROXIMITIES = np.linspace(0.01, 1.0, num=100)  # proxy for infectivity
@@ -33,8 +40,43 @@ migration_prob = (1/100.0)
 # migration probability (p) in each city m=p*N will be number of citizens that move from city A to B
 MIGRATE = False
 SOCIAL_DISTANCING = False
+# keep a snapshot of every agent each day and draw them as plots/<city><day>.png after the run, with
+# RENDER_WORKERS processes; SCATTER_ANIMATION 'gif' or 'mp4' also writes plots/<city>.<format>
 PLOT_SCATTER = False
+RENDER_WORKERS = 1
+SCATTER_ANIMATION = None
+# stream every agent's position, state and mode each day of setup_and_run to a snapshot store (see snapshots.py)
+# in a directory of its own under SNAPSHOT_DIR; 'raw' chunks can be memory-mapped, 'zlib' ones take less space
+SNAPSHOT_DIR = None
+SNAPSHOT_CODEC = 'zlib'
+# stop a run once every city's peak is a week behind and its effective reproduction number Rt is below this;
+# the final size is then that of the last simulated day
+EARLY_STOP_RT = None
+# 'python' moves and infects agents one by one; 'numpy', 'numba' or 'auto' use the array kernels in kernels.py
+KERNEL_BACKEND = 'python'
+# how cities find contacts, see contacts.get_engine; 'auto' groups preferential return agents by central location
+CONTACT_ENGINE = 'auto'
+# lay cities out with layouts.py, assigning agents to their nearest central locations with a k-d tree, instead of
+# with shapely Voronoi polygons; scenario.py builds these layouts in worker processes ahead of the runs
+LAYOUTS = False
 NRUNS = 5
+# step all NRUNS replicates together as one array program (see replicates.py) instead of one after another
+BATCH_REPLICATES = False
+# append per-day phase timings, counters and memory of every city to this JSON lines file
+INSTRUMENTATION_FILE = None
+# report completed runs, runs/sec, ETA and the in-flight timestep in a rolling JSON file and/or
+# in Prometheus text format on http://127.0.0.1:PROGRESS_PORT/metrics
+PROGRESS_FILE = None
+PROGRESS_PORT = None
+# simulate the lax days before each lockdown_t0 once and fork them into every intent below
+FORK_LOCKDOWN_SWEEP = False
+LOCKDOWN_INTENTS = ['tight', 'stay_at_home', 'lockdown', 'restrict']
+# seed run i of NRUNS with SEED + i; None leaves the random generators unseeded
+SEED = None
+# directory of a result store (see result_store.py) from which seeded runs with the same configuration and code
+# are answered instead of simulated again, bounded to RESULT_STORE_MAX_BYTES if set
+RESULT_STORE = None
+RESULT_STORE_MAX_BYTES = None
 
 
 def main():
@@ -49,12 +91,60 @@ def main():
         fn.close()
     '''
     timesteps = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    if FORK_LOCKDOWN_SWEEP and not DO_PARAMETER_SWEEP:
+        total_runs = NRUNS
+    elif DO_PARAMETER_SWEEP:
+        total_runs = len(lockdown_t0s) * len(EDGE_PROXIMITIES) * len(GAMMAS)
+    elif BATCH_REPLICATES:
+        total_runs = len(lockdown_t0s)
+    else:
+        total_runs = len(lockdown_t0s) * NRUNS
+    sinks = []
+    progress = None
+    if PROGRESS_FILE or PROGRESS_PORT is not None:
+        progress = SweepProgress(total_runs, status_file=PROGRESS_FILE, port=PROGRESS_PORT)
+        sinks.append(progress.observe)
+    if INSTRUMENTATION_FILE:
+        sinks.append(JsonLinesSink(INSTRUMENTATION_FILE))
+    instrumentation = Instrumentation(sink=fan_out(sinks)) if sinks else None
+
+    try:
+        run_experiments(timesteps, migration_t0, lockdown_t0s, instrumentation, progress)
+    finally:
+        if progress is not None:
+            progress.close()
+
+
+def run_experiments(timesteps, migration_t0, lockdown_t0s, instrumentation, progress):
+    """Run the experiments selected by the module settings, reporting each run to progress if given."""
+    if FORK_LOCKDOWN_SWEEP and not DO_PARAMETER_SWEEP:
+        for i in range(NRUNS):
+            results = tracked_run(progress, i, setup_and_run_forked, timesteps, 0.2, COVID_Gamma, migration_t0,
+                                  lockdown_t0s, LOCKDOWN_INTENTS, instrumentation=instrumentation)
+            for (t, intent), i_max in sorted(results.items()):
+                datafile = 'data/imax{}_{}.dat'.format(t, intent)
+                with open(datafile, 'a+') as fn:
+                    fn.write("{}\t{}\n".format(i, i_max[0]))
+        return
+    run_id = 0
     for t in lockdown_t0s:
         lockdown_t0 = t
         if DO_PARAMETER_SWEEP:
             for edge_proximity in EDGE_PROXIMITIES:
                 for gamma in GAMMAS:
-                    setup_and_run(timesteps, edge_proximity, gamma, migration_t0, lockdown_t0)
+                    tracked_run(progress, run_id, setup_and_run, timesteps, edge_proximity, gamma, migration_t0,
+                                lockdown_t0, instrumentation=instrumentation, seed=SEED)
+                    run_id += 1
+        elif BATCH_REPLICATES:
+            results = tracked_run(progress, run_id, setup_and_run_replicates, NRUNS, timesteps, 0.2, COVID_Gamma,
+                                  lockdown_t0, backend=KERNEL_BACKEND, seed=SEED)
+            run_id += 1
+            datafile = 'data/imax{}.dat'.format(t)
+            with open(datafile, 'a+') as fn:
+                for i, result in enumerate(results[0]):
+                    fn.write("{}\t{}\n".format(i, result['i_max']))
+            print([result['i_max'] for result in results[0]])
+            print('i_max mean {:.1f}, 95% CI [{:.1f}, {:.1f}]'.format(*replicates.summarize(results[0])))
         else:
             nruns = NRUNS
             #imax = np.zeros((2,nruns))                                #ADD number of cities to first index of array
@@ -62,7 +152,10 @@ def main():
             fn = open(datafile, 'a+')
             imaxs = []
             for i in range(nruns):  
-                i_max = setup_and_run(timesteps, 0.2, COVID_Gamma, migration_t0, lockdown_t0)
+                i_max = tracked_run(progress, run_id, setup_and_run, timesteps, 0.2, COVID_Gamma, migration_t0,
+                                    lockdown_t0, instrumentation=instrumentation,
+                                    seed=SEED + i if SEED is not None else None)
+                run_id += 1
                 #  print(Imax)
                 imaxs.append(i_max[0])
                 #  imaxs[:][i]=i_max[:]
@@ -74,60 +167,327 @@ def main():
     #print(np.mean(imaxs[0][:]), np.mean(imaxs[1][:]))
 
 
-def setup_and_run(timesteps, edge_proximity, gamma, migration_threshold, lockdown_threshold):
+def tracked_run(progress, run_id, run, *args, **kwargs):
+    """Call run(*args, **kwargs), reporting its start and end to progress if given."""
+    if progress is None:
+        return run(*args, **kwargs)
+    progress.run_started(run_id, args=[str(arg) for arg in args])
+    try:
+        result = run(*args, **kwargs)
+    except BaseException:
+        progress.run_finished(failed=True)
+        raise
+    progress.run_finished()
+    return result
+
+
+def setup_and_run(timesteps, edge_proximity, gamma, migration_threshold, lockdown_threshold, instrumentation=None,
+                  seed=None):
     """Initialize the simulation.
 
+    A seeded run whose result is in the RESULT_STORE returns it without simulating anything.
+
     :param timesteps: number of timesteps to run the simulation
     :param edge_proximity: edge proximity parameter (proxy for infection rate)
     :param gamma: gamma parameter (proxy for recovery rate)
     :param migration_threshold: timestep in which migration occurs, if enabled
     :param lockdown_threshold: timestep at which lockdown occurs, if enabled
+    :param instrumentation.Instrumentation instrumentation: receives per-day metrics of every city, if given
+    :param int seed: seed for both random number generators; None leaves them as they are
     """
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+
+    store = None
+    if RESULT_STORE is not None and seed is not None:
+        store = result_store.ResultStore(RESULT_STORE, max_bytes=RESULT_STORE_MAX_BYTES)
+        key = result_store.config_key(run_config(timesteps, edge_proximity, gamma, migration_threshold,
+                                                 lockdown_threshold, seed))
+        stored = store.get(key)
+        if stored is not None:
+            print('Using the stored result {}'.format(key[:12]))
+            i_max = [city['i_max'] for city in stored['cities'].values()]
+            print(i_max)
+            return i_max
     cities = construct_cities(edge_proximity, gamma, timesteps, lockdown_threshold)
+    instrument_cities(cities, instrumentation, edge_proximity=edge_proximity, gamma=gamma,
+                      lockdown_threshold=lockdown_threshold)
 
     for city_i in cities:
         city_i.set_initial_states()
     city_graphs = []
     for city_i in cities:
         city_graphs.append(CityGraph(city_i))
-    for i in range(0, timesteps):
+    if SNAPSHOT_DIR is not None:
+        for cg in city_graphs:
+            cg.snapshot_writer = SnapshotWriter(snapshot_directory(cg.name, seed), cg.N, codec=SNAPSHOT_CODEC)
+    try:
+        run_timesteps(cities, city_graphs, 0, timesteps, edge_proximity, migration_threshold, lockdown_threshold)
+    finally:
+        for cg in city_graphs:
+            if cg.snapshot_writer is not None:
+                cg.snapshot_writer.close()
+    i_max = collect_i_max(city_graphs)
+    if store is not None:
+        store.put(key, {'cities': summarize_city_graphs(city_graphs)})
+    return i_max
+
+
+def snapshot_directory(city_name, seed=None):
+    """A new directory under SNAPSHOT_DIR for the snapshots of one city."""
+    name = '{}-{}'.format(city_name.replace(' ', '_'), time.strftime('%Y%m%d-%H%M%S'))
+    if seed is not None:
+        name += '-seed{}'.format(seed)
+    path = os.path.join(SNAPSHOT_DIR, name)
+    suffix = 1
+    while os.path.exists(path):
+        path = os.path.join(SNAPSHOT_DIR, '{}-{}'.format(name, suffix))
+        suffix += 1
+    return path
+
+
+def run_config(timesteps, edge_proximity, gamma, migration_threshold, lockdown_threshold, seed):
+    """Everything besides the source code that determines the outcome of setup_and_run.
+
+    The cities are described by the arguments construct_cities would build them with, so that a stored run is
+    found without building any.
+    """
+    return {
+        'timesteps': timesteps,
+        'edge_proximity': float(edge_proximity),
+        'gamma': float(gamma),
+        'migration_threshold': migration_threshold,
+        'lockdown_threshold': lockdown_threshold,
+        'seed': seed,
+        'settings': {
+            'MIGRATE': MIGRATE,
+            'SOCIAL_DISTANCING': SOCIAL_DISTANCING,
+            'KERNEL_BACKEND': KERNEL_BACKEND,
+            'CONTACT_ENGINE': CONTACT_ENGINE,
+            'EARLY_STOP_RT': EARLY_STOP_RT,
+            'LAYOUTS': LAYOUTS,
+            # the schedules of cohorts that move by an intent of their own
+            'LOCATION_POLICIES': LOCATION_POLICIES,
+            'migration_prob': migration_prob,
+        },
+        'cities': [city_config(spec) for spec in city_specs(edge_proximity, gamma, timesteps, lockdown_threshold)],
+    }
+
+
+def city_config(spec):
+    """A JSON-serializable description of a city from city_specs, its movement schedule included."""
+    movement_policy, schedule = spec['mpolicy']
+    return {
+        'name': spec['name'],
+        'width': spec['x'],
+        'height': spec['y'],
+        'n': spec['n'],
+        'edge_proximity': float(spec['edge_proximity']),
+        'gamma': float(spec['gamma']),
+        'health_policy': spec['hpolicy'],
+        'movement_policy': movement_policy,
+        'schedule': [schedule[i] for i in sorted(schedule)],
+        'frequencies': spec['frequencies_dict'],
+        'backend': spec.get('backend', 'python'),
+        'contact_engine': spec.get('contact_engine', 'auto'),
+    }
+
+
+def setup_and_run_forked(timesteps, edge_proximity, gamma, migration_threshold, lockdown_thresholds, intents,
+                         instrumentation=None):
+    """Run one lockdown experiment per (lockdown_t0, intent) pair, sharing the pre-lockdown days.
+
+    Every schedule built by construct_location_policies_dict is 'lax' before its lockdown_t0, so the
+    cities are simulated once under the lax schedule and forked at each lockdown_t0. Each fork continues
+    under its own intent while the lax base keeps running to the next lockdown_t0.
+
+    :param timesteps: number of timesteps to run each experiment
+    :param edge_proximity: edge proximity parameter (proxy for infection rate)
+    :param gamma: gamma parameter (proxy for recovery rate)
+    :param migration_threshold: timestep in which migration occurs, if enabled
+    :param list[int] lockdown_thresholds: timesteps at which lockdown occurs
+    :param list[str] intents: keys of LOCATION_POLICIES to fork into at each lockdown threshold
+    :param instrumentation.Instrumentation instrumentation: receives per-day metrics of every city, if given
+    :returns: dict mapping (lockdown_threshold, intent) to the i_max list of that experiment
+    """
+    # a lockdown at t >= timesteps never happens, so the base schedule stays lax throughout
+    cities = construct_cities(edge_proximity, gamma, timesteps, timesteps)
+    instrument_cities(cities, instrumentation, edge_proximity=edge_proximity, gamma=gamma)
+    for city_i in cities:
+        city_i.set_initial_states()
+    city_graphs = [CityGraph(city_i) for city_i in cities]
+
+    results = {}
+    day = 0
+    finished = False
+    for lockdown_threshold in sorted(set(lockdown_thresholds)):
+        if not finished and lockdown_threshold > day:
+            if instrumentation is not None:
+                instrumentation.context.update(lockdown_threshold=None, intent=None)
+            finished = run_timesteps(cities, city_graphs, day, lockdown_threshold, edge_proximity,
+                                     migration_threshold, lockdown_threshold)
+            day = lockdown_threshold
+        for intent in intents:
+            print('Forking at day {} into {} lockdown'.format(day, intent))
+            forked_cities, forked_graphs = fork_cities(cities, city_graphs)
+            location_policies_dict = construct_location_policies_dict(intent, timesteps, lockdown_threshold)
+            for city_i in forked_cities:
+                city_i.policy.update(location_policies_dict)
+            if instrumentation is not None:
+                instrumentation.context.update(lockdown_threshold=lockdown_threshold, intent=intent)
+            if not finished:
+                run_timesteps(forked_cities, forked_graphs, day, timesteps, edge_proximity,
+                              migration_threshold, lockdown_threshold)
+            results[(lockdown_threshold, intent)] = collect_i_max(forked_graphs)
+    return results
+
+
+def setup_and_run_replicates(nreplicates, timesteps, edge_proximity, gamma, lockdown_threshold, backend='auto',
+                             seed=None):
+    """Run nreplicates replicates of every city in construct_cities as one batched array program.
+
+    Each replicate gets its own city layout and patient zero; the timesteps of all replicates of a city
+    are then vectorized together. Migration and social distancing are not supported in a batch, and neither is the
+    'python' backend.
+
+    :param int nreplicates: number of replicates per city
+    :param timesteps: maximum number of timesteps per replicate
+    :param edge_proximity: edge proximity parameter (proxy for infection rate)
+    :param gamma: gamma parameter (proxy for recovery rate)
+    :param lockdown_threshold: timestep at which lockdown occurs
+    :param str backend: kernel backend, see kernels.get_backend
+    :param int seed: seed for both random number generators; None leaves them as they are
+    :returns: one list of per-replicate results (see replicates.ReplicateBatch.run) per city
+    """
+    unsupported = [name for name, enabled in [('MIGRATE', MIGRATE), ('SOCIAL_DISTANCING', SOCIAL_DISTANCING)]
+                   if enabled]
+    if unsupported:
+        raise ValueError('BATCH_REPLICATES does not support {}'.format(', '.join(unsupported)))
+    if backend == 'python':
+        raise ValueError("BATCH_REPLICATES needs an array KERNEL_BACKEND ('numpy', 'numba' or 'auto'), not 'python'")
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+
+    replicate_cities = []
+    for r in range(nreplicates):
+        cities = construct_cities(edge_proximity, gamma, timesteps, lockdown_threshold)
+        for city_i in cities:
+            city_i.set_initial_states()
+        replicate_cities.append(cities)
+
+    results = []
+    for city_replicates in zip(*replicate_cities):
+        print('Running {} replicates of {}'.format(nreplicates, city_replicates[0].name))
+        batch = replicates.ReplicateBatch(list(city_replicates), backend=backend)
+        results.append(batch.run(timesteps))
+    return results
+
+
+def fork_cities(cities, city_graphs):
+    """Copy the full simulation state so that a copy can continue independently of the original.
+
+    Past contact edges are history that neither copy mutates again, so the copies share those arrays
+    instead of duplicating them.
+
+    :param list[City] cities: cities to copy
+    :param list[CityGraph] city_graphs: graphs recording the cities' history
+    :returns: tuple of copied cities and copied city graphs
+    """
+    memo = {}
+    for city_i in cities:
+        memo[id(city_i.instrumentation)] = city_i.instrumentation
+        memo[id(city_i.past_edges)] = list(city_i.past_edges)
+    return copy.deepcopy((cities, city_graphs), memo)
+
+
+def instrument_cities(cities, instrumentation, **context):
+    """Attach instrumentation to every city, labelling its records with the run parameters in context."""
+    if instrumentation is None:
+        return
+    instrumentation.context = context
+    for city_i in cities:
+        city_i.instrument(instrumentation)
+
+
+def run_timesteps(cities, city_graphs, start, stop, edge_proximity, migration_threshold, lockdown_threshold):
+    """Advance the cities from timestep start up to (not including) timestep stop.
+
+    :returns: True if all agents are free of infection
+    """
+    for i in range(start, stop):
         for city_i, city_graph in zip(cities, city_graphs):
             if SOCIAL_DISTANCING:
                 if i > lockdown_threshold:
                     city_i.change_proximity(edge_proximity*0.5)
-            city_graph.xs.append(i)
             print('Day {} - {}'.format(i, city_i.name))
             beta = city_i.timestep(i) / city_i.N
             if MIGRATE:
                 if i < migration_threshold:
                     migration(cities)
 
-            city_graph.set_beta(beta)
-            state_dict = city_i.get_states()
-            if state_dict['total_IR'] == city_i.N:
-                if not city_graph.timestep_of_convergence:
-                    city_graph.timestep_of_convergence = i
-
-            city_graph.ys.append(state_dict)
+            city_graph.record(i, city_i.get_states(), beta)
             city_i.print_states()
-            if PLOT_SCATTER:
-                city_i.plot_scatter(i)
+            if city_graph.snapshot_writer is not None:
+                city_graph.snapshot_writer.append(city_i.snapshot(i))
+            elif PLOT_SCATTER:
+                city_graph.snapshots.append(city_i.snapshot(i))
         finished_cities = []
         for city in cities:
             if city.num_infected == 0:
                 finished_cities.append(city)
         if len(finished_cities) == len(cities):
             print('All agents are free of infection.')
+            return True
+        if EARLY_STOP_RT is not None and all(cg.estimators.settled(EARLY_STOP_RT) for cg in city_graphs):
+            print('Stopping early, Rt is below {} in every city and the peaks have passed.'.format(EARLY_STOP_RT))
+            return True
+    return False
+
+
+def summarize_city_graphs(city_graphs):
+    """Peak number of infected agents, day of convergence, estimates, betas and S, I, R time series of every city.
 
-            break
+    Betas and time series are left out of cities whose CityGraph does not keep them.
 
+    :returns: dict keyed by city name
+    """
+    summary = {}
+    for cg in city_graphs:
+        summary[cg.name] = {
+            'i_max': cg.estimators.i_max,
+            'timestep_of_convergence': cg.timestep_of_convergence,
+            'estimates': cg.estimators.summary(),
+        }
+        if cg.keep_series:
+            summary[cg.name]['betas'] = cg.betas
+            summary[cg.name]['series'] = {key: [state[key] for state in cg.ys]
+                                          for key in ['susceptible', 'infected', 'removed', 'total_IR', 'quarantined']}
+    return summary
+
+
+def collect_i_max(city_graphs):
+    """Plot each city's curves and scatter snapshots and return the peak number of infected agents per city.
+
+    Cities whose CityGraph does not keep its time series have no curves to plot; their peak comes from the estimators.
+    """
     i_max = []
 
     for cg in city_graphs:
-        cg.total_infected = cg.ys[len(cg.xs)-1]['total_IR']
-        infected = cg.plot_data()
-        i_max.append(infected)
-        cg.plot_ro()
+        cg.total_infected = cg.estimators.final_size
+        if cg.keep_series:
+            i_max.append(cg.plot_data())
+            cg.plot_ro()
+        else:
+            i_max.append(cg.estimators.i_max)
+        snapshots = cg.snapshots
+        if cg.snapshot_writer is not None:
+            snapshots = SnapshotReader(cg.snapshot_writer.directory)
+        if PLOT_SCATTER and len(snapshots):
+            render.render_frames(snapshots, 'plots', cg.name, workers=RENDER_WORKERS, dpi=300)
+            if SCATTER_ANIMATION:
+                render.write_animation(snapshots, 'plots/{}.{}'.format(cg.name, SCATTER_ANIMATION))
     print(i_max)
     return i_max
 
@@ -140,6 +500,26 @@ def construct_cities(edge_proximity, gamma_denom, timesteps, lockdown_threshold)
     :param int timesteps
     :param int lockdown_threshold: num timesteps at which to initiate lockdown
     :returns: list of city objects"""
+    cities = []
+    for spec in city_specs(edge_proximity, gamma_denom, timesteps, lockdown_threshold):
+        layout = None
+        if LAYOUTS:
+            layout = layouts.generate_layout(spec['x'], spec['y'], spec['n'], spec['frequencies_dict'],
+                                             np.random.randint(2 ** 31))
+        cities.append(City(layout=layout, **spec))
+    for city_i in cities:
+        city_i.view_all_policies(POLICIES)
+    return cities
+
+
+def city_specs(edge_proximity, gamma_denom, timesteps, lockdown_threshold):
+    """The arguments of every City that construct_cities builds, without building any.
+
+    :param float edge_proximity: experimental edge_proximity value
+    :param float gamma_denom: gamma denominator
+    :param int timesteps
+    :param int lockdown_threshold: num timesteps at which to initiate lockdown
+    :returns: list of dicts of City keyword arguments"""
 
     # TODO: different Ro for different cities, based on data?
     gamma = 1.0 / gamma_denom
@@ -178,20 +558,18 @@ def construct_cities(edge_proximity, gamma_denom, timesteps, lockdown_threshold)
 
     hpolicy_a = 'social_distancing'
     hpolicy_b = 'normal'
-    cities = [
-              # City('Boulder', ws[0], hs[0], ns[1], edge_proximity, gamma, hpolicy_b, mpolicy_d,
-              #     frequencies_dict_a),
-              # City('Denver', ws[1], hs[1], ns[1], edge_proximity, gamma, hpolicy_b, mpolicy_b,
-              #     frequencies_dict_a),
-              # City(name='Quarantinopolis', x=ws[1], y=hs[1], n=ns[1], edge_proximity=edge_proximity,
-              #      gamma=gamma, hpolicy=hpolicy_b, mpolicy=mpolicy_c),
-              # City(name='EssentialWorkerOpolis', x=ws[1], y=hs[1], n=ns[1], edge_proximity=edge_proximity,
-              #      gamma=gamma, hpolicy=hpolicy_b, mpolicy=mpolicy_d),
-              City('City A', ws[0], hs[0], ns[0], edge_proximity, gamma, hpolicy_b, mpolicy_e,
-                   frequencies_dict_b)]
-    for city_i in cities:
-        city_i.view_all_policies(POLICIES)
-    return cities
+    return [
+            # dict(name='Boulder', x=ws[0], y=hs[0], n=ns[1], edge_proximity=edge_proximity, gamma=gamma,
+            #      hpolicy=hpolicy_b, mpolicy=mpolicy_d, frequencies_dict=frequencies_dict_a),
+            # dict(name='Denver', x=ws[1], y=hs[1], n=ns[1], edge_proximity=edge_proximity, gamma=gamma,
+            #      hpolicy=hpolicy_b, mpolicy=mpolicy_b, frequencies_dict=frequencies_dict_a),
+            # dict(name='Quarantinopolis', x=ws[1], y=hs[1], n=ns[1], edge_proximity=edge_proximity, gamma=gamma,
+            #      hpolicy=hpolicy_b, mpolicy=mpolicy_c),
+            # dict(name='EssentialWorkerOpolis', x=ws[1], y=hs[1], n=ns[1], edge_proximity=edge_proximity,
+            #      gamma=gamma, hpolicy=hpolicy_b, mpolicy=mpolicy_d),
+            dict(name='City A', x=ws[0], y=hs[0], n=ns[0], edge_proximity=edge_proximity, gamma=gamma,
+                 hpolicy=hpolicy_b, mpolicy=mpolicy_e, frequencies_dict=frequencies_dict_b, backend=KERNEL_BACKEND,
+                 contact_engine=CONTACT_ENGINE)]
 
 
 def construct_location_policies_dict(intent, timesteps,t0):
@@ -247,8 +625,9 @@ def shuffle(source_city, target_city, agent0, agent1):
         '''
         Sending migrant individuals to around their home location
         '''
-        m.positionx = list(m.personal_central_locations['home'])[0] + np.random.normal(-0.5, 0.5)
-        m.positiony = list(m.personal_central_locations['home'])[1] + np.random.normal(-0.5, 0.5)
+        home_x, home_y = m.city.central_location(m.number, 'home')
+        m.positionx = home_x + np.random.normal(-0.5, 0.5)
+        m.positiony = home_y + np.random.normal(-0.5, 0.5)
 
         if m.state == "susceptible":
             cty.num_susceptible += 1
@@ -263,15 +642,12 @@ def shuffle_central_locations(agent0, agent1):
     Brute Forced through the shuffling
     TODO: Make the shuffling code more elegant
     '''
-    migrating_agents = [agent0, agent1]
     modes = ['market', 'home', 'work', 'transit']
     for mode in modes:
-        m0x = list(agent0.personal_central_locations[mode])[0]
-        m0y = list(agent0.personal_central_locations[mode])[1]
-        m1x = list(agent1.personal_central_locations[mode])[0]
-        m1y = list(agent1.personal_central_locations[mode])[1]
-        agent0.personal_central_locations[mode] = [m1x, m1y]
-        agent1.personal_central_locations[mode] = [m0x, m0y]
+        m0x, m0y = agent0.city.central_location(agent0.number, mode)
+        m1x, m1y = agent1.city.central_location(agent1.number, mode)
+        agent0.city.set_central_location(agent0.number, mode, m1x, m1y)
+        agent1.city.set_central_location(agent1.number, mode, m0x, m0y)
 
 
 if __name__ == "__main__":
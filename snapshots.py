@@ -0,0 +1,252 @@
+"""On-disk stream of per-day agent snapshots for replay and analysis.
+
+A snapshot store is a directory holding meta.json and, for every field of City.snapshot, one file per chunk of
+days, each a (days, agents) array. With the 'raw' codec the chunk files are .npy files that are memory-mapped
+when read; with 'zlib' they are compressed and decompressed a chunk at a time. Snapshots are handed to a
+background thread that encodes and writes full chunks, so the simulation only pays for copying them.
+
+    writer = SnapshotWriter('data/snapshots/run', city.N)
+    for i in range(timesteps):
+        city.timestep(i)
+        writer.append(city.snapshot(i))
+    writer.close()
+
+    reader = SnapshotReader('data/snapshots/run')
+    xs = reader.read('xs', days=slice(10, 20), agents=slice(0, 1000))
+"""
+import json
+import os
+import queue
+import threading
+import zlib
+
+import numpy as np
+
+FIELDS = {'xs': np.float32, 'ys': np.float32, 'states': np.int8, 'modes': np.int8}
+CODECS = ['zlib', 'raw']
+META_FILE = 'meta.json'
+
+
+def _chunk_path(directory, field, chunk, codec):
+    return os.path.join(directory, '{}_{:05d}.{}'.format(field, chunk, 'npy' if codec == 'raw' else 'z'))
+
+
+class SnapshotWriter:
+    def __init__(self, directory, n_agents, chunk_days=32, codec='zlib', level=1):
+        '''Writes consecutive daily snapshots of one city to a snapshot store.
+
+        :param str directory: store directory, created if missing; must not hold a store already
+        :param int n_agents: number of agents in every snapshot
+        :param int chunk_days: days per chunk file
+        :param str codec: 'zlib' to compress chunks, 'raw' for memory-mappable .npy chunks
+        :param int level: zlib compression level
+        '''
+        if codec not in CODECS:
+            raise ValueError('Unknown snapshot codec {}, choose from {}'.format(codec, CODECS))
+        if os.path.exists(os.path.join(directory, META_FILE)):
+            raise ValueError('{} already holds snapshots'.format(directory))
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.n_agents = n_agents
+        self.chunk_days = chunk_days
+        self.codec = codec
+        self.level = level
+        self.first_day = None
+        self.days = 0
+        self.chunk_lengths = []
+        self._buffers = self._new_buffers()
+        self._filled = 0
+        self._error = None
+        # at most two full chunks wait for the writer thread, which bounds memory if writing falls behind
+        self._queue = queue.Queue(maxsize=2)
+        self._thread = threading.Thread(target=self._write_chunks, name='snapshot-writer', daemon=True)
+        self._thread.start()
+
+    def _new_buffers(self):
+        return {field: np.empty((self.chunk_days, self.n_agents), dtype=dtype) for field, dtype in FIELDS.items()}
+
+    def append(self, snapshot):
+        """Add the next day's snapshot.
+
+        :param dict snapshot: snapshot from City.snapshot, one day after the previous one
+        """
+        self._raise_error()
+        if self.first_day is None:
+            self.first_day = snapshot['day']
+        elif snapshot['day'] != self.first_day + self.days:
+            raise ValueError('Expected a snapshot of day {}, got day {}'.format(self.first_day + self.days,
+                                                                                 snapshot['day']))
+        for field, buffer in self._buffers.items():
+            buffer[self._filled] = snapshot[field]
+        self._filled += 1
+        self.days += 1
+        if self._filled == self.chunk_days:
+            self._flush()
+
+    def _flush(self):
+        if self._filled == 0:
+            return
+        chunk = len(self.chunk_lengths)
+        self.chunk_lengths.append(self._filled)
+        self._queue.put((chunk, {field: buffer[:self._filled] for field, buffer in self._buffers.items()}))
+        self._buffers = self._new_buffers()
+        self._filled = 0
+
+    def _write_chunks(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue  # drain the queue so that append never blocks after a failure
+            chunk, arrays = item
+            try:
+                for field, array in arrays.items():
+                    path = _chunk_path(self.directory, field, chunk, self.codec)
+                    if self.codec == 'raw':
+                        np.save(path, array)
+                    else:
+                        with open(path, 'wb') as f:
+                            f.write(zlib.compress(array.tobytes(), self.level))
+                self._write_meta(chunk + 1)
+            except Exception as e:
+                self._error = e
+
+    def _write_meta(self, chunks_written):
+        meta = {
+            'n_agents': self.n_agents,
+            'codec': self.codec,
+            'fields': {field: np.dtype(dtype).str for field, dtype in FIELDS.items()},
+            'first_day': self.first_day,
+            'chunk_lengths': self.chunk_lengths[:chunks_written],
+        }
+        tmp = os.path.join(self.directory, META_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        # readers only ever see chunks that are completely written
+        os.replace(tmp, os.path.join(self.directory, META_FILE))
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise IOError('Writing snapshots to {} failed: {}'.format(self.directory, self._error))
+
+    def close(self):
+        """Write the last, partial chunk and wait for the writer thread to finish."""
+        if self._thread.is_alive():
+            self._flush()
+            self._queue.put(None)
+            self._thread.join()
+            if not self.chunk_lengths:
+                self._write_meta(0)
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SnapshotReader:
+    def __init__(self, directory):
+        '''Reads a snapshot store written by SnapshotWriter.
+
+        Behaves as a sequence of per-day snapshot dicts, so it can be passed to the functions in render.py.
+
+        :param str directory: store directory
+        '''
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        self.directory = directory
+        self.n_agents = meta['n_agents']
+        self.codec = meta['codec']
+        self.dtypes = {field: np.dtype(dtype) for field, dtype in meta['fields'].items()}
+        self.first_day = meta['first_day'] if meta['first_day'] is not None else 0
+        self.chunk_lengths = meta['chunk_lengths']
+        self.chunk_starts = np.concatenate(([0], np.cumsum(self.chunk_lengths))).astype(int)
+        # the last decompressed chunk of each field
+        self._cached_chunks = {}
+
+    @property
+    def days(self):
+        """The days in the store."""
+        return range(self.first_day, self.first_day + len(self))
+
+    def __len__(self):
+        return int(self.chunk_starts[-1])
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError('Snapshot index {} out of range'.format(index))
+        day = self.days[index]
+        return self.snapshot(day)
+
+    def snapshot(self, day):
+        """All fields of one day, as returned by City.snapshot."""
+        snapshot = {field: self.read(field, days=day)[0] for field in self.dtypes}
+        snapshot['day'] = day
+        return snapshot
+
+    def snapshots(self, days=None):
+        """The snapshots of a slice of days, by day number; None for all days."""
+        if days is None:
+            days = slice(None)
+        start = self.first_day if days.start is None else max(days.start, self.first_day)
+        stop = self.first_day + len(self) if days.stop is None else min(days.stop, self.first_day + len(self))
+        return [self.snapshot(day) for day in range(start, stop)]
+
+    def chunk(self, field, chunk):
+        """The (days, agents) array of one chunk; memory-mapped with the raw codec."""
+        path = _chunk_path(self.directory, field, chunk, self.codec)
+        if self.codec == 'raw':
+            return np.load(path, mmap_mode='r')
+        cached_chunk, array = self._cached_chunks.get(field, (None, None))
+        if cached_chunk != chunk:
+            with open(path, 'rb') as f:
+                data = zlib.decompress(f.read())
+            array = np.frombuffer(data, dtype=self.dtypes[field]).reshape(self.chunk_lengths[chunk], self.n_agents)
+            self._cached_chunks[field] = (chunk, array)
+        return array
+
+    def read(self, field, days=None, agents=None):
+        """Read a field for a range of days and agents.
+
+        A range of days that falls within one chunk of a raw store is returned as a view of the memory map, without
+        copying; ranges across chunks are concatenated.
+
+        :param str field: 'xs', 'ys', 'states' or 'modes'
+        :param days: a day or a slice of days (by day number, not position); None for all days
+        :param agents: slice or index array of agent numbers; None for all agents
+        :returns: (days, agents) array
+        """
+        if field not in self.dtypes:
+            raise ValueError('Unknown snapshot field {}, choose from {}'.format(field, sorted(self.dtypes)))
+        if days is None:
+            days = slice(None)
+        if isinstance(days, slice):
+            if days.step not in (None, 1):
+                raise ValueError('Day slices must have a step of 1')
+            # days are day numbers, not positions, so a slice reaching past either end is cut off there, as in
+            # snapshots, rather than counted from the end
+            start = 0 if days.start is None else min(max(days.start - self.first_day, 0), len(self))
+            stop = len(self) if days.stop is None else min(max(days.stop - self.first_day, 0), len(self))
+            stop = max(start, stop)
+        else:
+            start = days - self.first_day
+            if not 0 <= start < len(self):
+                raise IndexError('Day {} is not in the store'.format(days))
+            stop = start + 1
+        if agents is None:
+            agents = slice(None)
+
+        parts = []
+        first_chunk = max(int(np.searchsorted(self.chunk_starts, start, side='right')) - 1, 0)
+        for chunk in range(first_chunk, len(self.chunk_lengths)):
+            chunk_start = self.chunk_starts[chunk]
+            if chunk_start >= stop:
+                break
+            rows = slice(max(start - chunk_start, 0), min(stop - chunk_start, self.chunk_lengths[chunk]))
+            parts.append(self.chunk(field, chunk)[rows, agents])
+        if not parts:
+            return np.empty((0, self.n_agents), dtype=self.dtypes[field])[:, agents]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)